@@ -0,0 +1,522 @@
+"""
+Analytics backends for the dashboard.
+
+PostgresAnalytics runs the dashboard aggregates on the OLTP tables (read replica
+when configured). DuckDBAnalytics runs the same queries, with the same method
+names and row shapes, on Parquet snapshots of classes, students and results, so
+dashboard reads stop competing with writes. Snapshots are refreshed by the
+"analytics_snapshot" background job or directly:
+
+    python analytics.py [--every 300] [--full]
+
+Set ANALYTICS_BACKEND = "duckdb" to serve the dashboard from the snapshot; the
+dashboard falls back to PostgreSQL until the first snapshot exists.
+
+Every fetch takes an optional DashboardScope (semester, exam date range, class),
+which both backends apply in the query itself.
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import date
+import psycopg2
+from psycopg2.pool import PoolError
+import streamlit as st
+from db_connection import Connect_DB
+from jobs import register_job
+from repositories import AtRiskRepo, ClassRepo, CubeRepo, ResultRepo
+from stats_accumulators import CUBE_LEVELS, HISTOGRAM_BINS, HISTOGRAM_MIN, HISTOGRAM_MAX
+
+MANIFEST_NAME = "manifest.json"
+
+# Bump when the snapshot's columns change; a snapshot of another version is rewritten in full
+SNAPSHOT_VERSION = 5
+
+# Columns copied into the snapshot; results are written one file per class
+SNAPSHOT_TABLES = {
+    "classes": "SELECT id, class_name, semester, total_students, user_id, created_at, archived_at FROM classes ORDER BY id",
+    "students": "SELECT id, class_id, roll_no, name, user_id, created_at FROM students ORDER BY class_id, id",
+    "at_risk": """
+        SELECT student_id, user_id, class_id, result_count, percentile, trend, worst_drop, reasons, scored_at
+        FROM at_risk WHERE flagged ORDER BY student_id
+    """,
+}
+CLASS_RESULTS_QUERY = """
+    SELECT r.id, r.student_id, e.class_id, r.exam_id, sb.name AS subject, e.name AS exam_name,
+           r.marks, r.total_marks, e.exam_date, r.updated_at
+    FROM results r
+    JOIN exams e ON r.exam_id = e.id
+    JOIN subjects sb ON e.subject_id = sb.id
+    WHERE e.class_id = %s
+    ORDER BY r.exam_id, r.student_id
+"""
+
+
+class DashboardScope:
+    """
+    What the dashboard aggregates. semester narrows classes, students and results;
+    date_from/date_to narrow results to exams held in that range; class_id is the
+    first drill-down level (subjects and exams are slices of its per-exam partials).
+    None means no restriction.
+    """
+
+    def __init__(self, semester=None, date_from=None, date_to=None, class_id=None):
+        self.semester = semester
+        self.date_from = date_from
+        self.date_to = date_to
+        self.class_id = class_id
+
+    @property
+    def filtered(self):
+        return any(value is not None for value in (self.semester, self.date_from, self.date_to, self.class_id))
+
+    @property
+    def date_range(self):
+        """(first, last) exam date, open ends widened to the whole calendar"""
+        return self.date_from or date.min, self.date_to or date.max
+
+    @property
+    def needs_exams(self):
+        """A class drill-down or an exam date range reads per-exam partials; other views read the cube"""
+        return any(value is not None for value in (self.date_from, self.date_to, self.class_id))
+
+    def includes_class(self, class_id, semester):
+        return (self.class_id is None or class_id == self.class_id) and (self.semester is None or semester == self.semester)
+
+    def includes_exam(self, exam_date):
+        first, last = self.date_range
+        return first <= exam_date <= last
+
+
+def snapshot_dir():
+    return Connect_DB.get_setting(
+        "ANALYTICS_SNAPSHOT_DIR",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "analytics_snapshots")
+    )
+
+
+def read_manifest(directory=None):
+    path = os.path.join(directory or snapshot_dir(), MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def _write_parquet(rows, path, columns):
+    """Writes dict rows to path atomically (temp file, then rename)"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pydict({column: [row[column] for row in rows] for column in columns})
+    temp_path = f"{path}.tmp"
+    pq.write_table(table, temp_path, compression="zstd")
+    os.replace(temp_path, path)
+
+
+def take_snapshot(connection, directory=None, full=False, progress=None):
+    """
+    Refreshes the Parquet snapshot from PostgreSQL. Classes and students are small and
+    rewritten every time; results are rewritten only for classes whose result count or
+    latest updated_at changed since the previous snapshot (or all of them with full=True).
+    Everything is read in one REPEATABLE READ transaction so the files are consistent.
+    Returns a summary of what was written.
+    """
+    directory = directory or snapshot_dir()
+    results_dir = os.path.join(directory, "results")
+    os.makedirs(results_dir, exist_ok=True)
+    started = time.perf_counter()
+
+    previous = None if full else read_manifest(directory)
+    if previous and previous.get("version") != SNAPSHOT_VERSION:
+        previous = None
+    previous_fingerprints = (previous or {}).get("classes", {})
+
+    connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT now() AS taken_at")
+        taken_at = cursor.fetchone()['taken_at']
+
+        for table, query in SNAPSHOT_TABLES.items():
+            cursor.execute(query)
+            columns = [column.name for column in cursor.description]
+            _write_parquet(cursor.fetchall(), os.path.join(directory, f"{table}.parquet"), columns)
+
+        cursor.execute("""
+            SELECT e.class_id, COUNT(*) AS row_count, MAX(r.updated_at) AS updated_at
+            FROM results r
+            JOIN exams e ON r.exam_id = e.id
+            GROUP BY e.class_id
+        """)
+        fingerprints = {
+            str(row['class_id']): [row['row_count'], row['updated_at'].isoformat() if row['updated_at'] else None]
+            for row in cursor.fetchall()
+        }
+
+        changed = [
+            class_id for class_id, fingerprint in fingerprints.items()
+            if previous_fingerprints.get(class_id) != fingerprint
+            or not os.path.exists(os.path.join(results_dir, f"class_{class_id}.parquet"))
+        ]
+        for index, class_id in enumerate(changed, start=1):
+            cursor.execute(CLASS_RESULTS_QUERY, (int(class_id),))
+            columns = [column.name for column in cursor.description]
+            _write_parquet(cursor.fetchall(), os.path.join(results_dir, f"class_{class_id}.parquet"), columns)
+            if progress:
+                progress(index, len(changed))
+    finally:
+        cursor.close()
+        connection.rollback()
+        connection.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+
+    # Drop partitions of classes that no longer have results
+    removed = 0
+    for name in os.listdir(results_dir):
+        class_id = name[len("class_"):-len(".parquet")] if name.startswith("class_") and name.endswith(".parquet") else None
+        if class_id is not None and class_id not in fingerprints:
+            os.remove(os.path.join(results_dir, name))
+            removed += 1
+
+    manifest = {"version": SNAPSHOT_VERSION, "taken_at": taken_at.isoformat(), "classes": fingerprints}
+    temp_path = os.path.join(directory, f"{MANIFEST_NAME}.tmp")
+    with open(temp_path, "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle)
+    os.replace(temp_path, os.path.join(directory, MANIFEST_NAME))
+
+    return {
+        "taken_at": manifest["taken_at"],
+        "classes_rewritten": len(changed),
+        "classes_removed": removed,
+        "classes_total": len(fingerprints),
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+class PostgresAnalytics:
+    """Dashboard aggregates over the OLTP tables, on the read-only pool (statements live in repositories.py)"""
+
+    errors = (psycopg2.Error, PoolError)
+
+    def __init__(self, pool, slots, guard=None):
+        self.pool = pool
+        self.slots = slots
+        # Captured on the script thread: the queries run on worker threads
+        self.guard = guard
+
+    @contextmanager
+    def cursor(self):
+        with self.slots:
+            with Connect_DB.pooled_connection(self.pool, self.guard) as connection:
+                cursor = connection.cursor()
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+
+    def fetch_classes(self, cursor, user_id):
+        return ClassRepo(cursor).list_for_user(user_id)
+
+    def fetch_totals(self, cursor, user_id, scope=None):
+        return ClassRepo(cursor).totals(user_id, scope.semester if scope else None)
+
+    def fetch_class_distribution(self, cursor, user_id, scope=None):
+        return ClassRepo(cursor).distribution(user_id, scope.semester if scope else None)
+
+    def fetch_performance_partials(self, cursor, user_id, scope=None):
+        if scope is None or not scope.filtered:
+            return ResultRepo(cursor).performance_partials(user_id)
+        return ResultRepo(cursor).scoped_partials(user_id, *scope.date_range, scope.semester, scope.class_id)
+
+    def fetch_performance_cube(self, cursor, user_id, scope=None):
+        return CubeRepo(cursor).slices(user_id, scope.semester if scope else None)
+
+    def fetch_enrollment(self, cursor, user_id, scope=None):
+        return ClassRepo(cursor).enrollment(user_id, scope.semester if scope else None)
+
+    def fetch_enrollment_buckets(self, cursor, user_id, unit, since):
+        return ClassRepo(cursor).enrollment_buckets(user_id, unit, since)
+
+    def fetch_at_risk(self, cursor, user_id, scope=None):
+        rows = AtRiskRepo(cursor).flagged_for_user(user_id)
+        # A teacher's flagged students are few; the index already narrowed them to the user
+        return [row for row in rows if scope is None or scope.includes_class(row['class_id'], row['semester'])]
+
+
+@st.cache_resource(max_entries=2)
+def _duckdb_database(directory, taken_at):
+    """
+    One in-process DuckDB database per snapshot, with views over its Parquet files.
+    Keyed on the manifest timestamp so a refreshed snapshot gets fresh views.
+    """
+    import duckdb
+
+    database = duckdb.connect(":memory:")
+    files = {table: os.path.join(directory, f"{table}.parquet").replace("'", "''")
+             for table in ("classes", "students", "at_risk")}
+    database.execute(f"CREATE VIEW classes AS SELECT * FROM read_parquet('{files['classes']}')")
+    database.execute(f"CREATE VIEW students AS SELECT * FROM read_parquet('{files['students']}')")
+    database.execute(f"CREATE VIEW at_risk AS SELECT * FROM read_parquet('{files['at_risk']}')")
+    results_glob = os.path.join(directory, "results", "*.parquet")
+    if glob.glob(results_glob):
+        results_glob = results_glob.replace("'", "''")
+        database.execute(f"CREATE VIEW results AS SELECT * FROM read_parquet('{results_glob}', union_by_name = true)")
+    else:
+        database.execute("""
+            CREATE VIEW results AS
+            SELECT NULL::INTEGER AS id, NULL::INTEGER AS student_id, NULL::INTEGER AS class_id,
+                   NULL::INTEGER AS exam_id, NULL::VARCHAR AS subject, NULL::VARCHAR AS exam_name,
+                   NULL::INTEGER AS marks, NULL::INTEGER AS total_marks,
+                   NULL::DATE AS exam_date, NULL::TIMESTAMP AS updated_at
+            WHERE FALSE
+        """)
+    return database
+
+
+class DuckDBAnalytics:
+    """
+    The PostgresAnalytics queries on an embedded columnar engine over the Parquet
+    snapshot. Rows are returned as dicts, so the dashboard cannot tell them apart.
+    Performance partials are computed from raw results here, since scanning them
+    column-wise is cheap and the snapshot has no result_aggregates table.
+    """
+
+    def __init__(self, directory, taken_at):
+        import duckdb
+
+        self.directory = directory
+        self.errors = (duckdb.Error, OSError)
+        self.database = _duckdb_database(directory, taken_at)
+
+    @contextmanager
+    def cursor(self):
+        # DuckDB cursors are per-thread handles on the shared database
+        cursor = self.database.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _rows(cursor):
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _semester(user_id, scope):
+        """Extra condition on classes c, and the query parameters, for the scope's semester"""
+        if scope is None or scope.semester is None:
+            return "", {"user_id": user_id}
+        return "AND c.semester = $semester", {"user_id": user_id, "semester": scope.semester}
+
+    def fetch_classes(self, cursor, user_id):
+        cursor.execute("""
+            SELECT id, class_name, semester, total_students, archived_at FROM classes WHERE user_id = $user_id
+        """, {"user_id": user_id})
+        return self._rows(cursor)
+
+    def fetch_totals(self, cursor, user_id, scope=None):
+        semester, params = self._semester(user_id, scope)
+        cursor.execute(f"""
+            SELECT
+                (SELECT COUNT(*) FROM classes c WHERE c.user_id = $user_id {semester}) AS total_classes,
+                (SELECT COUNT(*) FROM students s JOIN classes c ON s.class_id = c.id
+                 WHERE c.user_id = $user_id {semester}) AS total_students,
+                COALESCE((SELECT MAX(student_count) FROM (
+                    SELECT COUNT(*) AS student_count FROM students s JOIN classes c ON s.class_id = c.id
+                    WHERE c.user_id = $user_id {semester} GROUP BY s.class_id)), 0) AS highest_students
+        """, params)
+        rows = self._rows(cursor)
+        return rows[0] if rows else None
+
+    def fetch_class_distribution(self, cursor, user_id, scope=None):
+        semester, params = self._semester(user_id, scope)
+        cursor.execute(f"""
+            SELECT c.class_name, COUNT(s.id) AS student_count
+            FROM classes c
+            LEFT JOIN students s ON c.id = s.class_id
+            WHERE c.user_id = $user_id AND c.archived_at IS NULL {semester}
+            GROUP BY c.class_name, c.id
+            ORDER BY student_count DESC
+        """, params)
+        return self._rows(cursor)
+
+    def fetch_performance_partials(self, cursor, user_id, scope=None):
+        # Same fixed bins as RunningStats.bin_index, so partials merge with the Postgres ones
+        width = (HISTOGRAM_MAX - HISTOGRAM_MIN) / HISTOGRAM_BINS
+        bins = ", ".join(f"count_if(bin = {index})" for index in range(HISTOGRAM_BINS))
+        conditions, params = self._semester(user_id, scope)
+        if scope is not None and scope.filtered:
+            conditions += " AND r.exam_date BETWEEN $date_from AND $date_to"
+            params["date_from"], params["date_to"] = scope.date_range
+            if scope.class_id is not None:
+                conditions += " AND r.class_id = $class_id"
+                params["class_id"] = scope.class_id
+        cursor.execute(f"""
+            SELECT class_id, class_name, semester, exam_id, subject, exam_name, exam_date,
+                COUNT(*) AS count, AVG(percentage) AS mean,
+                VAR_POP(percentage) * COUNT(*) AS m2,
+                MIN(percentage) AS min_value, MAX(percentage) AS max_value,
+                list_value({bins}) AS histogram
+            FROM (
+                SELECT *, LEAST(GREATEST(FLOOR((percentage - {HISTOGRAM_MIN}) / {width}), 0), {HISTOGRAM_BINS - 1}) AS bin
+                FROM (
+                    SELECT r.class_id, c.class_name, c.semester, r.exam_id, r.subject, r.exam_name, r.exam_date,
+                        r.marks::DOUBLE / r.total_marks * 100 AS percentage
+                    FROM results r
+                    JOIN classes c ON r.class_id = c.id
+                    WHERE c.user_id = $user_id AND r.total_marks > 0 {conditions}
+                )
+            )
+            GROUP BY class_id, class_name, semester, exam_id, subject, exam_name, exam_date
+        """, params)
+        return self._rows(cursor)
+
+    def fetch_performance_cube(self, cursor, user_id, scope=None):
+        # The result_cube levels in one GROUPING SETS pass over the raw results
+        width = (HISTOGRAM_MAX - HISTOGRAM_MIN) / HISTOGRAM_BINS
+        bins = ", ".join(f"count_if(bin = {index})" for index in range(HISTOGRAM_BINS))
+        semester, params = self._semester(user_id, scope)
+        # Within a semester, only the levels that keep the semester apply (as CubeRepo.slices)
+        sets = {
+            columns: level for level, columns in CUBE_LEVELS.items()
+            if scope is None or scope.semester is None or "semester" in columns
+        }
+        cursor.execute(f"""
+            SELECT semester, class_id, CASE WHEN class_id IS NOT NULL THEN ANY_VALUE(class_name) END AS class_name,
+                subject, exam_date,
+                COUNT(*) AS count, AVG(percentage) AS mean,
+                VAR_POP(percentage) * COUNT(*) AS m2,
+                MIN(percentage) AS min_value, MAX(percentage) AS max_value,
+                list_value({bins}) AS histogram
+            FROM (
+                SELECT *, LEAST(GREATEST(FLOOR((percentage - {HISTOGRAM_MIN}) / {width}), 0), {HISTOGRAM_BINS - 1}) AS bin
+                FROM (
+                    SELECT c.semester, r.class_id, c.class_name, r.subject, r.exam_date,
+                        r.marks::DOUBLE / r.total_marks * 100 AS percentage
+                    FROM results r
+                    JOIN classes c ON r.class_id = c.id
+                    WHERE c.user_id = $user_id AND r.total_marks > 0 {semester}
+                )
+            )
+            GROUP BY GROUPING SETS ({", ".join(f"({', '.join(columns)})" for columns in sets)})
+        """, params)
+        rows = self._rows(cursor)
+        # A row's level is the set of columns it was grouped by (the data has no NULLs)
+        for row in rows:
+            row['level'] = sets[tuple(
+                column for column in ("semester", "class_id", "subject", "exam_date") if row[column] is not None
+            )]
+        return rows
+
+    def fetch_enrollment(self, cursor, user_id, scope=None):
+        semester, params = self._semester(user_id, scope)
+        cursor.execute(f"""
+            SELECT c.class_name, c.semester, COUNT(s.id) AS student_count
+            FROM classes c
+            LEFT JOIN students s ON c.id = s.class_id
+            WHERE c.user_id = $user_id {semester}
+            GROUP BY c.class_name, c.semester, c.id
+            HAVING COUNT(s.id) > 0
+            ORDER BY student_count DESC
+        """, params)
+        return self._rows(cursor)
+
+    def fetch_enrollment_buckets(self, cursor, user_id, unit, since):
+        cursor.execute("""
+            SELECT bucket, class_id, semester,
+                SUM(new_classes)::INTEGER AS new_classes, SUM(new_students)::INTEGER AS new_students
+            FROM (
+                SELECT date_trunc($unit, c.created_at)::DATE AS bucket, c.id AS class_id, c.semester,
+                    1 AS new_classes, 0 AS new_students
+                FROM classes c
+                WHERE c.user_id = $user_id AND c.created_at >= $since
+                UNION ALL
+                SELECT date_trunc($unit, s.created_at)::DATE, s.class_id, c.semester, 0, 1
+                FROM students s
+                JOIN classes c ON s.class_id = c.id
+                WHERE c.user_id = $user_id AND s.created_at >= $since
+            )
+            GROUP BY bucket, class_id, semester
+            ORDER BY bucket
+        """, {"user_id": user_id, "unit": unit, "since": since})
+        return self._rows(cursor)
+
+    def fetch_at_risk(self, cursor, user_id, scope=None):
+        semester, params = self._semester(user_id, scope)
+        if scope is not None and scope.class_id is not None:
+            semester += " AND c.id = $class_id"
+            params["class_id"] = scope.class_id
+        cursor.execute(f"""
+            SELECT ar.student_id, s.roll_no, s.name, ar.class_id, c.class_name, c.semester,
+                ar.result_count, ar.percentile, ar.trend, ar.worst_drop, ar.reasons, ar.scored_at
+            FROM at_risk ar
+            JOIN students s ON ar.student_id = s.id
+            JOIN classes c ON ar.class_id = c.id
+            WHERE ar.user_id = $user_id {semester}
+            ORDER BY ar.percentile, s.name
+        """, params)
+        return self._rows(cursor)
+
+
+def get_analytics():
+    """
+    Returns the configured analytics backend (ANALYTICS_BACKEND = "postgres" or "duckdb"),
+    or None if no database is reachable. DuckDB is only used once a current snapshot exists.
+    """
+    if Connect_DB.get_setting("ANALYTICS_BACKEND", "postgres").lower() == "duckdb":
+        directory = snapshot_dir()
+        manifest = read_manifest(directory)
+        if manifest is not None and manifest.get("version") == SNAPSHOT_VERSION:
+            return DuckDBAnalytics(directory, manifest["taken_at"])
+
+    pool = Connect_DB.get_pool(readonly=True)
+    if not pool:
+        return None
+    return PostgresAnalytics(pool, Connect_DB.session_slots(), Connect_DB.session_guard())
+
+
+@register_job("analytics_snapshot")
+def run_snapshot_job(job, connection):
+    """params: optional full (rewrite every class instead of only changed ones)"""
+    return take_snapshot(
+        connection,
+        full=bool(job.params.get("full")),
+        progress=lambda done, total: job.report(done / total, f"{done} of {total} classes")
+    )
+
+
+def main():
+    from psycopg2.extras import RealDictCursor
+
+    parser = argparse.ArgumentParser(description="Refresh the Parquet snapshot used by the DuckDB analytics backend")
+    parser.add_argument("--every", type=float, default=None, help="keep refreshing every N seconds")
+    parser.add_argument("--full", action="store_true", help="rewrite every class, not only changed ones")
+    parser.add_argument("--out", default=None, help="snapshot directory (default ANALYTICS_SNAPSHOT_DIR)")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        Connect_DB.get_database_url(),
+        cursor_factory=RealDictCursor,
+        sslmode=Connect_DB.get_setting("DB_SSLMODE", "require")
+    )
+    full = args.full
+    try:
+        while True:
+            summary = take_snapshot(connection, args.out, full=full)
+            print(f"snapshot at {summary['taken_at']}: {summary['classes_rewritten']} of "
+                  f"{summary['classes_total']} classes rewritten, {summary['classes_removed']} removed "
+                  f"in {summary['seconds']}s", flush=True)
+            if args.every is None:
+                break
+            full = False
+            time.sleep(args.every)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
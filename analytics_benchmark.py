@@ -0,0 +1,72 @@
+"""
+Compares the dashboard queries on PostgreSQL and on the DuckDB Parquet snapshot.
+
+    python analytics_benchmark.py --user-id 1 [--runs 20] [--snapshot]
+
+Each query is run --runs times per backend after one warm-up run and the median
+and p95 milliseconds are printed side by side. --snapshot refreshes the snapshot
+first. PostgreSQL is measured on a single connection to DATABASE_URL, so the
+numbers are per-query latency without pool or replica effects.
+"""
+import argparse
+import statistics
+import time
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from db_connection import Connect_DB
+from analytics import PostgresAnalytics, DuckDBAnalytics, read_manifest, snapshot_dir, take_snapshot
+
+QUERIES = ["fetch_totals", "fetch_class_distribution", "fetch_performance_partials", "fetch_performance_cube", "fetch_enrollment"]
+
+
+def time_query(fetch, cursor, user_id, runs):
+    fetch(cursor, user_id)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fetch(cursor, user_id)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dashboard queries on PostgreSQL vs DuckDB")
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--snapshot", action="store_true", help="refresh the Parquet snapshot before measuring")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        Connect_DB.get_database_url(),
+        cursor_factory=RealDictCursor,
+        sslmode=Connect_DB.get_setting("DB_SSLMODE", "require")
+    )
+    try:
+        if args.snapshot:
+            summary = take_snapshot(connection)
+            print(f"snapshot: {summary['classes_rewritten']} classes rewritten in {summary['seconds']}s")
+
+        directory = snapshot_dir()
+        manifest = read_manifest(directory)
+        if manifest is None:
+            raise SystemExit("No analytics snapshot yet; run with --snapshot or python analytics.py first")
+
+        postgres = PostgresAnalytics(pool=None, slots=None)
+        duckdb = DuckDBAnalytics(directory, manifest["taken_at"])
+        pg_cursor = connection.cursor()
+
+        print(f"{'query':<28}{'postgres p50':>14}{'p95':>9}{'duckdb p50':>14}{'p95':>9}{'speedup':>10}")
+        with duckdb.cursor() as duck_cursor:
+            for name in QUERIES:
+                pg_p50, pg_p95 = time_query(getattr(postgres, name), pg_cursor, args.user_id, args.runs)
+                dk_p50, dk_p95 = time_query(getattr(duckdb, name), duck_cursor, args.user_id, args.runs)
+                print(f"{name:<28}{pg_p50:>12.2f}ms{pg_p95:>7.2f}ms{dk_p50:>12.2f}ms{dk_p95:>7.2f}ms"
+                      f"{pg_p50 / dk_p50 if dk_p50 else float('inf'):>9.1f}x")
+        pg_cursor.close()
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
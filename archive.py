@@ -0,0 +1,475 @@
+"""
+Hot/cold archival of closed semesters.
+
+Archiving a class moves its students, subjects, exams and results out of
+PostgreSQL into zstd-compressed Parquet files under ARCHIVE_DIR (one directory
+per class) and marks the class row archived. The class row itself stays, so ids
+and the class list don't change. manifest.json records each archived class with
+its row counts and what the dashboard needs from it (student count and per-exam
+partial aggregates), so dashboards merge cold classes in without opening any
+Parquet. Exports read archived rows with DuckDB. Restoring loads the rows back
+with their original ids.
+
+    python archive.py archive --user-id 1 --semester "Fall 2024"
+    python archive.py restore --user-id 1 --class-id 42
+    python archive.py list --user-id 1
+
+Both operations also run as background jobs (archive_semester, restore_class).
+Settings: ARCHIVE_DIR (default ./archive).
+"""
+import argparse
+import fcntl
+import json
+import os
+import shutil
+from collections import defaultdict
+from datetime import date, datetime
+import psycopg2
+from psycopg2.extras import execute_values
+from db_connection import Connect_DB
+from jobs import register_job
+from live_updates import publish_change
+from repositories import CubeRepo, RankingRepo
+from shared_cache import invalidate_user
+from stats_accumulators import RunningStats, backfill_partials, cube_rows
+
+MANIFEST_NAME = "manifest.json"
+
+# Rows moved per archived class, in restore (foreign key) order
+ARCHIVE_TABLES = {
+    "students": "SELECT id, class_id, roll_no, name, user_id, created_at FROM students WHERE class_id = %s ORDER BY id",
+    "subjects": "SELECT id, class_id, name FROM subjects WHERE class_id = %s ORDER BY id",
+    "exams": "SELECT id, class_id, subject_id, name, exam_date FROM exams WHERE class_id = %s ORDER BY id",
+    "results": """
+        SELECT r.id, r.student_id, r.exam_id, r.marks, r.total_marks, r.created_at, r.updated_at
+        FROM results r
+        JOIN exams e ON r.exam_id = e.id
+        WHERE e.class_id = %s
+        ORDER BY r.exam_id, r.student_id
+    """,
+}
+
+# Rows inserted per round trip on restore
+RESTORE_BATCH_SIZE = 1000
+
+_manifest_cache = {}
+
+
+def archive_dir():
+    return Connect_DB.get_setting(
+        "ARCHIVE_DIR",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive")
+    )
+
+
+def class_dir(directory, class_id):
+    return os.path.join(directory, f"class_{class_id}")
+
+
+def read_manifest(directory=None):
+    """{"classes": {class_id (str): summary}}; re-read only when the file changes"""
+    path = os.path.join(directory or archive_dir(), MANIFEST_NAME)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {"classes": {}}
+    cached = _manifest_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, encoding="utf-8") as handle:
+        manifest = json.load(handle)
+    _manifest_cache[path] = (mtime, manifest)
+    return manifest
+
+
+def _update_manifest(directory, add=None, remove=None):
+    """Read-modify-write under a file lock, so concurrent jobs don't lose entries"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "manifest.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = os.path.join(directory, MANIFEST_NAME)
+        manifest = {"classes": {}}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as handle:
+                manifest = json.load(handle)
+        if add:
+            manifest["classes"][str(add["class_id"])] = add
+        if remove is not None:
+            manifest["classes"].pop(str(remove), None)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as handle:
+            json.dump(manifest, handle)
+        os.replace(temp_path, path)
+
+
+def archived_classes(user_id, directory=None):
+    """Summaries of a user's archived classes, from the manifest"""
+    return [
+        summary for summary in read_manifest(directory)["classes"].values()
+        if summary["user_id"] == user_id
+    ]
+
+
+def _write_parquet(rows, path, columns):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pydict({column: [row[column] for row in rows] for column in columns})
+    pq.write_table(table, path, compression="zstd")
+
+
+def _summarize(cls, tables, directory):
+    """Manifest entry: row counts, bytes on disk, per-exam partials and enrollment days for the dashboard"""
+    subjects = {row['id']: row['name'] for row in tables["subjects"]}
+    exams = {row['id']: row for row in tables["exams"]}
+    percentages = defaultdict(list)
+    for row in tables["results"]:
+        percentages[row['exam_id']].append(row['marks'] / row['total_marks'] * 100 if row['total_marks'] else None)
+
+    partials = []
+    for exam_id, values in percentages.items():
+        stats = RunningStats.from_values(value for value in values if value is not None)
+        if stats.count == 0:
+            continue
+        exam = exams[exam_id]
+        partials.append({
+            "exam_id": exam_id,
+            "subject": subjects[exam['subject_id']],
+            "exam_name": exam['name'],
+            "exam_date": exam['exam_date'].isoformat(),
+            "rows": len(values),
+            "count": stats.count,
+            "mean": stats.mean,
+            "m2": stats.m2,
+            "min_value": stats.minimum,
+            "max_value": stats.maximum,
+            "histogram": stats.histogram,
+        })
+
+    # Students added per day, for the enrollment trend
+    enrolled = defaultdict(int)
+    for row in tables["students"]:
+        if row['created_at'] is not None:
+            enrolled[row['created_at'].date().isoformat()] += 1
+
+    return {
+        "class_id": cls['id'],
+        "user_id": cls['user_id'],
+        "class_name": cls['class_name'],
+        "semester": cls['semester'],
+        "archived_at": datetime.now().isoformat(timespec="seconds"),
+        "students": len(tables["students"]),
+        "rows": {table: len(rows) for table, rows in tables.items()},
+        "bytes": sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)),
+        "partials": partials,
+        "enrolled": dict(sorted(enrolled.items())),
+    }
+
+
+def archive_class(connection, user_id, class_id, directory=None):
+    """
+    Moves one class's rows to Parquet and deletes them from PostgreSQL in a single
+    transaction; the files are in place before the delete commits. Returns the summary.
+    """
+    directory = directory or archive_dir()
+    target = class_dir(directory, class_id)
+    moved = listed = False
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """SELECT id, user_id, class_name, semester FROM classes
+               WHERE id = %s AND user_id = %s AND archived_at IS NULL FOR UPDATE""",
+            (class_id, user_id)
+        )
+        cls = cursor.fetchone()
+        if cls is None:
+            raise ValueError(f"Class {class_id} not found or already archived")
+        # Locking the students makes concurrent results writes wait (and then fail)
+        cursor.execute("SELECT id FROM students WHERE class_id = %s FOR UPDATE", (class_id,))
+
+        temp = f"{target}.tmp"
+        shutil.rmtree(temp, ignore_errors=True)
+        os.makedirs(temp)
+        tables = {}
+        for table, query in ARCHIVE_TABLES.items():
+            cursor.execute(query, (class_id,))
+            tables[table] = cursor.fetchall()
+            columns = [column.name for column in cursor.description]
+            _write_parquet(tables[table], os.path.join(temp, f"{table}.parquet"), columns)
+        summary = _summarize(cls, tables, temp)
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(temp, target)
+        moved = True
+
+        cursor.execute("UPDATE classes SET archived_at = CURRENT_TIMESTAMP WHERE id = %s", (class_id,))
+        # Exams, results and partial aggregates go with the subjects and students
+        cursor.execute("DELETE FROM subjects WHERE class_id = %s", (class_id,))
+        cursor.execute("DELETE FROM students WHERE class_id = %s", (class_id,))
+        # The class's semester, subject and date slices lose its exams
+        CubeRepo(cursor).refresh_user(user_id)
+        publish_change(cursor, user_id, "classes", class_id=class_id)
+        publish_change(cursor, user_id, "results", class_id=class_id)
+        # Listed before the commit, so a committed archive is never missing from the manifest
+        _update_manifest(directory, add=summary)
+        listed = True
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        if listed:
+            _update_manifest(directory, remove=class_id)
+        shutil.rmtree(f"{target}.tmp", ignore_errors=True)
+        if moved:
+            shutil.rmtree(target, ignore_errors=True)
+        raise
+    finally:
+        cursor.close()
+
+    invalidate_user(user_id)
+    return summary
+
+
+def restore_class(connection, user_id, class_id, directory=None):
+    """Loads an archived class back into PostgreSQL and removes its files; returns row counts"""
+    import pyarrow.parquet as pq
+
+    directory = directory or archive_dir()
+    source = class_dir(directory, class_id)
+    summary = None
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "SELECT id FROM classes WHERE id = %s AND user_id = %s AND archived_at IS NOT NULL FOR UPDATE",
+            (class_id, user_id)
+        )
+        if cursor.fetchone() is None:
+            raise ValueError(f"Class {class_id} not found or not archived")
+
+        counts = {}
+        for table in ARCHIVE_TABLES:
+            data = pq.read_table(os.path.join(source, f"{table}.parquet"))
+            counts[table] = data.num_rows
+            if not data.num_rows:
+                continue
+            columns = data.column_names
+            rows = [tuple(row[column] for column in columns) for row in data.to_pylist()]
+            execute_values(
+                cursor,
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+                rows,
+                page_size=RESTORE_BATCH_SIZE
+            )
+        # Recomputes partial aggregates for the restored exams (the only ones missing), then ranks
+        # the class and rolls its exams back into the cube
+        backfill_partials(cursor, user_id)
+        RankingRepo(cursor).refresh(class_id, user_id)
+        CubeRepo(cursor).refresh_user(user_id)
+        cursor.execute("UPDATE classes SET archived_at = NULL WHERE id = %s", (class_id,))
+        publish_change(cursor, user_id, "classes", class_id=class_id)
+        publish_change(cursor, user_id, "results", class_id=class_id)
+        # Unlisted before the commit, so a restored class is never counted twice
+        summary = read_manifest(directory)["classes"].get(str(class_id))
+        _update_manifest(directory, remove=class_id)
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        if summary:
+            _update_manifest(directory, add=summary)
+        raise
+    finally:
+        cursor.close()
+
+    shutil.rmtree(source, ignore_errors=True)
+    invalidate_user(user_id)
+    return counts
+
+
+def archive_semester(connection, user_id, semester, directory=None, progress=None):
+    """Archives every hot class of a user in one semester, one transaction per class"""
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT id FROM classes WHERE user_id = %s AND semester = %s AND archived_at IS NULL ORDER BY id",
+        (user_id, semester)
+    )
+    class_ids = [row['id'] for row in cursor.fetchall()]
+    cursor.close()
+    connection.commit()
+
+    totals = {"classes": 0, "students": 0, "results": 0, "bytes": 0}
+    for index, class_id in enumerate(class_ids, start=1):
+        summary = archive_class(connection, user_id, class_id, directory)
+        totals["classes"] += 1
+        totals["students"] += summary["students"]
+        totals["results"] += summary["rows"]["results"]
+        totals["bytes"] += summary["bytes"]
+        if progress:
+            progress(index, len(class_ids))
+    return totals
+
+
+def merge_archived(data, user_id, directory=None, scope=None):
+    """
+    Adds a user's archived classes to hot dashboard datasets (any subset of
+    totals, class_distribution, performance, performance_cube and enrollment). Hot
+    queries skip archived classes, except the class count, which still includes them.
+    With a DashboardScope, only the archived classes and exams inside it are added.
+    """
+    classes = archived_classes(user_id, directory)
+    if scope is not None:
+        classes = [cls for cls in classes if scope.includes_class(cls["class_id"], cls["semester"])]
+    if not classes or data is None:
+        return data
+    data = dict(data)
+
+    if data.get("totals") is not None:
+        totals = dict(data["totals"])
+        totals["total_students"] = (totals["total_students"] or 0) + sum(cls["students"] for cls in classes)
+        totals["highest_students"] = max([totals["highest_students"] or 0] + [cls["students"] for cls in classes])
+        data["totals"] = totals
+    if "class_distribution" in data:
+        rows = list(data["class_distribution"] or []) + [
+            {"class_name": cls["class_name"], "student_count": cls["students"]} for cls in classes
+        ]
+        data["class_distribution"] = sorted(rows, key=lambda row: row['student_count'], reverse=True)
+    if "enrollment" in data:
+        rows = list(data["enrollment"] or []) + [
+            {"class_name": cls["class_name"], "semester": cls["semester"], "student_count": cls["students"]}
+            for cls in classes if cls["students"] > 0
+        ]
+        data["enrollment"] = sorted(rows, key=lambda row: row['student_count'], reverse=True)
+    if "performance" in data or "performance_cube" in data:
+        partials = [
+            dict(partial, class_id=cls["class_id"], class_name=cls["class_name"], semester=cls["semester"],
+                 exam_date=date.fromisoformat(partial["exam_date"]))
+            for cls in classes for partial in cls["partials"]
+        ]
+        if scope is not None:
+            partials = [partial for partial in partials if scope.includes_exam(partial["exam_date"])]
+        if "performance" in data:
+            data["performance"] = list(data["performance"] or []) + partials
+        if "performance_cube" in data:
+            # Rolled up on their own; the dashboard merges rows of the same slice
+            rows = cube_rows(partials)
+            if scope is not None and scope.semester is not None:
+                rows = [row for row in rows if row['semester'] is not None]
+            data["performance_cube"] = list(data["performance_cube"] or []) + rows
+    return data
+
+
+def archived_enrollment(user_id, directory=None):
+    """
+    Students added per day to a user's archived classes: (day, class_id, semester, count).
+    Classes archived before enrollment days were recorded are left out.
+    """
+    return [
+        (date.fromisoformat(day), cls["class_id"], cls["semester"], count)
+        for cls in archived_classes(user_id, directory)
+        for day, count in cls.get("enrolled", {}).items()
+    ]
+
+
+def _scoped(user_id, class_id, exam_id, directory):
+    for summary in archived_classes(user_id, directory):
+        if class_id is not None and summary["class_id"] != class_id:
+            continue
+        if exam_id is not None and all(partial["exam_id"] != exam_id for partial in summary["partials"]):
+            continue
+        if summary["rows"]["results"]:
+            yield summary
+
+
+def archived_result_count(user_id, class_id=None, exam_id=None, directory=None):
+    """Archived result rows in an export scope, from the manifest"""
+    if exam_id is None:
+        return sum(summary["rows"]["results"] for summary in _scoped(user_id, class_id, None, directory))
+    return sum(
+        partial["rows"]
+        for summary in _scoped(user_id, class_id, exam_id, directory)
+        for partial in summary["partials"] if partial["exam_id"] == exam_id
+    )
+
+
+def iter_archived_chunks(user_id, class_id=None, exam_id=None, chunk_size=5000, directory=None):
+    """Yields archived results as export row tuples (EXPORT_COLUMNS order), chunk_size at a time"""
+    import duckdb
+
+    directory = directory or archive_dir()
+    for summary in _scoped(user_id, class_id, exam_id, directory):
+        path = class_dir(directory, summary["class_id"])
+        database = duckdb.connect(":memory:")
+        try:
+            files = {table: os.path.join(path, f"{table}.parquet").replace("'", "''") for table in ARCHIVE_TABLES}
+            database.execute(f"""
+                SELECT $class_name, $semester, s.roll_no, s.name, sb.name, e.name, e.exam_date,
+                       r.marks, r.total_marks,
+                       ROUND(r.marks::DOUBLE / NULLIF(r.total_marks, 0) * 100, 2) AS percentage
+                FROM read_parquet('{files["results"]}') r
+                JOIN read_parquet('{files["students"]}') s ON r.student_id = s.id
+                JOIN read_parquet('{files["exams"]}') e ON r.exam_id = e.id
+                JOIN read_parquet('{files["subjects"]}') sb ON e.subject_id = sb.id
+                WHERE $exam_id IS NULL OR r.exam_id = $exam_id
+                ORDER BY e.exam_date, lower(sb.name), e.name, s.roll_no
+            """, {"class_name": summary["class_name"], "semester": summary["semester"], "exam_id": exam_id})
+            while True:
+                rows = database.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            database.close()
+
+
+@register_job("archive_semester")
+def run_archive_job(job, connection):
+    """params: semester"""
+    return archive_semester(
+        connection,
+        job.user_id,
+        job.params["semester"],
+        progress=lambda done, total: job.report(done / total, f"{done} of {total} classes")
+    )
+
+
+@register_job("restore_class")
+def run_restore_job(job, connection):
+    """params: class_id"""
+    return restore_class(connection, job.user_id, int(job.params["class_id"]))
+
+
+def main():
+    from psycopg2.extras import RealDictCursor
+
+    parser = argparse.ArgumentParser(description="Move closed semesters to Parquet and back")
+    commands = parser.add_subparsers(dest="command", required=True)
+    archive_parser = commands.add_parser("archive", help="archive every class of a semester")
+    archive_parser.add_argument("--user-id", type=int, required=True)
+    archive_parser.add_argument("--semester", required=True)
+    restore_parser = commands.add_parser("restore", help="restore one archived class")
+    restore_parser.add_argument("--user-id", type=int, required=True)
+    restore_parser.add_argument("--class-id", type=int, required=True)
+    list_parser = commands.add_parser("list", help="list archived classes")
+    list_parser.add_argument("--user-id", type=int, required=True)
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for summary in archived_classes(args.user_id):
+            print(f"{summary['class_id']:>6}  {summary['class_name']} ({summary['semester']})  "
+                  f"{summary['students']} students, {summary['rows']['results']} results, "
+                  f"{summary['bytes']} bytes, archived {summary['archived_at']}")
+        return
+
+    connection = psycopg2.connect(
+        Connect_DB.get_database_url(),
+        cursor_factory=RealDictCursor,
+        sslmode=Connect_DB.get_setting("DB_SSLMODE", "require")
+    )
+    try:
+        if args.command == "archive":
+            print(archive_semester(connection, args.user_id, args.semester))
+        else:
+            print(restore_class(connection, args.user_id, args.class_id))
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Batch detection of students at risk.
+
+Every result is scored against its own exam, using the exam's partial aggregate
+(see stats_accumulators): a z-score from the exam's mean and standard deviation,
+and a percentile from its histogram. Per student, across all their subjects:
+
+    percentile   mean percentile of their results (low: at or below AT_RISK_PERCENTILE)
+    trend        least-squares slope of their z-scores over time, in standard
+                 deviations per 30 days (falling: at or below AT_RISK_TREND)
+    worst_drop   largest fall in z-score into the latest exam of a subject, from the
+                 one before it (sudden drop: at least AT_RISK_DROP)
+
+A student is flagged when any of the three fires. Results are loaded into pandas
+column-wise and scored with NumPy for a whole batch of students at once. Scores
+are written to the at_risk table, one row per student.
+
+Runs are incremental: at_risk_exams remembers the updated_at of each exam's
+partial aggregate when it was last scored, and only students with a result in an
+exam whose aggregate changed since (new or edited marks, a restored class) are
+scored again. Run it as the "at_risk_scan" background job (one teacher) or for
+everyone:
+
+    python at_risk.py [--every 600] [--full]
+"""
+import argparse
+import time
+import psycopg2
+from psycopg2.extras import execute_values
+from db_connection import Connect_DB
+from jobs import register_job
+from live_updates import publish_change
+from shared_cache import invalidate_user
+from stats_accumulators import HISTOGRAM_BINS, HISTOGRAM_MIN, HISTOGRAM_MAX
+
+# Students scored per round of loading results
+SCAN_BATCH_SIZE = 2000
+
+# A trend needs at least this many results to mean anything
+MIN_TREND_RESULTS = 3
+
+CHANGED_EXAMS_QUERY = """
+    SELECT a.exam_id, a.updated_at
+    FROM result_aggregates a
+    LEFT JOIN at_risk_exams x ON x.exam_id = a.exam_id
+    WHERE (%(user_id)s IS NULL OR a.user_id = %(user_id)s)
+      AND (%(full)s OR x.exam_id IS NULL OR x.aggregate_updated_at IS DISTINCT FROM a.updated_at)
+"""
+STUDENT_RESULTS_QUERY = """
+    SELECT r.student_id, s.class_id, c.user_id, r.exam_id, e.subject_id, e.exam_date,
+           r.marks::float / r.total_marks * 100 AS percentage
+    FROM results r
+    JOIN students s ON r.student_id = s.id
+    JOIN classes c ON s.class_id = c.id
+    JOIN exams e ON r.exam_id = e.id
+    WHERE r.student_id = ANY(%s) AND r.total_marks > 0
+"""
+# The partial aggregates of those results' exams, once per exam rather than once per result
+EXAM_AGGREGATES_QUERY = """
+    SELECT exam_id, count, mean, m2, histogram
+    FROM result_aggregates
+    WHERE exam_id IN (SELECT exam_id FROM results WHERE student_id = ANY(%s))
+"""
+
+
+def thresholds():
+    """(percentile, trend, drop) limits from the settings"""
+    return (
+        float(Connect_DB.get_setting("AT_RISK_PERCENTILE", 20)),
+        float(Connect_DB.get_setting("AT_RISK_TREND", -0.25)),
+        float(Connect_DB.get_setting("AT_RISK_DROP", 1.5)),
+    )
+
+
+def score_results(results, exams, limits=None):
+    """
+    Scores a DataFrame with one row per result (STUDENT_RESULTS_QUERY's columns) against
+    its exams' aggregates (EXAM_AGGREGATES_QUERY's rows) and returns one row per student:
+    student_id, user_id, class_id, result_count, percentile, z_score, trend, worst_drop,
+    reasons and flagged.
+    """
+    import numpy as np
+    import pandas as pd
+
+    percentile_limit, trend_limit, drop_limit = limits or thresholds()
+    # Each result's exam, as a row number into the per-exam arrays; results of an exam
+    # without an aggregate yet (not backfilled) can't be placed and wait for the next scan
+    exam_ids = pd.Index([exam['exam_id'] for exam in exams])
+    frame = results[exam_ids.get_indexer(results["exam_id"]) >= 0]
+    frame = frame.sort_values(["student_id", "subject_id", "exam_date", "exam_id"], ignore_index=True)
+    exam_rows = exam_ids.get_indexer(frame["exam_id"])
+    percentage = frame["percentage"].to_numpy(dtype=float)
+    count = np.array([exam['count'] for exam in exams], dtype=float)[exam_rows]
+    mean = np.array([exam['mean'] for exam in exams], dtype=float)[exam_rows]
+    m2 = np.array([exam['m2'] for exam in exams], dtype=float)[exam_rows]
+
+    # Standing within the exam: z-score from its mean and spread...
+    std = np.sqrt(m2 / count)
+    frame["z"] = np.divide(percentage - mean, std, out=np.zeros(len(frame)), where=std > 0)
+
+    # ...and percentile from its histogram: the bins below, plus the filled share of its own bin
+    histograms = np.array([exam['histogram'] for exam in exams], dtype=float).reshape(len(exams), HISTOGRAM_BINS)
+    width = (HISTOGRAM_MAX - HISTOGRAM_MIN) / HISTOGRAM_BINS
+    bins = np.clip(((percentage - HISTOGRAM_MIN) // width).astype(int), 0, HISTOGRAM_BINS - 1)
+    below = (np.cumsum(histograms, axis=1) - histograms)[exam_rows, bins]
+    within = np.clip((percentage - HISTOGRAM_MIN - bins * width) / width, 0.0, 1.0) * histograms[exam_rows, bins]
+    frame["percentile"] = (below + within) / count * 100
+
+    # Least-squares slope of z over time, per student: sum(dx * dz) / sum(dx^2)
+    frame["months"] = pd.to_datetime(frame["exam_date"]).to_numpy().astype("datetime64[D]").astype(float) / 30
+    students = frame.groupby("student_id", sort=False)
+    dx = frame["months"] - students["months"].transform("mean")
+    dz = frame["z"] - students["z"].transform("mean")
+    frame["dxdz"] = dx * dz
+    frame["dx2"] = dx ** 2
+
+    # Fall from the previous exam of the same subject (rows are in date order), counted
+    # only for each subject's latest exam: a drop the student has since recovered from is not news
+    frame["drop"] = -frame.groupby(["student_id", "subject_id"], sort=False)["z"].diff()
+    frame.loc[frame.duplicated(["student_id", "subject_id"], keep="last"), "drop"] = float("nan")
+
+    scores = frame.groupby("student_id").agg(
+        user_id=("user_id", "first"),
+        class_id=("class_id", "first"),
+        result_count=("exam_id", "size"),
+        percentile=("percentile", "mean"),
+        z_score=("z", "mean"),
+        dxdz=("dxdz", "sum"),
+        dx2=("dx2", "sum"),
+        worst_drop=("drop", "max"),
+    ).reset_index()
+    dx2 = scores["dx2"].to_numpy()
+    trend = np.divide(scores["dxdz"].to_numpy(), dx2, out=np.full(len(scores), np.nan), where=dx2 > 0)
+    trend[scores["result_count"].to_numpy() < MIN_TREND_RESULTS] = np.nan
+    scores["trend"] = trend
+    scores["worst_drop"] = scores["worst_drop"].clip(lower=0)
+
+    low = scores["percentile"] <= percentile_limit
+    falling = scores["trend"] <= trend_limit
+    dropped = scores["worst_drop"] >= drop_limit
+    scores["reasons"] = [
+        [reason for reason, fired in (("low percentile", a), ("falling trend", b), ("sudden drop", c)) if fired]
+        for a, b, c in zip(low, falling, dropped)
+    ]
+    scores["flagged"] = low | falling | dropped
+    return scores.drop(columns=["dxdz", "dx2"])
+
+
+def _value(value):
+    """NaN (no trend or drop yet) is stored as NULL"""
+    return None if value != value else float(value)
+
+
+def save_scores(cursor, scores):
+    if scores.empty:
+        return
+    execute_values(cursor, """
+        INSERT INTO at_risk (student_id, user_id, class_id, result_count, percentile, z_score,
+                             trend, worst_drop, reasons, flagged)
+        VALUES %s
+        ON CONFLICT (student_id)
+        DO UPDATE SET user_id = EXCLUDED.user_id, class_id = EXCLUDED.class_id,
+                      result_count = EXCLUDED.result_count, percentile = EXCLUDED.percentile,
+                      z_score = EXCLUDED.z_score, trend = EXCLUDED.trend, worst_drop = EXCLUDED.worst_drop,
+                      reasons = EXCLUDED.reasons, flagged = EXCLUDED.flagged, scored_at = CURRENT_TIMESTAMP
+    """, [
+        (int(row.student_id), int(row.user_id), int(row.class_id), int(row.result_count),
+         _value(row.percentile), _value(row.z_score), _value(row.trend), _value(row.worst_drop),
+         list(row.reasons), bool(row.flagged))
+        for row in scores.itertuples(index=False)
+    ], page_size=1000)
+
+
+def scan(connection, user_id=None, full=False, progress=None):
+    """
+    Scores the students (of one user, or everyone) with results in exams that changed
+    since the last scan, or all of them with full=True, in one transaction. Returns a
+    summary of what was scored.
+    """
+    import pandas as pd
+
+    started = time.perf_counter()
+    limits = thresholds()
+    cursor = connection.cursor()
+    try:
+        cursor.execute(CHANGED_EXAMS_QUERY, {"user_id": user_id, "full": full})
+        exams = cursor.fetchall()
+        student_ids = []
+        if exams:
+            cursor.execute(
+                "SELECT DISTINCT student_id FROM results WHERE exam_id = ANY(%s) ORDER BY student_id",
+                ([exam['exam_id'] for exam in exams],)
+            )
+            student_ids = [row['student_id'] for row in cursor.fetchall()]
+
+        flagged = 0
+        users = set()
+        for start in range(0, len(student_ids), SCAN_BATCH_SIZE):
+            batch = student_ids[start:start + SCAN_BATCH_SIZE]
+            cursor.execute(STUDENT_RESULTS_QUERY, (batch,))
+            results = pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+            if results.empty:
+                continue
+            cursor.execute(EXAM_AGGREGATES_QUERY, (batch,))
+            scores = score_results(results, cursor.fetchall(), limits)
+            save_scores(cursor, scores)
+            flagged += int(scores["flagged"].sum())
+            users.update(int(value) for value in scores["user_id"].unique())
+            if progress:
+                progress(start + len(batch), len(student_ids))
+
+        if exams:
+            execute_values(cursor, """
+                INSERT INTO at_risk_exams (exam_id, aggregate_updated_at) VALUES %s
+                ON CONFLICT (exam_id) DO UPDATE SET aggregate_updated_at = EXCLUDED.aggregate_updated_at
+            """, [(exam['exam_id'], exam['updated_at']) for exam in exams], page_size=1000)
+        for changed_user in users:
+            publish_change(cursor, changed_user, "at_risk")
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    for changed_user in users:
+        invalidate_user(changed_user, "at_risk")
+    return {
+        "exams": len(exams),
+        "students": len(student_ids),
+        "flagged": flagged,
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+@register_job("at_risk_scan")
+def run_at_risk_job(job, connection):
+    """params: optional full (score every student of the user, not only those with new results)"""
+    return scan(
+        connection,
+        user_id=job.user_id,
+        full=bool(job.params.get("full")),
+        progress=lambda done, total: job.report(done / total, f"{done} of {total} students")
+    )
+
+
+def main():
+    from psycopg2.extras import RealDictCursor
+
+    parser = argparse.ArgumentParser(description="Score students and flag those at risk")
+    parser.add_argument("--every", type=float, default=None, help="keep scanning every N seconds")
+    parser.add_argument("--full", action="store_true", help="score every student, not only those with new results")
+    parser.add_argument("--user-id", type=int, default=None, help="only this teacher's students")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        Connect_DB.get_database_url(),
+        cursor_factory=RealDictCursor,
+        sslmode=Connect_DB.get_setting("DB_SSLMODE", "require")
+    )
+    full = args.full
+    try:
+        while True:
+            summary = scan(connection, args.user_id, full=full)
+            print(f"at-risk scan: {summary['students']} students of {summary['exams']} changed exams scored, "
+                  f"{summary['flagged']} flagged in {summary['seconds']}s", flush=True)
+            if args.every is None:
+                break
+            full = False
+            time.sleep(args.every)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
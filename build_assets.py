@@ -0,0 +1,56 @@
+"""
+Builds the self-hosted static assets served from ./static.
+
+    python build_assets.py
+
+Images in assets/icons and assets/img are resized and re-encoded as WebP,
+stylesheets in assets/css are minified, and static/manifest.json records a
+content hash per output so pages can reference versioned, cacheable URLs.
+Run it after changing anything under assets/ and commit the static/ output.
+"""
+import json
+from PIL import Image
+from static_assets import ASSETS_DIR, STATIC_DIR, MANIFEST_PATH, content_hash, minify_css
+
+# (source folder, output folder, max width in px); icons are shown at 80px, so 2x for HiDPI
+IMAGE_TARGETS = [
+    ("icons", "icons", 160),
+    ("img", "img", 960),
+]
+WEBP_QUALITY = 80
+
+
+def optimize_image(source, destination, max_width):
+    with Image.open(source) as image:
+        image = image.convert("RGBA")
+        if image.width > max_width:
+            height = round(image.height * max_width / image.width)
+            image = image.resize((max_width, height), Image.LANCZOS)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        image.save(destination, "WEBP", quality=WEBP_QUALITY, method=6)
+
+
+def build():
+    manifest = {}
+
+    for source_folder, output_folder, max_width in IMAGE_TARGETS:
+        for source in sorted((ASSETS_DIR / source_folder).glob("*.png")):
+            relative = f"{output_folder}/{source.stem}.webp"
+            destination = STATIC_DIR / relative
+            optimize_image(source, destination, max_width)
+            manifest[relative] = content_hash(destination.read_bytes())
+            print(f"{source.relative_to(ASSETS_DIR)}: {source.stat().st_size} -> {destination.stat().st_size} bytes")
+
+    for source in sorted((ASSETS_DIR / "css").glob("*.css")):
+        relative = f"css/{source.stem}.min.css"
+        destination = STATIC_DIR / relative
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        destination.write_text(minify_css(source.read_text()))
+        manifest[relative] = content_hash(destination.read_bytes())
+        print(f"{source.relative_to(ASSETS_DIR)}: {source.stat().st_size} -> {destination.stat().st_size} bytes")
+
+    MANIFEST_PATH.write_text(json.dumps(manifest, indent=2, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    build()
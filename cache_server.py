@@ -0,0 +1,140 @@
+"""
+Local key-value cache server for CACHE_BACKEND = "socket".
+
+    python cache_server.py [--socket PATH] [--max-bytes 268435456]
+
+A stand-in for a networked cache (Redis, memcached) that needs nothing but the
+standard library, so the shared cache tier can be exercised with several app
+processes on one machine. Entries expire after their TTL and the least recently
+used ones are evicted past --max-bytes. See SocketBackend in shared_cache.py for
+the protocol.
+
+The socket lives in a directory only its owner can enter (0700), by default
+laytics/ under XDG_RUNTIME_DIR or ~/.cache, so other local users can't connect.
+"""
+import argparse
+import os
+import signal
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+
+
+def default_socket_path():
+    base = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "laytics", "cache.sock")
+
+
+def private_directory(path):
+    """Creates the socket's directory as 0700, or refuses one another user owns or can enter"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid():
+        raise SystemExit(f"{directory} belongs to another user; choose a socket path in a directory of your own")
+    if info.st_mode & 0o077:
+        os.chmod(directory, 0o700)
+    return directory
+
+
+class CacheStore:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self.size += len(value)
+            while self.size > self.max_bytes and self._entries:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+class CacheHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        store = self.server.store
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode().split()
+            if not parts:
+                continue
+            command = parts[0]
+            if command == "GET" and len(parts) == 2:
+                value = store.get(parts[1])
+                self.wfile.write(b"MISS\n" if value is None else f"HIT {len(value)}\n".encode() + value)
+            elif command == "SET" and len(parts) == 4:
+                value = self.rfile.read(int(parts[3]))
+                store.set(parts[1], value, float(parts[2]))
+                self.wfile.write(b"OK\n")
+            elif command == "DEL" and len(parts) == 2:
+                store.delete(parts[1])
+                self.wfile.write(b"OK\n")
+            else:
+                self.wfile.write(b"ERROR\n")
+                return
+            self.wfile.flush()
+
+
+class CacheServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, max_bytes):
+        self.store = CacheStore(max_bytes)
+        super().__init__(path, CacheHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the local shared-cache server")
+    parser.add_argument("--socket", default=default_socket_path())
+    parser.add_argument("--max-bytes", type=int, default=256 * 1024 * 1024)
+    args = parser.parse_args()
+
+    private_directory(args.socket)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    # The socket itself is created 0600 as well
+    os.umask(0o077)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    with CacheServer(args.socket, args.max_bytes) as server:
+        print(f"cache server listening on {args.socket}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
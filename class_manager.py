@@ -1,8 +1,103 @@
 import streamlit as st
+import psycopg2
+import csv
+import io
+import os
+import time
+from contextlib import contextmanager
+from datetime import date
+from psycopg2.pool import PoolError
 from db_connection import Connect_DB
 from dashboard import Dashboard
-import plotly.express as px
-import pandas as pd
+from grading import calculate_grade
+from exports import render_export_controls, file_reader
+from jobs import JobQueue, ACTIVE_STATUSES, job_summary
+from repositories import ClassRepo, StudentRepo, ExamRepo, ResultRepo, RankingRepo
+from shared_cache import get_shared_cache, roster_key, invalidate_user
+from live_updates import publish_change
+from session_memory import Roster, remember, recall, forget, memory_report, session_state_sizes
+from metrics import histogram
+from figure_cache import cached_figure
+from marks_autosave import (
+    AUTOSAVE_CHECK_SECONDS, DRAFT_KEY, MARKS_COLUMN, apply_edits, get_draft, load_draft, mark_dirty, publish_marks,
+    write_marks
+)
+
+# Seconds between refreshes of the Background Jobs list
+JOB_POLL_SECONDS = 3
+
+PAGE_SECONDS = histogram(
+    "laytics_page_render_seconds", "Time to render a page, by outcome (ok, degraded, error)", ("page", "outcome")
+)
+
+
+@contextmanager
+def pooled_cursor(pool):
+    """A cursor on a connection borrowed for one step of a page, not for its whole render"""
+    with Connect_DB.pooled_connection(pool) as connection:
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+
+def individual_performance_figure(students, percentages):
+    import plotly.express as px
+    fig = px.bar(
+        x=students,
+        y=percentages,
+        title="Individual Student Performance",
+        labels={'x': 'Student', 'y': 'Percentage'},
+        color=percentages,
+        color_continuous_scale="Viridis"
+    )
+    fig.update_layout(
+        template="plotly_dark",
+        title_x=0.5,
+        xaxis_tickangle=-45,
+        height=400
+    )
+    return fig
+
+
+def grade_distribution_figure(grades, counts):
+    import plotly.express as px
+    fig = px.pie(
+        values=counts,
+        names=grades,
+        title="Grade Distribution",
+        hole=0.4,
+        color_discrete_sequence=px.colors.qualitative.Pastel
+    )
+    fig.update_layout(
+        template="plotly_dark",
+        title_x=0.5,
+        height=400
+    )
+    return fig
+
+
+def class_statistics_figure(subject_name, percentages):
+    import plotly.express as px
+    fig = px.line(
+        x=list(range(1, len(percentages) + 1)),
+        y=percentages,
+        title=f"Performance Trend for {subject_name}",
+        labels={'x': 'Student Rank', 'y': 'Percentage'},
+        markers=True
+    )
+    fig.update_traces(
+        line=dict(width=3),
+        marker=dict(size=8)
+    )
+    fig.update_layout(
+        template="plotly_dark",
+        title_x=0.5,
+        height=400
+    )
+    return fig
+
 
 class ClassManager:
     def __init__(self):
@@ -20,20 +115,24 @@ class ClassManager:
 
         # Add Logout button at top of sidebar
         if st.sidebar.button("Logout"):
-            # Clear all session state variables
+            # Clear all session state variables and anything remembered for this session
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
+            forget()
             st.session_state.is_logged_in = False
             st.session_state.current_tab = "login"  # So login tab shows
             st.success("You have been logged out.")
             st.rerun()
 
+        if str(Connect_DB.get_setting("SHOW_SESSION_MEMORY", "false")).lower() in ("1", "true", "yes", "on"):
+            self.display_session_memory()
+
 
         # Sidebar navigation
         # Remember the last selected page
 
         
-        valid_tabs = ["Home Dashboard", "Add New Class", "Results & Class Management"]
+        valid_tabs = ["Home Dashboard", "Add New Class", "Results & Class Management", "Background Jobs"]
         if "current_tab" not in st.session_state or st.session_state.current_tab not in valid_tabs:
             st.session_state.current_tab = "Home Dashboard"  # Reset to valid default
 
@@ -44,23 +143,52 @@ class ClassManager:
         st.session_state.current_tab = options
 
         
-        if options == "Home Dashboard":
-            self.dashboard.display_dashboard()
-        elif options == "Add New Class":
-            self.display_add_class()
-        elif options == "Results & Class Management":
-            self.display_results_management()
+        pages = {
+            "Home Dashboard": ("dashboard", self.dashboard.display_dashboard),
+            "Add New Class": ("add_class", self.display_add_class),
+            "Results & Class Management": ("results", self.display_results_management),
+            "Background Jobs": ("jobs", self.display_jobs),
+        }
+        budget, display = pages[options]
+        Connect_DB.use_budget(budget)
+        # st.rerun() and st.stop() raise BaseExceptions; those runs still count as ok
+        started, outcome = time.perf_counter(), "ok"
+        try:
+            display()
+        except psycopg2.OperationalError as e:
+            # Blown budgets, lost connections and the open circuit breaker end up here
+            outcome = "degraded"
+            Connect_DB.show_degraded(e)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            PAGE_SECONDS.observe(time.perf_counter() - started, page=budget, outcome=outcome)
     
+    def display_session_memory(self):
+        """Sidebar breakdown of this session's memory and the process-wide totals"""
+        with st.sidebar.expander("Session Memory"):
+            sizes = session_state_sizes()
+            st.metric("This session (state)", f"{sum(sizes.values()) / 1024:.1f} KiB")
+            for key, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:5]:
+                st.caption(f"{key}: {size / 1024:.1f} KiB")
+
+            report = memory_report()
+            st.caption(f"Sessions in this process: {len(report['sessions'])}")
+            st.caption(f"Remembered objects: {report['store_bytes'] / 1024:.1f} KiB "
+                       f"({report['store_evictions']} evictions)")
+
     def display_add_class(self):
         st.subheader("Create Class & add Students")
         
         # Initialize session state for students list if not already done
+        # (rows are (roll_no, name) tuples, much smaller than a dict per row)
         if "students" not in st.session_state:
-            st.session_state.students = [{"roll_no": "", "name": ""}]
+            st.session_state.students = [("", "")]
 
         # Function to add a new row of student inputs
         def add_student_row():
-            st.session_state.students.append({"roll_no": "", "name": ""})
+            st.session_state.students.append(("", ""))
 
         # Function to create a class and insert data into the database
         def create_class(class_name, semester, students):
@@ -68,7 +196,7 @@ class ClassManager:
                 st.error("Please provide both the class name and semester.")
                 return
 
-            if not any(student["roll_no"] and student["name"] for student in students):
+            if not any(roll_no and name for roll_no, name in students):
                 st.error("Add at least one student with a valid roll number and name.")
                 return
 
@@ -81,25 +209,22 @@ class ClassManager:
                 cursor = connection.cursor()
                 
                 # Insert class
-                cursor.execute(
-                    "INSERT INTO classes (class_name, semester, total_students, user_id) VALUES (%s, %s, %s, %s) RETURNING id",
-                    (class_name, semester, len([s for s in students if s["roll_no"] and s["name"]]), st.session_state.user_id)
+                class_id = ClassRepo(cursor).create(
+                    class_name, semester, len([roll_no for roll_no, name in students if roll_no and name]), st.session_state.user_id
                 )
 
-                class_id = cursor.fetchone()['id']
-
                 # Insert students
-                for student in students:
-                    if student["roll_no"] and student["name"]:
-                        cursor.execute(
-                            "INSERT INTO students (class_id, roll_no, name, user_id) VALUES (%s, %s, %s, %s)",
-                            (class_id, student["roll_no"], student["name"], st.session_state.user_id)
-                        )
+                student_repo = StudentRepo(cursor)
+                for roll_no, name in students:
+                    if roll_no and name:
+                        student_repo.add(class_id, roll_no, name, st.session_state.user_id)
+                publish_change(cursor, st.session_state.user_id, "classes", class_id=class_id)
                 connection.commit()
                 cursor.close()
                 connection.close()
+                invalidate_user(st.session_state.user_id, "classes")
                 st.success("Class created successfully!")
-                st.session_state.students = [{"roll_no": "", "name": ""}]  # Reset form
+                st.session_state.students = [("", "")]  # Reset form
             except Exception as e:
                 st.error(f"An error occurred: {e}")
 
@@ -116,13 +241,13 @@ class ClassManager:
         students = []
 
         # Display existing rows of students and create input fields
-        for i, student in enumerate(st.session_state.students):
+        for i, (roll_no, name) in enumerate(st.session_state.students):
             cols = st.columns(2)
             with cols[0]:
-                roll_no = st.text_input(f"Roll No {i + 1}", value=student["roll_no"], key=f"roll_no_{i}")
+                roll_no = st.text_input(f"Roll No {i + 1}", value=roll_no, key=f"roll_no_{i}")
             with cols[1]:
-                name = st.text_input(f"Name {i + 1}", value=student["name"], key=f"name_{i}")
-            students.append({"roll_no": roll_no, "name": name})
+                name = st.text_input(f"Name {i + 1}", value=name, key=f"name_{i}")
+            students.append((roll_no, name))
 
         # Update the session state with the latest student data
         st.session_state.students = students
@@ -136,6 +261,123 @@ class ClassManager:
         if st.button("Save Class"):
             create_class(class_name, semester, students)
 
+        st.markdown("---")
+        self.display_bulk_import(class_name, semester)
+
+    def display_bulk_import(self, class_name, semester):
+        """Queue a background job that creates the class from an uploaded roster"""
+        with st.expander("Bulk Import Students from CSV"):
+            st.write("Upload a CSV with `roll_no` and `name` columns. The class is created in the background.")
+            roster = st.file_uploader("Roster CSV", type=["csv"], key="roster_upload")
+
+            if st.button("Import in Background", disabled=roster is None):
+                if not class_name or not semester:
+                    st.error("Please provide both the class name and semester.")
+                    return
+
+                reader = csv.DictReader(io.TextIOWrapper(roster, encoding="utf-8-sig"))
+                if not reader.fieldnames or not {"roll_no", "name"} <= set(reader.fieldnames):
+                    st.error("The CSV needs `roll_no` and `name` columns.")
+                    return
+                students = [[row["roll_no"], row["name"]] for row in reader if row["roll_no"] and row["name"]]
+                if not students:
+                    st.error("The CSV has no students with a roll number and name.")
+                    return
+
+                connection = Connect_DB.get_connection()
+                if not connection:
+                    st.error("Database connection failed.")
+                    return
+                try:
+                    cursor = connection.cursor()
+                    job_id = JobQueue.submit(cursor, st.session_state.user_id, "import_class", {
+                        "class_name": class_name,
+                        "semester": semester,
+                        "students": students,
+                    })
+                    connection.commit()
+                    st.success(f"Import job #{job_id} queued for {len(students)} students. Follow it on Background Jobs.")
+                except Exception as e:
+                    st.error(f"An error occurred: {e}")
+                finally:
+                    connection.close()
+
+    def display_jobs(self):
+        st.subheader("Background Jobs")
+        st.write("Imports, exports and reports run on the job workers, so the page stays responsive while they finish.")
+        if st.button("Generate Report Cards for All Classes"):
+            self.submit_report_cards(None)
+        self.display_job_list()
+
+    def submit_report_cards(self, class_ids):
+        """Queue a report_cards job for the given classes (None means every class)"""
+        params = {"class_ids": class_ids} if class_ids else {}
+        self.submit_job("report_cards", params, "Report card job #{job_id} queued. Download the PDFs from Background Jobs.")
+
+    def submit_job(self, kind, params, success_message):
+        """Queue a background job; success_message may refer to {job_id}"""
+        connection = Connect_DB.get_connection()
+        if not connection:
+            st.error("Database connection failed.")
+            return
+        try:
+            cursor = connection.cursor()
+            job_id = JobQueue.submit(cursor, st.session_state.user_id, kind, params)
+            connection.commit()
+            st.success(success_message.format(job_id=job_id))
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
+        finally:
+            connection.close()
+
+    @st.fragment(run_every=JOB_POLL_SECONDS)
+    def display_job_list(self):
+        """Job table that re-polls its own rows without rerunning the rest of the page"""
+        connection = Connect_DB.get_connection()
+        if not connection:
+            st.error("Database connection failed.")
+            return
+
+        try:
+            cursor = connection.cursor()
+            jobs = JobQueue.list_for_user(cursor, st.session_state.user_id)
+
+            if not jobs:
+                st.info("No background jobs yet.")
+                return
+
+            for job in jobs:
+                col1, col2, col3 = st.columns([3, 3, 1])
+                with col1:
+                    st.write(f"**#{job['id']}** {job_summary(job)}")
+                    st.caption(f"{job['status'].capitalize()} · queued {job['created_at']:%Y-%m-%d %H:%M}"
+                               + (f" · attempt {job['attempts']}/{job['max_attempts']}" if job['attempts'] else ""))
+                with col2:
+                    st.progress(float(job['progress']), text=job['message'] or "")
+                with col3:
+                    if job['status'] in ACTIVE_STATUSES:
+                        if st.button("Cancel", key=f"job_cancel_{job['id']}", disabled=job['cancel_requested']):
+                            JobQueue.cancel(cursor, st.session_state.user_id, job['id'])
+                            connection.commit()
+                            st.rerun(scope="fragment")
+                    elif job['status'] in ("failed", "cancelled"):
+                        if st.button("Retry", key=f"job_retry_{job['id']}"):
+                            JobQueue.retry(cursor, st.session_state.user_id, job['id'])
+                            connection.commit()
+                            st.rerun(scope="fragment")
+                    elif job['result'] and job['result'].get("path") and os.path.exists(job['result']["path"]):
+                        st.download_button(
+                            "Download",
+                            data=file_reader(job['result']["path"]),
+                            file_name=job['result']["file_name"],
+                            mime=job['result'].get("mime"),
+                            key=f"job_download_{job['id']}"
+                        )
+        except psycopg2.OperationalError as e:
+            Connect_DB.show_degraded(e)
+        finally:
+            connection.close()
+
     def display_results_management(self):
         # st.subheader("Generate Results for your Class")
         # st.write("View available classes, manage their details, and generate results for any subject.")
@@ -159,19 +401,18 @@ class ClassManager:
             # Main Page: Display existing classes
             st.markdown("---")
 
-            connection = Connect_DB.get_connection()
-            if not connection:
+            pool = Connect_DB.get_pool(readonly=True)
+            if not pool:
                 st.error("Database connection failed.")
                 return
-                
-            cursor = connection.cursor()
-            cursor.execute(
-                "SELECT id, class_name, semester, total_students FROM classes WHERE user_id = %s",
-                (st.session_state.user_id,)
-            )
-            classes = cursor.fetchall()
-            cursor.close()
-            connection.close()
+
+            # Pooled so the prepared catalog query is reused across reruns
+            try:
+                with pooled_cursor(pool) as cursor:
+                    classes = ClassRepo(cursor).list_for_user(st.session_state.user_id)
+            except (psycopg2.Error, PoolError) as e:
+                Connect_DB.show_degraded(e)
+                return
 
             if not classes:
                 st.info("No classes available.")
@@ -187,13 +428,17 @@ class ClassManager:
                             class_name = cls["class_name"]
                             semester = cls["semester"]
                             total_students = cls["total_students"]
+                            # Archived classes are greyed out; their page offers export and restore
+                            border, title = ("#888888", "#BBBBBB") if cls["archived_at"] else ("#4CAF50", "#00FF00")
+                            archived_note = "<p><em>Archived</em></p>" if cls["archived_at"] else ""
 
                             st.markdown(
                                 f"""
-                                <div style="text-align: center; padding: 20px; margin: 10px; border: 2px solid #4CAF50; border-radius: 10px; background-color: #333333; color: white;">
-                                    <h3 style="color: #00FF00;">{class_name}</h3>
+                                <div style="text-align: center; padding: 20px; margin: 10px; border: 2px solid {border}; border-radius: 10px; background-color: #333333; color: white;">
+                                    <h3 style="color: {title};">{class_name}</h3>
                                     <p><strong>Semester:</strong> {semester}</p>
                                     <p><strong>Total Students:</strong> {total_students}</p>
+                                    {archived_note}
                                 </div>
                                 """,
                                 unsafe_allow_html=True
@@ -207,91 +452,184 @@ class ClassManager:
                             ):
                                 st.session_state.selected_class = class_id
                                 st.rerun()
+
+                self.display_semester_archive(classes)
         else:
             # Class-Specific Page: Show details and generate result form
             self.display_class_results()
 
-    def display_class_results(self):
-        selected_class_id = st.session_state.selected_class
+    def display_semester_archive(self, classes):
+        """Move a closed semester's students and results out of the live tables"""
+        semesters = sorted({cls["semester"] for cls in classes if not cls["archived_at"]})
+        if not semesters:
+            return
+        st.markdown("---")
+        with st.expander("Archive a Semester"):
+            st.write(
+                "Archiving moves a semester's students and results to compressed files. "
+                "They still count on the dashboard and in exports, but can't be edited until restored."
+            )
+            semester = st.selectbox("Semester", semesters, key="archive_semester")
+            confirmed = st.checkbox(f"Semester {semester} is closed", key="archive_confirm")
+            if st.button("Archive in Background", key="archive_button", disabled=not confirmed):
+                self.submit_job(
+                    "archive_semester",
+                    {"semester": semester},
+                    "Archive job #{job_id} queued. Follow it on the Background Jobs page."
+                )
 
-        connection = Connect_DB.get_connection()
-        if not connection:
+    def display_archived_class(self, cls):
+        """An archived class can be exported as is, or restored to edit its results"""
+        st.info(f"This class was archived on {cls['archived_at']:%Y-%m-%d}. Restore it to enter or change results.")
+        if st.button("Restore in Background", key="restore_class"):
+            self.submit_job(
+                "restore_class",
+                {"class_id": cls['id']},
+                "Restore job #{job_id} queued. Follow it on the Background Jobs page."
+            )
+        st.markdown("---")
+        with st.expander("Export Results"):
+            render_export_controls(
+                f"class_{cls['id']}",
+                f"{cls['class_name']}_{cls['semester']}",
+                st.session_state.user_id,
+                class_id=cls['id']
+            )
+
+    def display_class_results(self):
+        pool = Connect_DB.get_pool()
+        if not pool:
             st.error("Database connection failed.")
             return
-            
-        cursor = connection.cursor()
-        cursor.execute("SELECT * FROM classes WHERE id = %s AND user_id = %s", 
-               (selected_class_id, st.session_state.user_id))
-        cls = cursor.fetchone()
+
+        try:
+            self.display_class_results_form(pool)
+        except (psycopg2.Error, PoolError) as e:
+            Connect_DB.show_degraded(e)
+
+    def display_class_results_form(self, pool):
+        """Each step borrows a pooled connection only for its own queries"""
+        import pandas as pd
+        selected_class_id = st.session_state.selected_class
+
+        with pooled_cursor(pool) as cursor:
+            cls = ClassRepo(cursor).get(selected_class_id, st.session_state.user_id)
+            subjects = [] if cls['archived_at'] else ExamRepo(cursor).subjects_for_class(
+                selected_class_id, st.session_state.user_id
+            )
 
         st.markdown("---")
         st.title(f"Class: {cls['class_name']} - Semester {cls['semester']}")
         st.write(f"Total Students: {cls['total_students']}")
         st.markdown("---")
+        if cls['archived_at']:
+            self.display_archived_class(cls)
+            return
         st.subheader("Subject Result")
         
-        subject_name = st.text_input("Subject Name")
-        total_marks = st.number_input("Total Marks", min_value=0, step=1)
-
-        # Fetch students for the selected class
-        cursor.execute("SELECT id, roll_no, name FROM students WHERE class_id = %s AND user_id = %s",
-               (selected_class_id, st.session_state.user_id))
-        students = cursor.fetchall()
+        # Existing subjects are listed so marks go to the same subject instead of a new spelling
+        subject_name = st.text_input(
+            "Subject Name",
+            key="result_subject",
+            help="Case and spacing are ignored, so \"math \" is the same subject as \"Math\""
+        ).strip()
+        if subjects:
+            st.caption("Subjects of this class: " + ", ".join(subject['name'] for subject in subjects))
+        exam_name = st.text_input("Exam Name (optional)", key="result_exam_name",
+                                  placeholder="e.g. Midterm").strip()
+
+        # Fetch students for the selected class; the compact roster is kept in the bounded
+        # session store so each mark entry (a rerun) doesn't refetch the whole class
+        # (and in the shared cache, so other replicas can skip the query too)
+        session_key = f"roster_{selected_class_id}"
+        students = recall(session_key)
+        if students is None:
+            def load_roster():
+                with pooled_cursor(pool) as cursor:
+                    return Roster(StudentRepo(cursor).list_for_class(selected_class_id, st.session_state.user_id))
+
+            students = remember(session_key, get_shared_cache().get_or_compute(
+                roster_key(st.session_state.user_id, selected_class_id), load_roster
+            ))
+
+        # Marks are autosaved per exam; write what the previous one still has pending before switching
+        draft = get_draft()
+        exam = (selected_class_id, subject_name, exam_name, date.today())
+        if draft is not None and draft.exam != exam:
+            with Connect_DB.pooled_connection(pool) as connection:
+                if self.save_marks(connection, draft, draft.changes()):
+                    self.publish_draft(connection, draft)
+            del st.session_state[DRAFT_KEY]
+        if subject_name and students:
+            with pooled_cursor(pool) as cursor:
+                saved_total = load_draft(cursor, st.session_state.user_id, *exam, students)
+            if saved_total:
+                st.session_state.result_total_marks = saved_total
+
+        total_marks = st.number_input("Total Marks", min_value=0, step=1, key="result_total_marks", on_change=mark_dirty)
+        draft = get_draft()
+        if draft is not None:
+            draft.total_marks = total_marks
 
         if not students:
             st.warning("No students found for this class.")
         else:
-            st.write("Enter Marks for each student:")
-            results = []
-            all_marks_entered = True
+            ready = draft is not None and total_marks > 0
+            if ready:
+                st.write("Enter Marks for each student:")
+            else:
+                st.info("Enter the subject name and total marks to start entering marks.")
+            # One editor for the whole class: its state keeps only the edited rows, and the
+            # marks themselves live in the draft
+            entered = draft.marks if draft is not None else {}
+            student_ids = [student_id for student_id, _, _ in students]
+            st.data_editor(
+                pd.DataFrame({
+                    "Roll No": [roll_no for _, roll_no, _ in students],
+                    "Name": [name for _, _, name in students],
+                    MARKS_COLUMN: [entered.get(student_id, 0) for student_id in student_ids],
+                }),
+                column_config={
+                    MARKS_COLUMN: st.column_config.NumberColumn(
+                        min_value=0, max_value=total_marks if total_marks > 0 else 100, step=1, required=True
+                    ),
+                },
+                disabled=["Roll No", "Name"] if ready else True,
+                hide_index=True,
+                use_container_width=True,
+                key=draft.editor_key if draft is not None else "marks_editor",
+                on_change=apply_edits,
+                args=(student_ids,)
+            )
+            results = [(student_id, entered.get(student_id, 0)) for student_id in student_ids]
 
-            for student in students:
-                col1, col2, col3 = st.columns([1, 2, 2])
-                with col1:
-                    st.write(student["roll_no"])
-                with col2:
-                    st.write(student["name"])
-                with col3:
-                    marks = st.number_input(
-                        f"Marks for {student['roll_no']}",
-                        min_value=0,
-                        max_value=total_marks if total_marks > 0 else 100,
-                        key=f"marks_{student['roll_no']}"
-                    )
-                    results.append({
-                        "student_id": student["id"],
-                        "marks": marks
-                    })
+            self.display_autosave_status()
 
             if st.button("Generate Result"):
-                if subject_name and len(subject_name.strip()) > 0 and total_marks > 0:
-                    try:
-                        from datetime import date
-                        today = date.today()
-                        
-                        for result in results:
-                            cursor.execute(
-                                """INSERT INTO results (student_id, subject, marks, total_marks, exam_date) 
-                                   VALUES (%s, %s, %s, %s, %s)
-                                   ON CONFLICT (student_id, subject, exam_date) 
-                                   DO UPDATE SET marks = EXCLUDED.marks, total_marks = EXCLUDED.total_marks""",
-                                (result["student_id"], subject_name, result["marks"], total_marks, today)
-                            )
-                        
-                        connection.commit()
+                if ready:
+                    # Autosave has written most rows already; only what differs (including
+                    # students never saved) is written now
+                    with Connect_DB.pooled_connection(pool) as connection:
+                        saved = (
+                            self.save_marks(connection, draft, draft.changes([student_id for student_id, _ in results]))
+                            and self.publish_draft(connection, draft)
+                        )
+                    if not saved:
+                        st.error(f"Error saving results: {draft.error}")
+                    else:
                         st.success("Results saved successfully!")
                         
                         # Display results summary
                         st.markdown("---")
                         st.subheader("Results Summary")
                         summary_data = []
-                        for i, student in enumerate(students):
-                            percentage = (results[i]["marks"] / total_marks) * 100 if total_marks > 0 else 0
+                        for (_, roll_no, name), (_, marks) in zip(students, results):
+                            percentage = (marks / total_marks) * 100 if total_marks > 0 else 0
                             grade = self.calculate_grade(percentage)
                             summary_data.append({
-                                "Roll No": student["roll_no"],
-                                "Name": student["name"],
-                                "Marks": f"{results[i]['marks']}/{total_marks}",
+                                "Roll No": roll_no,
+                                "Name": name,
+                                "Marks": f"{marks}/{total_marks}",
                                 "Percentage": f"{percentage:.1f}%",
                                 "Grade": grade
                             })
@@ -315,29 +653,154 @@ class ClassManager:
                         with chart_tab3:
                             self.create_class_statistics_chart(summary_data, subject_name)
                         
-                    except Exception as e:
-                        st.error(f"Error saving results: {e}")
                 else:
                     st.error("Please provide subject name and total marks.")
 
-        cursor.close()
-        connection.close()
+        self.display_class_rankings(pool, cls)
+        self.display_class_export(pool, cls)
 
-    def calculate_grade(self, percentage):
-        if percentage >= 90:
-            return "A+"
-        elif percentage >= 80:
-            return "A"
-        elif percentage >= 70:
-            return "B+"
-        elif percentage >= 60:
-            return "B"
-        elif percentage >= 50:
-            return "C+"
-        elif percentage >= 40:
-            return "C"
+    def save_marks(self, connection, draft, changes):
+        """Writes changed marks of the draft's exam; on failure they stay pending and False is returned"""
+        started = time.monotonic()
+        if changes:
+            cursor = connection.cursor()
+            try:
+                exam_id = write_marks(cursor, st.session_state.user_id, draft, changes)
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                draft.error = str(e)
+                # Retry after another debounce interval rather than on every check
+                draft.touch()
+                return False
+            finally:
+                cursor.close()
+            draft.mark_saved(changes, started, exam_id)
+        else:
+            draft.mark_saved(changes, started, draft.exam_id)
+        return True
+
+    def publish_draft(self, connection, draft):
+        """Brings the exam's aggregates, rankings and cube up to its written marks; False on failure"""
+        if not draft.unpublished:
+            return True
+        cursor = connection.cursor()
+        try:
+            students = publish_marks(cursor, st.session_state.user_id, draft)
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            draft.error = str(e)
+            draft.touch()
+            return False
+        finally:
+            cursor.close()
+        draft.unpublished -= students
+        invalidate_user(st.session_state.user_id, "results")
+        return True
+
+    @st.fragment(run_every=AUTOSAVE_CHECK_SECONDS)
+    def display_autosave_status(self):
+        """Writes pending marks once typing pauses and shows whether everything is saved"""
+        draft = get_draft()
+        if draft is None or draft.total_marks <= 0:
+            return
+        changes = draft.changes()
+        if (changes and draft.due()) or draft.publish_due():
+            pool = Connect_DB.get_pool()
+            if pool:
+                try:
+                    with Connect_DB.pooled_connection(pool) as connection:
+                        # Rows on every pause; aggregates only after a longer one
+                        if self.save_marks(connection, draft, changes) and draft.publish_due():
+                            self.publish_draft(connection, draft)
+                except (psycopg2.Error, PoolError) as e:
+                    # No connection (breaker open, pool exhausted): keep the marks pending
+                    draft.error = str(e)
+                    draft.touch()
+            changes = draft.changes()
+
+        if draft.error:
+            st.warning(f"Autosave failed, retrying: {draft.error}")
+        elif changes:
+            st.caption(f"● {len(changes)} unsaved change(s)")
+        elif draft.saved_at:
+            st.caption(f"✓ All changes saved at {draft.saved_at}")
         else:
-            return "F"
+            st.caption("Marks are saved automatically as you type.")
+
+    def display_class_rankings(self, pool, cls):
+        """Leaderboard across every subject, read from the rankings kept up to date on each save"""
+        import pandas as pd
+        st.markdown("---")
+        with st.expander("Class Rankings"):
+            sizes = {"Top 10": 10, "Top 25": 25, "Top 50": 50, "Everyone": None}
+            size = st.selectbox("Show", list(sizes), key="ranking_size")
+            with pooled_cursor(pool) as cursor:
+                rankings = RankingRepo(cursor).top_for_class(cls['id'], st.session_state.user_id, sizes[size])
+            if not rankings:
+                st.info("No saved results to rank yet.")
+                return
+
+            def change(row):
+                if row['previous_rank'] is None:
+                    return "new"
+                moved = row['previous_rank'] - row['rank']
+                return f"▲{moved}" if moved > 0 else f"▼{-moved}" if moved < 0 else "–"
+
+            st.dataframe(pd.DataFrame([{
+                "Rank": row['rank'],
+                "Change": change(row),
+                "Roll No": row['roll_no'],
+                "Name": row['name'],
+                "Overall %": f"{row['percentage']:.1f}%",
+                "Exams": row['exam_count'],
+            } for row in rankings]), use_container_width=True, hide_index=True)
+            st.caption(
+                "Every exam counts in proportion to its total marks. "
+                "Change is measured against the ranking before the latest exam."
+            )
+
+    def display_class_export(self, pool, cls):
+        """Export saved results for the whole class or for one subject/exam"""
+        st.markdown("---")
+        with st.expander("Export Results"):
+            with pooled_cursor(pool) as cursor:
+                exams = ResultRepo(cursor).exams_for_class(cls['id'], st.session_state.user_id)
+
+            if not exams:
+                st.info("No saved results to export yet.")
+                return
+
+            if st.button("Generate Report Cards in Background", key="report_cards_class",
+                         help="One PDF per student, packaged as a zip for this class"):
+                self.submit_report_cards([cls['id']])
+
+            options = ["All subjects and exams"] + [
+                f"{exam['subject']}{' · ' + exam['name'] if exam['name'] else ''} ({exam['exam_date']})"
+                for exam in exams
+            ]
+            choice = st.selectbox("Results to export", options, key="export_scope")
+
+            if choice == options[0]:
+                render_export_controls(
+                    f"class_{cls['id']}",
+                    f"{cls['class_name']}_{cls['semester']}",
+                    st.session_state.user_id,
+                    class_id=cls['id']
+                )
+            else:
+                exam = exams[options.index(choice) - 1]
+                render_export_controls(
+                    f"class_{cls['id']}_exam_{exam['id']}",
+                    "_".join(str(part) for part in (cls['class_name'], exam['subject'], exam['name'], exam['exam_date']) if part),
+                    st.session_state.user_id,
+                    class_id=cls['id'],
+                    exam_id=exam['id']
+                )
+
+    def calculate_grade(self, percentage):
+        return calculate_grade(percentage)
     
     def create_individual_performance_chart(self, summary_data):
         """Create a bar chart showing individual student performance"""
@@ -348,22 +811,7 @@ class ClassManager:
         students = [data["Name"] for data in summary_data]
         percentages = [float(data["Percentage"].replace('%', '')) for data in summary_data]
         
-        fig = px.bar(
-            x=students,
-            y=percentages,
-            title="Individual Student Performance",
-            labels={'x': 'Student', 'y': 'Percentage'},
-            color=percentages,
-            color_continuous_scale="Viridis"
-        )
-        
-        fig.update_layout(
-            template="plotly_dark",
-            title_x=0.5,
-            xaxis_tickangle=-45,
-            height=400
-        )
-        
+        fig = cached_figure(individual_performance_figure, students=students, percentages=percentages)
         st.plotly_chart(fig, use_container_width=True)
     
     def create_grade_distribution_chart(self, summary_data):
@@ -378,20 +826,9 @@ class ClassManager:
         for grade in grades:
             grade_counts[grade] = grade_counts.get(grade, 0) + 1
         
-        fig = px.pie(
-            values=list(grade_counts.values()),
-            names=list(grade_counts.keys()),
-            title="Grade Distribution",
-            hole=0.4,
-            color_discrete_sequence=px.colors.qualitative.Pastel
-        )
-        
-        fig.update_layout(
-            template="plotly_dark",
-            title_x=0.5,
-            height=400
+        fig = cached_figure(
+            grade_distribution_figure, grades=list(grade_counts.keys()), counts=list(grade_counts.values())
         )
-        
         st.plotly_chart(fig, use_container_width=True)
     
     def create_class_statistics_chart(self, summary_data, subject_name):
@@ -420,25 +857,5 @@ class ClassManager:
         
         # Create a trend line showing performance distribution
         sorted_percentages = sorted(percentages, reverse=True)
-        student_ranks = list(range(1, len(sorted_percentages) + 1))
-        
-        fig = px.line(
-            x=student_ranks,
-            y=sorted_percentages,
-            title=f"Performance Trend for {subject_name}",
-            labels={'x': 'Student Rank', 'y': 'Percentage'},
-            markers=True
-        )
-        
-        fig.update_traces(
-            line=dict(width=3),
-            marker=dict(size=8)
-        )
-        
-        fig.update_layout(
-            template="plotly_dark",
-            title_x=0.5,
-            height=400
-        )
-        
+        fig = cached_figure(class_statistics_figure, subject_name=subject_name, percentages=sorted_percentages)
         st.plotly_chart(fig, use_container_width=True)
@@ -16,6 +16,9 @@ CREATE TABLE IF NOT EXISTS classes (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Archived classes keep their row; their students and results live in archive/ (see archive.py)
+ALTER TABLE classes ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP;
+
 -- Create students table
 CREATE TABLE IF NOT EXISTS students (
     id SERIAL PRIMARY KEY,
@@ -26,18 +29,50 @@ CREATE TABLE IF NOT EXISTS students (
     UNIQUE(class_id, roll_no),
     FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE
 );
+-- Enrollment trends read created_at ranges of these append-mostly tables
+CREATE INDEX IF NOT EXISTS idx_students_created_at ON students USING BRIN (created_at);
+CREATE INDEX IF NOT EXISTS idx_classes_created_at ON classes USING BRIN (created_at);
+
+-- Subject names are compared by subject_key, so "Math" and "math " are one subject
+CREATE OR REPLACE FUNCTION subject_key(name TEXT) RETURNS TEXT
+LANGUAGE SQL IMMUTABLE AS $$ SELECT lower(regexp_replace(btrim(name), '\s+', ' ', 'g')) $$;
+
+-- Create subjects table (one row per subject taught in a class)
+CREATE TABLE IF NOT EXISTS subjects (
+    id SERIAL PRIMARY KEY,
+    class_id INTEGER NOT NULL,
+    name VARCHAR(100) NOT NULL,
+    name_key VARCHAR(100) GENERATED ALWAYS AS (subject_key(name)) STORED,
+    UNIQUE(class_id, name_key),
+    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE
+);
+
+-- Create exams table (one sitting of a subject: optional exam name and date)
+CREATE TABLE IF NOT EXISTS exams (
+    id SERIAL PRIMARY KEY,
+    class_id INTEGER NOT NULL,
+    subject_id INTEGER NOT NULL,
+    name VARCHAR(100) NOT NULL DEFAULT '',
+    exam_date DATE NOT NULL,
+    UNIQUE(subject_id, exam_date, name),
+    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE,
+    FOREIGN KEY (subject_id) REFERENCES subjects(id) ON DELETE CASCADE
+);
+-- Dashboard filters: a class's exams by date range
+CREATE INDEX IF NOT EXISTS idx_exams_class_id_exam_date ON exams(class_id, exam_date);
 
--- Create results table
+-- Create results table (subject and date live on the exam, referenced by a 4-byte key)
 CREATE TABLE IF NOT EXISTS results (
     id SERIAL PRIMARY KEY,
     student_id INTEGER,
-    subject VARCHAR(100) NOT NULL,
+    exam_id INTEGER NOT NULL,
     marks INTEGER NOT NULL,
     total_marks INTEGER NOT NULL,
-    exam_date DATE NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    UNIQUE(student_id, subject, exam_date),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(exam_id, student_id),
     FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
+    FOREIGN KEY (exam_id) REFERENCES exams(id) ON DELETE CASCADE,
     CHECK (marks >= 0)
 );
 
@@ -48,14 +83,145 @@ DROP TABLE IF EXISTS results CASCADE;
 CREATE TABLE results (
     id SERIAL PRIMARY KEY,
     student_id INTEGER,
-    subject VARCHAR(100) NOT NULL,
+    exam_id INTEGER NOT NULL,
     marks INTEGER NOT NULL,
     total_marks INTEGER NOT NULL,
-    exam_date DATE NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    UNIQUE(student_id, subject, exam_date),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(exam_id, student_id),
     FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
+    FOREIGN KEY (exam_id) REFERENCES exams(id) ON DELETE CASCADE,
     CHECK (marks >= 0)
 );
+CREATE INDEX IF NOT EXISTS idx_results_student_id ON results(student_id);
+
+
 
 
+-- Results changed since the last analytics snapshot are found through updated_at
+ALTER TABLE results ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+-- Create partial aggregates table (one mergeable summary per exam)
+CREATE TABLE IF NOT EXISTS result_aggregates (
+    exam_id INTEGER PRIMARY KEY,
+    class_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    mean DOUBLE PRECISION NOT NULL,
+    m2 DOUBLE PRECISION NOT NULL,
+    min_value DOUBLE PRECISION,
+    max_value DOUBLE PRECISION,
+    histogram INTEGER[] NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (exam_id) REFERENCES exams(id) ON DELETE CASCADE,
+    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE
+);
+
+
+-- Create background jobs table (queue for the job_worker.py pool)
+CREATE TABLE IF NOT EXISTS jobs (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    kind VARCHAR(50) NOT NULL,
+    params JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    result JSONB,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+    worker VARCHAR(100),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    heartbeat_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    CHECK (status IN ('queued', 'running', 'succeeded', 'failed', 'cancelled')),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+
+-- Create shared cache table (UNLOGGED: no WAL, emptied after a crash, which a cache can afford)
+CREATE UNLOGGED TABLE IF NOT EXISTS cache_entries (
+    key TEXT PRIMARY KEY,
+    value BYTEA NOT NULL,
+    expires_at TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_expires_at ON cache_entries(expires_at);
+
+
+-- Create class rankings (one row per ranked student, refreshed with every results write)
+CREATE TABLE IF NOT EXISTS class_rankings (
+    student_id INTEGER PRIMARY KEY,
+    class_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    exam_count INTEGER NOT NULL,
+    percentage DOUBLE PRECISION NOT NULL,
+    rank INTEGER NOT NULL,
+    previous_rank INTEGER,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
+    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_class_rankings_class_id_rank ON class_rankings(class_id, rank);
+
+-- Create result cube (per-user rollups of the partial aggregates, see CubeRepo)
+CREATE TABLE IF NOT EXISTS result_cube (
+    user_id INTEGER NOT NULL,
+    level VARCHAR(20) NOT NULL,
+    semester VARCHAR(50),
+    class_id INTEGER,
+    subject VARCHAR(100),
+    exam_date DATE,
+    count INTEGER NOT NULL,
+    sum DOUBLE PRECISION NOT NULL,
+    sum_sq DOUBLE PRECISION NOT NULL,
+    min_value DOUBLE PRECISION,
+    max_value DOUBLE PRECISION,
+    histogram INTEGER[] NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+-- One row per slice; columns a level rolls up are NULL, so the key coalesces them
+CREATE UNIQUE INDEX IF NOT EXISTS idx_result_cube_slice ON result_cube (
+    user_id, level, COALESCE(semester, ''), COALESCE(class_id, 0), COALESCE(subject, ''),
+    COALESCE(exam_date, DATE '0001-01-01')
+);
+
+-- Create at-risk scores (one row per scored student, written by at_risk.py)
+CREATE TABLE IF NOT EXISTS at_risk (
+    student_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    class_id INTEGER NOT NULL,
+    result_count INTEGER NOT NULL,
+    percentile DOUBLE PRECISION,
+    z_score DOUBLE PRECISION,
+    trend DOUBLE PRECISION,
+    worst_drop DOUBLE PRECISION,
+    reasons TEXT[] NOT NULL DEFAULT '{}',
+    flagged BOOLEAN NOT NULL,
+    scored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
+    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_at_risk_user_id_flagged ON at_risk(user_id) WHERE flagged;
+
+-- Create at-risk scan state (the partial aggregate version each exam was last scored at)
+CREATE TABLE IF NOT EXISTS at_risk_exams (
+    exam_id INTEGER PRIMARY KEY,
+    aggregate_updated_at TIMESTAMP,
+    FOREIGN KEY (exam_id) REFERENCES exams(id) ON DELETE CASCADE
+);
+
+
+-- Create circuit breaker trip log (one row per trip, written by the app process once it closes)
+CREATE TABLE IF NOT EXISTS db_breaker_trips (
+    id SERIAL PRIMARY KEY,
+    host VARCHAR(255) NOT NULL,
+    opened_at TIMESTAMP NOT NULL,
+    closed_at TIMESTAMP NOT NULL,
+    failures INTEGER NOT NULL,
+    probes INTEGER NOT NULL,
+    reason TEXT
+);
@@ -1,57 +1,189 @@
 import streamlit as st
+import psycopg2
+from psycopg2.pool import PoolError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import partial
 from db_connection import Connect_DB
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
-import numpy as np
+from exports import render_export_controls
+from analytics import get_analytics, DashboardScope, PostgresAnalytics
+from repositories import CubeRepo
+from archive import merge_archived, archived_enrollment
+from shared_cache import get_shared_cache, dashboard_key, DASHBOARD_DATASETS
+from live_updates import get_change_listener, rerun_fragments, LIVE_CHECK_SECONDS
+from stats_accumulators import RunningStats, HISTOGRAM_BINS, HISTOGRAM_MIN, HISTOGRAM_MAX, merge_by, backfill_partials, cube_rows
+from metrics import counter, histogram
+from figure_cache import cached_figure
+
+LOAD_SECONDS = histogram("laytics_dashboard_load_seconds", "Time to gather the dashboard's datasets")
+DATASETS = counter(
+    "laytics_dashboard_datasets_total", "Dashboard datasets served, by source (cache, database, stale)", ("source",)
+)
+
+# What a filtered or drilled-down dashboard loads again (the class list feeds the filters);
+# of the two performance datasets, only the one the scope needs (see DashboardScope.needs_exams)
+SCOPED_DATASETS = ("totals", "class_distribution", "performance", "performance_cube", "enrollment", "at_risk")
+
+# Sections that rerun on their own when a change of their kind lands (change -> fragment key).
+# Any other change moves the filters and most of the page, so the page reruns.
+LIVE_SECTIONS = {"results": "dashboard_performance", "at_risk": "dashboard_at_risk"}
+# Where a page run hands the live sections the datasets it loaded for them
+PREFETCHED_KEY = "dashboard_prefetched"
+
+# Enrollment trend periods and the date_trunc unit counted for each; semesters are month buckets grouped by class
+ENROLLMENT_PERIODS = {"Week": "week", "Month": "month", "Semester": "month"}
+
+
+class DashboardUnavailable(Exception):
+    """The dashboard queries failed; the message is what the user is shown"""
+
+
+def class_distribution_figure(class_names, student_counts):
+    import plotly.express as px
+    fig = px.bar(
+        x=class_names,
+        y=student_counts,
+        title="Students per Class",
+        labels={'x': 'Class', 'y': 'Number of Students'},
+        color=student_counts,
+        color_continuous_scale="Viridis"
+    )
+    fig.update_layout(
+        template="plotly_dark",
+        title_x=0.5,
+        xaxis_tickangle=-45,
+        height=400
+    )
+    return fig
+
+
+def performance_overview_figure(group_by, group_names, avg_percentages):
+    import plotly.express as px
+    fig = px.line(
+        x=group_names,
+        y=avg_percentages,
+        title=f"Average Performance by {group_by}",
+        labels={'x': group_by, 'y': 'Average Percentage'},
+        markers=True
+    )
+    fig.update_traces(
+        line=dict(width=3),
+        marker=dict(size=8)
+    )
+    fig.update_layout(
+        template="plotly_dark",
+        title_x=0.5,
+        xaxis_tickangle=-45,
+        height=400
+    )
+    return fig
+
+
+def score_distribution_figure(title, bins, counts):
+    import plotly.express as px
+    fig = px.bar(
+        x=bins,
+        y=counts,
+        title=title,
+        labels={'x': 'Percentage', 'y': 'Results'}
+    )
+    fig.update_layout(
+        template="plotly_dark",
+        title_x=0.5,
+        height=400
+    )
+    return fig
+
+
+def _drop_stale(key, options):
+    """Forgets a filter or drill-down selection that is no longer offered, e.g. after its parent changed"""
+    if st.session_state.get(key) not in options:
+        st.session_state.pop(key, None)
+
+
+def exam_label(row):
+    """Subject, exam name (if any) and date, as the results page shows exams"""
+    name = row.get('exam_name')
+    return f"{row['subject']}{' · ' + name if name else ''} ({row['exam_date']})"
+
+
+def bucket_start(day, unit):
+    """The first day of the "week" (Monday, as date_trunc) or "month" bucket holding day"""
+    if unit == "week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def enrollment_trend_figure(period, labels, new_students, total_students):
+    import plotly.express as px
+    fig = px.bar(
+        x=labels,
+        y=new_students,
+        title=f"New Students per {period}",
+        labels={'x': period, 'y': 'New Students'}
+    )
+    fig.add_scatter(x=labels, y=total_students, name="Total Students", mode="lines+markers", yaxis="y2")
+    fig.update_layout(
+        template="plotly_dark",
+        title_x=0.5,
+        xaxis_tickangle=-45,
+        height=400,
+        yaxis2=dict(title="Total Students", overlaying="y", side="right", rangemode="tozero"),
+        showlegend=False
+    )
+    return fig
+
+
+def enrollment_figure(labels, values):
+    import plotly.express as px
+    fig = px.pie(
+        values=values,
+        names=labels,
+        title="Enrollment Distribution by Class",
+        hole=0.4,
+        color_discrete_sequence=px.colors.qualitative.Pastel
+    )
+    fig.update_layout(
+        template="plotly_dark",
+        title_x=0.5,
+        height=400
+    )
+    return fig
+
 
 class Dashboard:
     def __init__(self):
         pass
     
     def display_dashboard(self):
-        # Create connection
-        connection = Connect_DB.get_connection()
-        if not connection:
-            st.error("Failed to connect to the database. Please try again later.")
+        # Note the change versions before loading, so a change made while loading still triggers a refresh
+        user_id = st.session_state.user_id
+        listener = get_change_listener()
+        if listener:
+            st.session_state.dashboard_versions = listener.versions(user_id)
+        live = bool(listener and listener.connected)
+
+        with LOAD_SECONDS.time():
+            data = self.get_dashboard_data(user_id, live=live)
+        if data is None:
             return
-        
-        cursor = connection.cursor()
-
-        # Helper functions for database queries
-        def get_total_classes(cursor):
-            cursor.execute("SELECT COUNT(*) AS total_classes FROM classes where user_id = %s", (st.session_state.user_id,))
-            result = cursor.fetchone()
-            return result['total_classes'] if result else 0
-
-        def get_total_students(cursor):
-            cursor.execute("""
-                           SELECT COUNT(s.id) AS total_students 
-                           FROM students s 
-                           JOIN classes c ON s.class_id = c.id 
-                           WHERE c.user_id = %s""", 
-                           (st.session_state.user_id,))
-            result = cursor.fetchone()
-            return result['total_students'] if result else 0
-
-        def get_highest_students_in_class(cursor):
-            cursor.execute("""
-                            SELECT s.class_id, COUNT(*) AS student_count
-                            FROM students s
-                            JOIN classes c ON s.class_id = c.id
-                            WHERE c.user_id = %s
-                            GROUP BY s.class_id
-                            ORDER BY student_count DESC LIMIT 1
-                        """, (st.session_state.user_id,))
-
-            result = cursor.fetchone()
-            return result['student_count'] if result else 0
-
-        # Fetch data
-        total_classes = get_total_classes(cursor)
-        total_students = get_total_students(cursor)
-        highest_students = get_highest_students_in_class(cursor)
+
+        st.title("Dashboard")
+        scope = self.display_filters(data["classes"])
+        if scope.filtered:
+            with LOAD_SECONDS.time():
+                data = self.get_scoped_data(user_id, scope)
+            if data is None:
+                return
+        # Loaded with the rest, in parallel; the live sections load their own again when they rerun alone
+        st.session_state[PREFETCHED_KEY] = {
+            name: data[name] for name in ("performance", "performance_cube", "at_risk") if name in data
+        }
+
+        totals = data["totals"]
+        total_classes = totals['total_classes'] if totals else 0
+        total_students = totals['total_students'] if totals else 0
+        highest_students = totals['highest_students'] if totals else 0
 
         # delta for metrics
         delta_classes = total_classes/2 if total_classes > 0 else 0
@@ -59,7 +191,6 @@ class Dashboard:
         delta_highest_students = highest_students/2 if highest_students > 0 else 0
 
         # Display Metrics in the Dashboard
-        st.title("Dashboard")
         container = st.container()
         block1, block2, block3 = container.columns(3)
 
@@ -74,147 +205,524 @@ class Dashboard:
         # Analytics Section with Tabs
         st.markdown("<h2 style='text-align: center; margin: 2rem 0;'>Analytics Overview</h2>", unsafe_allow_html=True)
         
-        tab1, tab2, tab3 = st.tabs(["Class Distribution", "Performance Overview", "Enrollment Trends"])
+        tab1, tab2, tab3, tab4 = st.tabs(["Class Distribution", "Performance Overview", "Enrollment Trends", "At-Risk Students"])
         
         with tab1:
-            self.create_class_distribution_chart(cursor)
+            self.create_class_distribution_chart(data["class_distribution"])
         
         with tab2:
-            self.create_performance_overview_chart(cursor)
+            self.display_performance(user_id, scope, live)
         
         with tab3:
-            self.create_enrollment_trends_chart(cursor)
+            self.create_enrollment_trends_chart(user_id, scope, data["enrollment"], live=live)
+
+        with tab4:
+            self.display_at_risk(user_id, scope, live)
+
+        st.markdown("---")
+        with st.expander("Export All Results"):
+            render_export_controls("all_classes", "all_results", st.session_state.user_id)
+
+        if listener:
+            self.watch_for_changes(user_id)
+
+    @st.fragment(run_every=LIVE_CHECK_SECONDS)
+    def watch_for_changes(self, user_id):
+        """
+        Compares this session's change versions with the process listener's, in memory.
+        A results or at-risk change reruns only the section showing it. Any other change,
+        or a listener reconnect (events may have been missed), reruns the page; datasets
+        the change did not touch are still cached, so only the affected queries run again.
+        """
+        listener = get_change_listener()
+        seen = st.session_state.get("dashboard_versions")
+        if not listener or seen is None:
+            return
+        epoch, versions = listener.versions(user_id)
+        changed = {change for change in set(versions) | set(seen[1]) if versions.get(change) != seen[1].get(change)}
+        if epoch != seen[0] or changed - set(LIVE_SECTIONS):
+            st.rerun()
+        if changed:
+            rerun_fragments([LIVE_SECTIONS[change] for change in sorted(changed)])
+
+    def note_version(self, user_id, change):
+        """Records the version of one change kind that this session is about to show"""
+        listener = get_change_listener()
+        seen = st.session_state.get("dashboard_versions")
+        if listener and seen is not None:
+            versions = dict(seen[1])
+            versions[change] = listener.versions(user_id)[1].get(change)
+            st.session_state.dashboard_versions = (seen[0], versions)
+
+    def section_data(self, user_id, scope, change, names, live):
+        """
+        A live section's datasets: the ones the page run just loaded, or, when the section
+        reruns alone (a change of its kind or one of its own widgets), loaded again
+        """
+        prefetched = st.session_state.get(PREFETCHED_KEY, {})
+        if all(name in prefetched for name in names):
+            return {name: prefetched.pop(name) for name in names}
+        self.note_version(user_id, change)
+        with LOAD_SECONDS.time():
+            if scope.filtered:
+                return self.get_scoped_data(user_id, scope, names)
+            return self.get_dashboard_data(user_id, live=live, datasets=names)
+
+    @st.fragment(key="dashboard_performance")
+    def display_performance(self, user_id, scope, live):
+        """The performance tab; reruns alone when the user's results change"""
+        name = "performance" if scope.needs_exams else "performance_cube"
+        data = self.section_data(user_id, scope, "results", [name], live)
+        if data is not None:
+            self.create_performance_overview_chart(data, scope)
+
+    @st.fragment(key="dashboard_at_risk")
+    def display_at_risk(self, user_id, scope, live):
+        """The at-risk tab; reruns alone when an at-risk scan finishes"""
+        data = self.section_data(user_id, scope, "at_risk", ["at_risk"], live)
+        if data is not None:
+            self.create_at_risk_table(data["at_risk"])
+
+    def display_filters(self, classes):
+        """Semester and exam date filters and the class to drill into; returns the DashboardScope"""
+        semesters = [None] + sorted({cls['semester'] for cls in classes})
+        _drop_stale("dashboard_semester", semesters)
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            semester = st.selectbox(
+                "Semester", semesters,
+                format_func=lambda value: "All semesters" if value is None else value,
+                key="dashboard_semester"
+            )
+        with col2:
+            dates = st.date_input("Exam dates", value=(), key="dashboard_exam_dates")
+        names = {
+            cls['id']: cls['class_name'] if semester else f"{cls['class_name']} ({cls['semester']})"
+            for cls in classes if semester is None or cls['semester'] == semester
+        }
+        class_ids = [None] + sorted(names, key=lambda value: names[value].lower())
+        _drop_stale("dashboard_class", class_ids)
+        with col3:
+            class_id = st.selectbox(
+                "Class", class_ids,
+                format_func=lambda value: "All classes" if value is None else names[value],
+                key="dashboard_class"
+            )
+        if dates:
+            st.caption("Exam dates narrow the performance figures; class and student counts follow the semester.")
+        return DashboardScope(
+            semester=semester,
+            date_from=dates[0] if len(dates) > 0 else None,
+            date_to=dates[1] if len(dates) > 1 else None,
+            class_id=class_id
+        )
+
+    def get_scoped_data(self, user_id, scope, datasets=None):
+        """
+        The dashboard datasets inside a scope, straight from the database. Their queries
+        run on the classes(user_id, semester) and exams(class_id, exam_date) indexes, so
+        a narrower scope reads fewer rows. They are not cached: a change could not find
+        every scope's copy to drop it. datasets narrows what is loaded.
+        """
+        skipped = "performance_cube" if scope.needs_exams else "performance"
+        datasets = datasets or [name for name in SCOPED_DATASETS if name != skipped]
+        try:
+            data = self.load_dashboard_data(user_id, datasets, scope)
+        except DashboardUnavailable as e:
+            st.error(str(e))
+            return None
+        DATASETS.inc(len(data), source="database")
+        return data
+
+    def get_dashboard_data(self, user_id, live=False, datasets=DASHBOARD_DATASETS):
+        """
+        Returns the dashboard datasets (all by default), loading only those missing from the shared cache.
+        With live updates connected, invalidation is pushed to every replica, so the
+        in-process copies may be kept as long as the shared ones.
+        """
+        cache = get_shared_cache()
+        data = {}
+        for name in datasets:
+            hit, value = cache.get(dashboard_key(user_id, name))
+            if hit:
+                data[name] = value
+
+        missing = [name for name in datasets if name not in data]
+        DATASETS.inc(len(data), source="cache")
+        if missing:
+            try:
+                loaded = self.load_dashboard_data(user_id, missing)
+            except DashboardUnavailable as e:
+                return self.get_stale_dashboard_data(user_id, data, missing, e)
+            for name, value in loaded.items():
+                cache.set(dashboard_key(user_id, name), value,
+                          local_ttl=cache.default_ttl if live else None, keep_stale=True)
+            data.update(loaded)
+            DATASETS.inc(len(loaded), source="database")
+        return data
+
+    def get_stale_dashboard_data(self, user_id, data, missing, error):
+        """
+        While the database is failing, fills the missing datasets with the last ones
+        this process loaded, and says how old they are; None if it has none
+        """
+        cache = get_shared_cache()
+        saved_at = []
+        for name in missing:
+            hit, value, saved = cache.get_stale(dashboard_key(user_id, name))
+            if not hit:
+                st.error(str(error))
+                return None
+            data[name] = value
+            saved_at.append(saved)
+        DATASETS.inc(len(missing), source="stale")
+        st.warning(f"{error} Showing the figures from {datetime.fromtimestamp(min(saved_at)):%H:%M:%S} instead.")
+        return data
 
-        cursor.close()
-        connection.close()
+    def load_dashboard_data(self, user_id, datasets=DASHBOARD_DATASETS, scope=None):
+        """
+        Runs the given independent dashboard queries concurrently on the configured analytics
+        backend (PostgreSQL or the DuckDB snapshot), each on its own cursor, so the page
+        waits for the slowest query rather than the sum. On PostgreSQL the number of
+        queries in flight is capped per session by Connect_DB.session_slots().
+        A DashboardScope narrows every dataset but the class list.
+        """
+        analytics = get_analytics()
+        if not analytics:
+            raise DashboardUnavailable("Failed to connect to the database. Please try again later.")
+
+        queries = {
+            "classes": analytics.fetch_classes,
+            "totals": partial(analytics.fetch_totals, scope=scope),
+            "class_distribution": partial(analytics.fetch_class_distribution, scope=scope),
+            "performance": partial(analytics.fetch_performance_partials, scope=scope),
+            "performance_cube": partial(analytics.fetch_performance_cube, scope=scope),
+            "enrollment": partial(analytics.fetch_enrollment, scope=scope),
+            "at_risk": partial(analytics.fetch_at_risk, scope=scope),
+        }
+        queries = {name: fetch for name, fetch in queries.items() if name in datasets}
+
+        def run_query(fetch):
+            with analytics.cursor() as cursor:
+                return fetch(cursor, user_id)
+
+        try:
+            with ThreadPoolExecutor(max_workers=Connect_DB.session_concurrency()) as executor:
+                futures = {name: executor.submit(run_query, fetch) for name, fetch in queries.items()}
+                data = {name: future.result() for name, future in futures.items()}
+
+            # An empty scope proves nothing about missing partials; only the whole dashboard backfills
+            if "performance_cube" in data and not data["performance_cube"] and scope is None and isinstance(analytics, PostgresAnalytics):
+                data["performance_cube"] = self.backfill_performance_cube(analytics, user_id)
+            # Archived classes come from the archive manifest, without touching their files
+            return merge_archived(data, user_id, scope=scope)
+        except (psycopg2.Error, PoolError) + analytics.errors as e:
+            raise DashboardUnavailable(f"Failed to load dashboard data: {str(e).strip().rstrip('.')}.") from e
+
+    def backfill_performance_cube(self, analytics, user_id):
+        """
+        One-time build on the primary for results saved before partial aggregates or the
+        cube existed; returns the cube afterwards (empty if the user has no results)
+        """
+        with Connect_DB.pooled_connection(Connect_DB.get_pool()) as connection:
+            cursor = connection.cursor()
+            try:
+                backfill_partials(cursor, user_id)
+                if CubeRepo(cursor).refresh_user(user_id).rowcount:
+                    connection.commit()
+                    return analytics.fetch_performance_cube(cursor, user_id)
+                connection.rollback()
+                return []
+            finally:
+                cursor.close()
     
-    def create_class_distribution_chart(self, cursor):
+    def create_class_distribution_chart(self, classes):
         """Create a modern bar chart showing student distribution across classes"""
-        cursor.execute("""
-                        SELECT c.class_name, COUNT(s.id) AS student_count
-                        FROM classes c
-                        LEFT JOIN students s ON c.id = s.class_id
-                        WHERE c.user_id = %s
-                        GROUP BY c.class_name, c.id
-                        ORDER BY student_count DESC
-                    """, (st.session_state.user_id,))
-
-        classes = cursor.fetchall()
-        
         if classes:
             class_names = [cls['class_name'] for cls in classes]
             student_counts = [cls['student_count'] for cls in classes]
             
-            # Create Plotly bar chart
-            fig = px.bar(
-                x=class_names, 
-                y=student_counts,
-                title="Students per Class",
-                labels={'x': 'Class', 'y': 'Number of Students'},
-                color=student_counts,
-                color_continuous_scale="Viridis"
-            )
-            
-            fig.update_layout(
-                template="plotly_dark",
-                title_x=0.5,
-                xaxis_tickangle=-45,
-                height=400
-            )
-            
+            # Create Plotly bar chart (rebuilt only when the counts change)
+            fig = cached_figure(class_distribution_figure, class_names=class_names, student_counts=student_counts)
             st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("No classes available to display distribution.")
     
-    def create_performance_overview_chart(self, cursor):
-        """Create a chart showing overall performance metrics"""
-        cursor.execute("""
-                        SELECT c.class_name, 
-                            AVG(r.marks::float / r.total_marks * 100) as avg_percentage,
-                            COUNT(r.id) as total_results
-                        FROM classes c
-                        LEFT JOIN students s ON c.id = s.class_id
-                        LEFT JOIN results r ON s.id = r.student_id
-                        WHERE c.user_id = %s AND r.id IS NOT NULL
-                        GROUP BY c.class_name, c.id
-                        HAVING COUNT(r.id) > 0
-                        ORDER BY avg_percentage DESC
-                    """, (st.session_state.user_id,))
-
-        performance_data = cursor.fetchall()
-        
-        if performance_data:
-            class_names = [data['class_name'] for data in performance_data]
-            avg_percentages = [round(data['avg_percentage'], 1) if data['avg_percentage'] else 0 for data in performance_data]
-            
-            # Create Plotly line chart
-            fig = px.line(
-                x=class_names,
-                y=avg_percentages,
-                title="Average Class Performance",
-                labels={'x': 'Class', 'y': 'Average Percentage'},
-                markers=True
+    def drill_down(self, partials):
+        """
+        Subject and exam selectors for a class's per-exam partials. Returns the level shown
+        and its groups: the class's subjects, a subject's exams (oldest first) or one exam.
+        """
+        subjects = [None] + sorted({row['subject'] for row in partials}, key=str.lower)
+        _drop_stale("dashboard_subject", subjects)
+        col1, col2 = st.columns(2)
+        with col1:
+            subject = st.selectbox(
+                "Subject", subjects,
+                format_func=lambda value: "All subjects" if value is None else value,
+                key="dashboard_subject"
             )
-            
-            fig.update_traces(
-                line=dict(width=3),
-                marker=dict(size=8)
+        if subject is None:
+            return "Subject", merge_by(partials, lambda row: row['subject'])
+
+        exams = sorted((row for row in partials if row['subject'] == subject), key=lambda row: row['exam_date'])
+        labels = {row['exam_id']: exam_label(row) for row in exams}
+        _drop_stale("dashboard_exam", [None] + list(labels))
+        with col2:
+            exam_id = st.selectbox(
+                "Exam", [None] + list(labels),
+                format_func=lambda value: "All exams" if value is None else labels[value],
+                key="dashboard_exam"
             )
-            
-            fig.update_layout(
-                template="plotly_dark",
-                title_x=0.5,
-                xaxis_tickangle=-45,
-                height=400
+        if exam_id is not None:
+            exams = [row for row in exams if row['exam_id'] == exam_id]
+        return "Exam", merge_by(exams, lambda row: labels[row['exam_id']])
+
+    def compare_groups(self, slices, semester=None):
+        """
+        The "Compare by" choice across classes, read from the cube level it names (rows of
+        the same slice, hot and archived, are merged); returns it and the merged groups
+        """
+        group_by = st.radio(
+            "Compare by",
+            ["Class", "Semester", "Subject", "Exam Date", "Custom Group"],
+            horizontal=True,
+            key="performance_group_by"
+        )
+
+        def level(name):
+            # Within a semester, subjects and dates come from the levels that keep the semester
+            if semester is not None and name in ("subject", "exam_date"):
+                name = f"semester_{name}"
+            return [row for row in slices if row['level'] == name]
+
+        if group_by == "Class":
+            groups = merge_by(level("class"), lambda row: row['class_name'])
+        elif group_by == "Semester":
+            groups = merge_by(level("semester"), lambda row: row['semester'])
+        elif group_by == "Subject":
+            groups = merge_by(level("subject"), lambda row: row['subject'])
+        elif group_by == "Exam Date":
+            groups = merge_by(sorted(level("exam_date"), key=lambda row: row['exam_date']), lambda row: f"{row['exam_date']}")
+        else:
+            class_names = sorted({row['class_name'] for row in level("class")})
+            selected = st.multiselect("Classes in group", class_names, default=class_names, key="performance_custom_group")
+            groups = merge_by(
+                level("class"),
+                lambda row: "Selected Group" if row['class_name'] in selected else "Other Classes"
             )
+        return group_by, groups
+
+    def create_performance_overview_chart(self, data, scope=None):
+        """
+        Create a chart showing overall performance metrics from merged partial aggregates:
+        a class drill-down from its per-exam partials, comparisons from the result cube
+        (rolled up here from the per-exam partials when an exam date range is set)
+        """
+        import pandas as pd
+        needs_exams = scope is not None and scope.needs_exams
+        rows = data["performance"] if needs_exams else data["performance_cube"]
+        if rows:
+            if scope is not None and scope.class_id is not None:
+                group_by, groups = self.drill_down(rows)
+            else:
+                group_by, groups = self.compare_groups(
+                    cube_rows(rows) if needs_exams else rows, scope.semester if scope else None
+                )
+
+            if group_by in ("Exam", "Exam Date"):
+                # Exams keep their date order, so the line reads as a trend
+                ordered = list(groups.items())
+            else:
+                ordered = sorted(groups.items(), key=lambda item: item[1].mean, reverse=True)
+            group_names = [name for name, _ in ordered]
+            avg_percentages = [round(stats.mean, 1) for _, stats in ordered]
             
+            # Create Plotly line chart
+            fig = cached_figure(
+                performance_overview_figure,
+                group_by=group_by, group_names=group_names, avg_percentages=avg_percentages
+            )
             st.plotly_chart(fig, use_container_width=True)
+            if group_by == "Exam" and len(ordered) == 1:
+                self.create_score_distribution_chart(*ordered[0])
             
             # Show performance summary
-            if avg_percentages:
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("Highest Avg", f"{max(avg_percentages):.1f}%")
-                with col2:
-                    st.metric("Lowest Avg", f"{min(avg_percentages):.1f}%")
-                with col3:
-                    st.metric("Overall Avg", f"{sum(avg_percentages)/len(avg_percentages):.1f}%")
+            overall = RunningStats.combine(stats for _, stats in ordered)
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("Highest Avg", f"{max(avg_percentages):.1f}%")
+            with col2:
+                st.metric("Lowest Avg", f"{min(avg_percentages):.1f}%")
+            with col3:
+                st.metric("Overall Avg", f"{overall.mean:.1f}%")
+            with col4:
+                st.metric("Overall Median", f"{overall.median:.1f}%")
+
+            st.dataframe(
+                pd.DataFrame([
+                    {
+                        group_by: name,
+                        "Results": stats.count,
+                        "Mean %": round(stats.mean, 1),
+                        "Std Dev": round(stats.std, 1),
+                        "Median %": round(stats.median, 1),
+                        "Min %": round(stats.minimum, 1),
+                        "Max %": round(stats.maximum, 1),
+                    }
+                    for name, stats in ordered
+                ]),
+                use_container_width=True,
+                hide_index=True
+            )
+        elif scope is not None and scope.filtered:
+            st.info("No results match these filters.")
         else:
             st.info("No results available to show performance overview. Add some results first.")
+
+    def create_score_distribution_chart(self, name, stats):
+        """The histogram of one exam's percentages"""
+        width = (HISTOGRAM_MAX - HISTOGRAM_MIN) / HISTOGRAM_BINS
+        bins = [f"{HISTOGRAM_MIN + index * width:.0f}-{HISTOGRAM_MIN + (index + 1) * width:.0f}" for index in range(HISTOGRAM_BINS)]
+        fig = cached_figure(score_distribution_figure, title=f"Score Distribution: {name}", bins=bins, counts=stats.histogram)
+        st.plotly_chart(fig, use_container_width=True)
     
-    def create_enrollment_trends_chart(self, cursor):
-        """Create a pie chart showing enrollment distribution"""
-        cursor.execute("""
-                        SELECT c.class_name, c.semester, COUNT(s.id) AS student_count
-                        FROM classes c
-                        LEFT JOIN students s ON c.id = s.class_id
-                        WHERE c.user_id = %s
-                        GROUP BY c.class_name, c.semester, c.id
-                        HAVING COUNT(s.id) > 0
-                        ORDER BY student_count DESC
-                    """, (st.session_state.user_id,))
-
-        enrollment_data = cursor.fetchall()
-        
+    def get_enrollment_trend(self, user_id, unit, live=False):
+        """
+        New classes and students per class and bucket, archived classes included. Buckets
+        before the current one are kept in the shared cache, so each load only counts rows
+        created since the current bucket began, a range the created_at BRIN indexes narrow
+        to the newest pages. Creating classes or students drops the cached buckets.
+        """
+        analytics = get_analytics()
+        if not analytics:
+            raise DashboardUnavailable("Failed to connect to the database. Please try again later.")
+        cache = get_shared_cache()
+        key = dashboard_key(user_id, f"enrollment_{unit}")
+        current = bucket_start(date.today(), unit)
+        hit, closed = cache.get(key)
+        try:
+            with analytics.cursor() as cursor:
+                if hit and closed["before"] == current:
+                    rows = closed["rows"] + analytics.fetch_enrollment_buckets(cursor, user_id, unit, current)
+                else:
+                    rows = analytics.fetch_enrollment_buckets(cursor, user_id, unit, date.min)
+                    closed = {"before": current, "rows": [row for row in rows if row['bucket'] < current]}
+                    ttl = float(Connect_DB.get_setting("ENROLLMENT_CACHE_TTL_SECONDS", 3600))
+                    cache.set(key, closed, ttl=ttl, local_ttl=ttl if live else None)
+        except (psycopg2.Error, PoolError) + analytics.errors as e:
+            raise DashboardUnavailable(f"Failed to load enrollment trends: {str(e).strip().rstrip('.')}.") from e
+        # Archived students are gone from the students table; the archive manifest counts them per day
+        return rows + [
+            {"bucket": bucket_start(day, unit), "class_id": class_id, "semester": semester,
+             "new_classes": 0, "new_students": count}
+            for day, class_id, semester, count in archived_enrollment(user_id)
+        ]
+
+    def create_enrollment_trends_chart(self, user_id, scope, enrollment_data, live=False):
+        """New students per week, month or semester, then the current enrollment per class"""
+        import pandas as pd
+        period = st.radio("Per", list(ENROLLMENT_PERIODS), horizontal=True, key="enrollment_period")
+        unit = ENROLLMENT_PERIODS[period]
+        try:
+            rows = self.get_enrollment_trend(user_id, unit, live)
+        except DashboardUnavailable as e:
+            st.error(str(e))
+            rows = []
+        rows = [row for row in rows if scope is None or scope.includes_class(row['class_id'], row['semester'])]
+
+        if rows:
+            # Periods in time order; a semester sits where its first class or student was added
+            periods = {}
+            for row in sorted(rows, key=lambda row: row['bucket']):
+                if period == "Semester":
+                    label = row['semester']
+                else:
+                    label = f"{row['bucket']:%Y-%m-%d}" if unit == "week" else f"{row['bucket']:%Y-%m}"
+                totals = periods.setdefault(label, {"new_classes": 0, "new_students": 0})
+                totals["new_classes"] += row['new_classes']
+                totals["new_students"] += row['new_students']
+            labels = list(periods)
+            new_students = [totals["new_students"] for totals in periods.values()]
+            total_students = [sum(new_students[:index + 1]) for index in range(len(new_students))]
+
+            fig = cached_figure(
+                enrollment_trend_figure,
+                period=period, labels=labels, new_students=new_students, total_students=total_students
+            )
+            st.plotly_chart(fig, use_container_width=True)
+            st.dataframe(
+                pd.DataFrame([
+                    {
+                        period: label,
+                        "New Classes": totals["new_classes"],
+                        "New Students": totals["new_students"],
+                        "Total Students": total,
+                    }
+                    for (label, totals), total in zip(periods.items(), total_students)
+                ]),
+                use_container_width=True,
+                hide_index=True
+            )
+        else:
+            st.info("No classes or students have been added yet.")
+
+        st.markdown("#### Current Enrollment")
         if enrollment_data:
             labels = [f"{data['class_name']} ({data['semester']})" for data in enrollment_data]
             values = [data['student_count'] for data in enrollment_data]
             
             # Create Plotly pie chart
-            fig = px.pie(
-                values=values,
-                names=labels,
-                title="Enrollment Distribution by Class",
-                hole=0.4,
-                color_discrete_sequence=px.colors.qualitative.Pastel
+            fig = cached_figure(enrollment_figure, labels=labels, values=values)
+            st.plotly_chart(fig, use_container_width=True)
+        else:
+            st.info("No enrollment data available to display.")
+
+    def create_at_risk_table(self, students):
+        """Students the last at-risk scan flagged (see at_risk.py), and a button to scan again"""
+        import pandas as pd
+        if students:
+            st.caption(
+                f"{len(students)} student(s) flagged for a low percentile, a falling trend or a sudden drop "
+                f"across their subjects. Last scanned {max(row['scored_at'] for row in students):%Y-%m-%d %H:%M}."
             )
-            
-            fig.update_layout(
-                template="plotly_dark",
-                title_x=0.5,
-                height=400
+            st.dataframe(
+                pd.DataFrame([
+                    {
+                        "Student": row['name'],
+                        "Roll No": row['roll_no'],
+                        "Class": f"{row['class_name']} ({row['semester']})",
+                        "Results": row['result_count'],
+                        "Percentile": None if row['percentile'] is None else round(row['percentile'], 1),
+                        "Trend (σ/month)": None if row['trend'] is None else round(row['trend'], 2),
+                        "Worst Drop (σ)": None if row['worst_drop'] is None else round(row['worst_drop'], 2),
+                        "Flags": ", ".join(row['reasons']),
+                    }
+                    for row in students
+                ]),
+                use_container_width=True,
+                hide_index=True
             )
-            
-            st.plotly_chart(fig, use_container_width=True)
         else:
-            st.info("No enrollment data available to display trends.")
+            st.info("No students are flagged. Scores are refreshed by the at-risk scan.")
+
+        if st.button("Scan for New Results", key="at_risk_scan"):
+            self.submit_at_risk_scan()
+
+    def submit_at_risk_scan(self):
+        """Queues an at_risk_scan job for this teacher; it only scores students with new results"""
+        from jobs import JobQueue
+
+        connection = Connect_DB.get_connection()
+        if not connection:
+            st.error("Database connection failed.")
+            return
+        try:
+            cursor = connection.cursor()
+            job_id = JobQueue.submit(cursor, st.session_state.user_id, "at_risk_scan", {})
+            connection.commit()
+            st.success(f"At-risk scan #{job_id} queued. Flagged students update here when it finishes.")
+        except psycopg2.Error as e:
+            st.error(f"An error occurred: {e}")
+        finally:
+            connection.close()
@@ -1,34 +1,551 @@
 import psycopg2
+import psycopg2.errors
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from contextlib import contextmanager
+import math
+import threading
+import time
 import os
+import weakref
 import streamlit as st
+from stats_accumulators import backfill_partials
+from db_health import PAGE_BUDGETS_MS, CLOSED, OPEN, HALF_OPEN, CircuitBreaker, DatabaseUnavailable, SessionGuard, record_trips, was_cancelled
+from metrics import counter, gauge, histogram
+
+# Last measured replica lag in seconds (None = unreachable), shared by all sessions
+_replica_state = {"lag": None, "checked_at": float("-inf")}
+_replica_lock = threading.Lock()
+
+# The process-wide circuit breaker, created on first use (see Connect_DB.get_breaker)
+_breaker_state = {"breaker": None}
+_breaker_lock = threading.Lock()
+
+# connection -> statement_timeout last SET on it (absent = the server default)
+_statement_timeouts = weakref.WeakKeyDictionary()
+
+# "primary" / "replica" -> this process's connection pool, for the pool gauges
+_pools = weakref.WeakValueDictionary()
+
+
+def _pool_usage():
+    return [
+        ({"pool": name, "state": state}, count)
+        for name, pool in list(_pools.items())
+        for state, count in (("in_use", len(pool._used)), ("idle", len(pool._pool)))
+    ]
+
+
+def _breaker_position():
+    state = Connect_DB.get_breaker().state
+    return [({"state": name}, int(name == state)) for name in (CLOSED, OPEN, HALF_OPEN)]
+
+
+CONNECT_SECONDS = histogram("laytics_db_connect_seconds", "Time to open a database connection", ("target",))
+CONNECTIONS_OPENED = counter(
+    "laytics_db_connections_opened_total", "Database connections opened, by outcome", ("target", "outcome")
+)
+POOL_EXHAUSTED = counter(
+    "laytics_db_pool_exhausted_total", "Borrows refused because every pooled connection was in use", ("pool",)
+)
+QUERIES_CANCELLED = counter("laytics_db_queries_cancelled_total", "Queries cancelled because their session reran")
+gauge("laytics_db_pool_connections", "Pooled connections, by state", ("pool", "state"), collect=_pool_usage)
+gauge(
+    "laytics_db_pool_max_connections", "Size limit of each connection pool", ("pool",),
+    collect=lambda: [({"pool": name}, pool.maxconn) for name, pool in list(_pools.items())]
+)
+gauge("laytics_db_breaker_state", "1 for the circuit breaker's current state", ("state",), collect=_breaker_position)
+counter(
+    "laytics_db_breaker_trips_total", "Times the circuit breaker opened",
+    collect=lambda: [({}, Connect_DB.get_breaker().trips)]
+)
+
+
+class GuardedCursor(RealDictCursor):
+    """
+    Cursor of primary connections: tells the circuit breaker how each statement went.
+    Queries cancelled because their session reran are not held against the database.
+    """
+
+    def execute(self, query, vars=None):
+        breaker = Connect_DB.get_breaker()
+        try:
+            super().execute(query, vars)
+        except psycopg2.OperationalError as e:
+            if not was_cancelled(self.connection):
+                breaker.record_failure(e)
+            raise
+        breaker.record_success()
+
+
+class AppPool(ThreadedConnectionPool):
+    """
+    Counts the connections it opens and the borrows it refuses. A borrow waits up to
+    wait_seconds for a connection to come back when all of them are in use. On the
+    primary, borrowing fails fast while the circuit breaker is open.
+    """
+
+    def __init__(self, minconn, maxconn, *args, readonly=False, wait_seconds=0, **kwargs):
+        self.target = "replica" if readonly else "primary"
+        self.wait_seconds = wait_seconds
+        # One slot per connection: a burst of page loads queues here instead of erroring
+        self._slots = threading.BoundedSemaphore(maxconn)
+        # Starts empty: connections are opened on first borrow, where the breaker can refuse
+        # them. minconn still sets how many idle connections are kept when they come back.
+        super().__init__(0, maxconn, *args, **kwargs)
+        self.minconn = minconn
+
+    def _connect(self, key=None):
+        with CONNECT_SECONDS.time(target=self.target):
+            try:
+                connection = super()._connect(key)
+            except psycopg2.Error:
+                CONNECTIONS_OPENED.inc(target=self.target, outcome="error")
+                raise
+        CONNECTIONS_OPENED.inc(target=self.target, outcome="ok")
+        return connection
+
+    def getconn(self, key=None):
+        # The replica has its own fallback (replica_available), so only the primary trips the breaker
+        breaker = Connect_DB.get_breaker() if self.target == "primary" else None
+        if breaker and not breaker.allow():
+            raise breaker.unavailable()
+        if not self._slots.acquire(timeout=self.wait_seconds):
+            POOL_EXHAUSTED.inc(pool=self.target)
+            raise PoolError(f"connection pool exhausted (waited {self.wait_seconds:g}s)")
+        try:
+            return super().getconn(key)
+        except PoolError:
+            self._slots.release()
+            POOL_EXHAUSTED.inc(pool=self.target)
+            raise
+        except psycopg2.OperationalError as e:
+            self._slots.release()
+            if breaker:
+                breaker.record_failure(e)
+            raise
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        super().putconn(conn, key, close)
+        self._slots.release()
+
 
 class Connect_DB:
     @staticmethod
-    
-    def get_connection():
+    def get_setting(name, default=None):
         """
-        Creates and returns a PostgreSQL database connection using Streamlit secrets
+        Reads an optional setting from the [secrets] section of Streamlit secrets,
+        falling back to an environment variable of the same name (used by job workers)
         """
         try:
-            database_url = st.secrets["secrets"]["DATABASE_URL"]
-            
-            connection = psycopg2.connect(
-                database_url,
-                cursor_factory=RealDictCursor,
-                sslmode="require"
-            )
+            return st.secrets["secrets"][name]
+        except (KeyError, FileNotFoundError):
+            return os.environ.get(name, default)
+
+    @staticmethod
+    def get_database_url():
+        """
+        Returns DATABASE_URL from Streamlit secrets or the environment; raises KeyError if unset
+        """
+        database_url = Connect_DB.get_setting("DATABASE_URL")
+        if not database_url:
+            raise KeyError("DATABASE_URL")
+        return database_url
+
+    @staticmethod
+    def get_read_database_url():
+        """Returns the optional read-replica DSN (DATABASE_READ_URL), or None"""
+        return Connect_DB.get_setting("DATABASE_READ_URL") or None
+
+    @staticmethod
+    def _connect(database_url, readonly=False, timeout_ms=None):
+        """
+        Opens a connection; timeout_ms becomes its statement_timeout and caps the connect
+        timeout. Connections to the primary go through the circuit breaker.
+        """
+        # Read-only sessions reject writes, so a write routed to the replica fails loudly
+        options = ["-c default_transaction_read_only=on"] if readonly else []
+        connect_timeout = int(Connect_DB.get_setting("DB_CONNECT_TIMEOUT", 10))
+        if timeout_ms:
+            options.append(f"-c statement_timeout={int(timeout_ms)}")
+            # libpq rounds anything below 2 seconds up to 2
+            connect_timeout = min(connect_timeout, max(2, math.ceil(timeout_ms / 1000)))
+
+        # The replica has its own fallback (replica_available), so only the primary trips the breaker
+        target = "replica" if readonly else "primary"
+        breaker = None if readonly else Connect_DB.get_breaker()
+        if breaker and not breaker.allow():
+            CONNECTIONS_OPENED.inc(target=target, outcome="refused")
+            raise breaker.unavailable()
+        try:
+            with CONNECT_SECONDS.time(target=target):
+                connection = psycopg2.connect(
+                    database_url,
+                    cursor_factory=RealDictCursor if readonly else GuardedCursor,
+                    sslmode=Connect_DB.get_setting("DB_SSLMODE", "require"),
+                    connect_timeout=connect_timeout,
+                    **({"options": " ".join(options)} if options else {})
+                )
+        except psycopg2.OperationalError as e:
+            CONNECTIONS_OPENED.inc(target=target, outcome="error")
+            if breaker:
+                breaker.record_failure(e)
+            raise
+        CONNECTIONS_OPENED.inc(target=target, outcome="ok")
+        return connection
+
+    @staticmethod
+    def replica_lag(connection):
+        """
+        Returns how many seconds the server behind this connection lags its primary, or
+        None for a replica that is not streaming from it. A streaming replica that has
+        replayed everything it received counts as current even if the primary has been
+        idle, and a primary always reports 0.
+        """
+        cursor = connection.cursor()
+        # Without a streaming WAL receiver nothing new arrives, so replay "catches up" with a
+        # receive position that no longer moves: that replica is stale, not current
+        cursor.execute("""
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END AS lag_seconds
+        """)
+        lag = cursor.fetchone()['lag_seconds']
+        cursor.close()
+        return None if lag is None else float(lag)
+
+    @staticmethod
+    def _mark_replica(lag):
+        with _replica_lock:
+            _replica_state["lag"] = lag
+            _replica_state["checked_at"] = time.monotonic()
+
+    @staticmethod
+    def replica_available(max_lag=None):
+        """
+        True when a read replica is configured, reachable and no staler than max_lag seconds
+        (REPLICA_MAX_LAG_SECONDS by default). The probe runs at most once every
+        REPLICA_CHECK_SECONDS per process; between probes the last measured lag is reused.
+        """
+        read_url = Connect_DB.get_read_database_url()
+        if not read_url:
+            return False
+        if max_lag is None:
+            max_lag = float(Connect_DB.get_setting("REPLICA_MAX_LAG_SECONDS", 30))
+        check_interval = float(Connect_DB.get_setting("REPLICA_CHECK_SECONDS", 15))
+
+        with _replica_lock:
+            fresh = time.monotonic() - _replica_state["checked_at"] < check_interval
+            lag = _replica_state["lag"]
+
+        if not fresh:
+            try:
+                connection = Connect_DB._connect(read_url, readonly=True)
+                try:
+                    lag = Connect_DB.replica_lag(connection)
+                finally:
+                    connection.close()
+            except psycopg2.Error:
+                lag = None
+            Connect_DB._mark_replica(lag)
+
+        return lag is not None and lag <= max_lag
+
+    @staticmethod
+    def get_connection(readonly=False, max_lag=None):
+        """
+        Creates and returns a PostgreSQL database connection using Streamlit secrets.
+        With readonly=True the connection goes to DATABASE_READ_URL when the replica is
+        within the staleness tolerance, and falls back to the primary otherwise.
+        On a page, the connection runs under the page's budget and is cancelled if the
+        session reruns while it is still busy.
+        """
+        guard = Connect_DB.session_guard()
+        timeout_ms = guard.timeout_ms if guard else None
+        connection = None
+        if readonly and Connect_DB.replica_available(max_lag):
+            try:
+                connection = Connect_DB._connect(Connect_DB.get_read_database_url(), readonly=True, timeout_ms=timeout_ms)
+            except psycopg2.Error:
+                # Replica went away since the last probe; stop routing to it until the next one
+                Connect_DB._mark_replica(None)
+
+        try:
+            if connection is None:
+                database_url = Connect_DB.get_database_url()
+                connection = Connect_DB._connect(database_url, timeout_ms=timeout_ms)
+            if guard:
+                guard.track(connection)
             return connection
 
         except KeyError:
             st.error("DATABASE_URL is not set in Streamlit secrets. Go to Settings → Secrets and add it.")
             return None
+        except DatabaseUnavailable as e:
+            st.warning(str(e))
+            return None
         except psycopg2.OperationalError as e:
             st.error(f"OperationalError: {e}")
         except psycopg2.Error as e:
             st.error(f"psycopg Error: {e}")
             return None
 
+    @staticmethod
+    @st.cache_resource(show_spinner=False)
+    def _create_pool(database_url, max_connections, readonly=False):
+        options = {"options": "-c default_transaction_read_only=on"} if readonly else {}
+        pool = AppPool(
+            1,
+            max_connections,
+            database_url,
+            readonly=readonly,
+            wait_seconds=float(Connect_DB.get_setting("DB_POOL_WAIT_SECONDS", 5)),
+            cursor_factory=RealDictCursor if readonly else GuardedCursor,
+            sslmode=Connect_DB.get_setting("DB_SSLMODE", "require"),
+            connect_timeout=int(Connect_DB.get_setting("DB_CONNECT_TIMEOUT", 10)),
+            **options
+        )
+        _pools[pool.target] = pool
+        return pool
+
+    @staticmethod
+    def get_pool(readonly=False, max_lag=None):
+        """
+        Returns the process-wide connection pool shared by all sessions, or None if it cannot be created.
+        readonly=True returns the replica pool under the same rules as get_connection(readonly=True).
+        """
+        max_connections = int(Connect_DB.get_setting("DB_POOL_MAX_CONNECTIONS", 10))
+        if readonly and Connect_DB.replica_available(max_lag):
+            try:
+                return Connect_DB._create_pool(Connect_DB.get_read_database_url(), max_connections, True)
+            except psycopg2.Error:
+                Connect_DB._mark_replica(None)
+
+        try:
+            database_url = Connect_DB.get_database_url()
+            return Connect_DB._create_pool(database_url, max_connections)
+
+        except KeyError:
+            st.error("DATABASE_URL is not set in Streamlit secrets. Go to Settings → Secrets and add it.")
+            return None
+        except psycopg2.Error as e:
+            st.error(f"psycopg Error: {e}")
+            return None
+
+    @staticmethod
+    @contextmanager
+    def pooled_connection(pool=None, guard=None):
+        """
+        Borrows a connection from the pool and always hands it back, discarding it if it broke
+        or a cancel was sent to it. Worker threads should pass the pool obtained with get_pool()
+        and the guard from session_guard() on the script thread, so their queries keep the
+        page's budget and can be cancelled.
+        """
+        if pool is None:
+            pool = Connect_DB.get_pool()
+        if guard is None:
+            guard = Connect_DB.session_guard()
+        if pool.target == "replica" and not Connect_DB.replica_available():
+            # The replica went bad after this pool was handed out
+            pool = Connect_DB._fallback_pool()
+        try:
+            connection = pool.getconn()
+        except psycopg2.OperationalError:
+            if pool.target != "replica":
+                raise
+            Connect_DB._mark_replica(None)
+            pool = Connect_DB._fallback_pool()
+            connection = pool.getconn()
+        cancelled = False
+        try:
+            Connect_DB._set_statement_timeout(connection, guard.timeout_ms if guard else None)
+            if guard:
+                guard.track(connection)
+            yield connection
+        finally:
+            if guard:
+                cancelled = guard.release(connection)
+            pool.putconn(connection, close=bool(connection.closed) or cancelled)
+
+    @staticmethod
+    def _fallback_pool():
+        """The primary pool, for reads whose replica pool can no longer serve them"""
+        pool = Connect_DB.get_pool()
+        if pool is None:
+            raise PoolError("the read replica is unavailable and the primary pool could not be created")
+        return pool
+
+    @staticmethod
+    def _set_statement_timeout(connection, timeout_ms):
+        """Pooled connections are shared by pages with different budgets; SET only when it differs"""
+        if _statement_timeouts.get(connection) == timeout_ms:
+            return
+        # A plain cursor: a SET says nothing about the database's health
+        cursor = connection.cursor(cursor_factory=psycopg2.extensions.cursor)
+        try:
+            if timeout_ms:
+                cursor.execute("SET statement_timeout = %s", (int(timeout_ms),))
+            else:
+                cursor.execute("RESET statement_timeout")
+        finally:
+            cursor.close()
+        # Its own transaction, so a later rollback on the page doesn't undo it
+        connection.commit()
+        _statement_timeouts[connection] = timeout_ms
+
+    @staticmethod
+    def get_breaker():
+        """The process-wide circuit breaker guarding the primary (see db_health.py)"""
+        breaker = _breaker_state["breaker"]
+        if breaker is None:
+            with _breaker_lock:
+                if _breaker_state["breaker"] is None:
+                    _breaker_state["breaker"] = CircuitBreaker(
+                        threshold=int(Connect_DB.get_setting("DB_BREAKER_FAILURES", 3)),
+                        cooldown=float(Connect_DB.get_setting("DB_BREAKER_COOLDOWN_SECONDS", 30))
+                    )
+                breaker = _breaker_state["breaker"]
+        return breaker
+
+    @staticmethod
+    def session_guard():
+        """This session's SessionGuard, or None outside a script run (job workers, CLIs, threads)"""
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+        if get_script_run_ctx(suppress_warning=True) is None:
+            return None
+        if "_db_session_guard" not in st.session_state:
+            st.session_state._db_session_guard = SessionGuard()
+        return st.session_state._db_session_guard
+
+    @staticmethod
+    def begin_run():
+        """
+        Called first on every script run: cancels the queries this session's earlier runs
+        still have in flight and writes out circuit breaker trips that have ended
+        """
+        guard = Connect_DB.session_guard()
+        if guard:
+            QUERIES_CANCELLED.inc(guard.begin_run())
+
+        breaker = Connect_DB.get_breaker()
+        trips = breaker.take_pending()
+        if not trips:
+            return
+        pool = Connect_DB.get_pool()
+        if not pool:
+            breaker.requeue(trips)
+            return
+        try:
+            with Connect_DB.pooled_connection(pool) as connection:
+                cursor = connection.cursor()
+                try:
+                    record_trips(cursor, trips)
+                    connection.commit()
+                finally:
+                    cursor.close()
+        except psycopg2.Error:
+            breaker.requeue(trips)
+
+    @staticmethod
+    def use_budget(page):
+        """Sets the latency budget (statement_timeout) for the rest of this run's queries"""
+        guard = Connect_DB.session_guard()
+        if guard:
+            guard.timeout_ms = int(Connect_DB.get_setting(f"{page.upper()}_BUDGET_MS", PAGE_BUDGETS_MS[page]))
+
+    @staticmethod
+    def show_degraded(error):
+        """What a page shows instead of its content when the database can't serve it"""
+        if isinstance(error, DatabaseUnavailable):
+            st.warning(f"{error} This page will load again once the database recovers.")
+        elif isinstance(error, psycopg2.errors.QueryCanceled):
+            st.warning("The database took too long to answer, so this page stopped waiting. Please try again in a moment.")
+        else:
+            st.error(f"Database connection problem: {error}")
+
+    @staticmethod
+    def session_concurrency():
+        """Maximum number of pooled connections a single session may hold at once"""
+        return max(1, int(Connect_DB.get_setting("DB_SESSION_CONCURRENCY", 3)))
+
+    @staticmethod
+    def session_slots():
+        """
+        Returns this session's semaphore limiting concurrent pooled queries, so one
+        user loading a dashboard can't exhaust the shared pool
+        """
+        if "_db_session_slots" not in st.session_state:
+            st.session_state._db_session_slots = threading.BoundedSemaphore(Connect_DB.session_concurrency())
+        return st.session_state._db_session_slots
+
+    @staticmethod
+    def migrate_results_to_exams(cursor):
+        """
+        One-time move of results from the free-text subject and exam_date columns to
+        subjects/exams keys; does nothing once results has no subject column. Subjects
+        that differ only in case or spacing are merged (the earliest spelling is kept),
+        and where that leaves a student with two rows for one exam the most recently
+        updated one wins. Returns True if it migrated; the old partial aggregates are
+        dropped and create_tables rebuilds them per exam. Run VACUUM FULL results
+        afterwards to give the freed space back.
+        """
+        cursor.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'results' AND column_name = 'subject'
+        """)
+        if cursor.fetchone() is None:
+            return False
+
+        cursor.execute("""
+            INSERT INTO subjects (class_id, name)
+            SELECT DISTINCT ON (s.class_id, subject_key(r.subject)) s.class_id, btrim(r.subject)
+            FROM results r
+            JOIN students s ON r.student_id = s.id
+            WHERE s.class_id IS NOT NULL
+            ORDER BY s.class_id, subject_key(r.subject), r.created_at, r.id
+            ON CONFLICT (class_id, name_key) DO NOTHING
+        """)
+        cursor.execute("""
+            INSERT INTO exams (class_id, subject_id, exam_date)
+            SELECT DISTINCT sb.class_id, sb.id, r.exam_date
+            FROM results r
+            JOIN students s ON r.student_id = s.id
+            JOIN subjects sb ON sb.class_id = s.class_id AND sb.name_key = subject_key(r.subject)
+            ON CONFLICT (subject_id, exam_date, name) DO NOTHING
+        """)
+        cursor.execute("ALTER TABLE results ADD COLUMN IF NOT EXISTS exam_id INTEGER")
+        cursor.execute("""
+            UPDATE results r SET exam_id = e.id
+            FROM students s, subjects sb, exams e
+            WHERE r.student_id = s.id
+              AND sb.class_id = s.class_id AND sb.name_key = subject_key(r.subject)
+              AND e.subject_id = sb.id AND e.exam_date = r.exam_date AND e.name = ''
+        """)
+        cursor.execute("""
+            DELETE FROM results r
+            USING results other
+            WHERE r.exam_id = other.exam_id AND r.student_id = other.student_id
+              AND (COALESCE(r.updated_at, r.created_at), r.id) < (COALESCE(other.updated_at, other.created_at), other.id)
+        """)
+        # Results of students without a class have no exam to belong to
+        cursor.execute("DELETE FROM results WHERE exam_id IS NULL")
+        cursor.execute("""
+            ALTER TABLE results
+                DROP COLUMN subject,
+                DROP COLUMN exam_date,
+                ALTER COLUMN exam_id SET NOT NULL,
+                ADD FOREIGN KEY (exam_id) REFERENCES exams(id) ON DELETE CASCADE,
+                ADD UNIQUE (exam_id, student_id)
+        """)
+        cursor.execute("DROP TABLE IF EXISTS result_aggregates")
+        return True
 
     @staticmethod
     def create_tables():
@@ -66,6 +583,9 @@ class Connect_DB:
                 );
             """)
             
+            # Archived classes keep their row; their students and results live in archive/ (see archive.py)
+            cursor.execute("ALTER TABLE classes ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP")
+            
             # Create students table with user association
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS students (
@@ -81,26 +601,238 @@ class Connect_DB:
                 );
             """)
             
-            # Create results table
+            # Subject names are compared by subject_key, so "Math" and "math " are one subject
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION subject_key(name TEXT) RETURNS TEXT
+                LANGUAGE SQL IMMUTABLE AS $$ SELECT lower(regexp_replace(btrim(name), '\\s+', ' ', 'g')) $$;
+            """)
+
+            # Create subjects table (one row per subject taught in a class)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS subjects (
+                    id SERIAL PRIMARY KEY,
+                    class_id INTEGER NOT NULL,
+                    name VARCHAR(100) NOT NULL,
+                    name_key VARCHAR(100) GENERATED ALWAYS AS (subject_key(name)) STORED,
+                    UNIQUE(class_id, name_key),
+                    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE
+                );
+            """)
+
+            # Create exams table (one sitting of a subject: optional exam name and date)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS exams (
+                    id SERIAL PRIMARY KEY,
+                    class_id INTEGER NOT NULL,
+                    subject_id INTEGER NOT NULL,
+                    name VARCHAR(100) NOT NULL DEFAULT '',
+                    exam_date DATE NOT NULL,
+                    UNIQUE(subject_id, exam_date, name),
+                    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE,
+                    FOREIGN KEY (subject_id) REFERENCES subjects(id) ON DELETE CASCADE
+                );
+            """)
+
+            # Create results table (subject and date live on the exam, referenced by a 4-byte key)
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS results (
                     id SERIAL PRIMARY KEY,
                     student_id INTEGER,
-                    subject VARCHAR(100) NOT NULL,
+                    exam_id INTEGER NOT NULL,
                     marks INTEGER NOT NULL,
                     total_marks INTEGER NOT NULL,
-                    exam_date DATE NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(student_id, subject, exam_date),
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(exam_id, student_id),
                     FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
+                    FOREIGN KEY (exam_id) REFERENCES exams(id) ON DELETE CASCADE,
                     CHECK (marks >= 0)
                 );
             """)
+            # Existing databases predate updated_at, which analytics snapshots use to find changed classes
+            cursor.execute("ALTER TABLE results ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+            migrated = Connect_DB.migrate_results_to_exams(cursor)
             
+            # Create partial aggregates table (one mergeable summary per exam)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS result_aggregates (
+                    exam_id INTEGER PRIMARY KEY,
+                    class_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    mean DOUBLE PRECISION NOT NULL,
+                    m2 DOUBLE PRECISION NOT NULL,
+                    min_value DOUBLE PRECISION,
+                    max_value DOUBLE PRECISION,
+                    histogram INTEGER[] NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (exam_id) REFERENCES exams(id) ON DELETE CASCADE,
+                    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE,
+                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                );
+            """)
+
+            if migrated:
+                cursor.execute("SELECT id FROM users")
+                for user in cursor.fetchall():
+                    backfill_partials(cursor, user['id'])
+
+            # Create background jobs table (queue for the job_worker.py pool)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id SERIAL PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    kind VARCHAR(50) NOT NULL,
+                    params JSONB NOT NULL DEFAULT '{}',
+                    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    result JSONB,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 3,
+                    cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+                    worker VARCHAR(100),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    heartbeat_at TIMESTAMP,
+                    finished_at TIMESTAMP,
+                    CHECK (status IN ('queued', 'running', 'succeeded', 'failed', 'cancelled')),
+                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                );
+            """)
+
+            # Create shared cache table (UNLOGGED: no WAL, emptied after a crash, which a cache can afford)
+            cursor.execute("""
+                CREATE UNLOGGED TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    value BYTEA NOT NULL,
+                    expires_at TIMESTAMP NOT NULL
+                );
+            """)
+
+            # Create class rankings (one row per ranked student with its totals, refreshed when results are published)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS class_rankings (
+                    student_id INTEGER PRIMARY KEY,
+                    class_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    exam_count INTEGER NOT NULL,
+                    percentage DOUBLE PRECISION NOT NULL,
+                    previous_percentage DOUBLE PRECISION,
+                    rank INTEGER NOT NULL,
+                    previous_rank INTEGER,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
+                    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE,
+                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                );
+            """)
+            # Stored so a results write re-ranks from the totals instead of every result
+            cursor.execute("ALTER TABLE class_rankings ADD COLUMN IF NOT EXISTS previous_percentage DOUBLE PRECISION")
+            # Classes with results from before rankings (or stored totals) existed are ranked once here
+            from repositories import RankingRepo
+            rankings = RankingRepo(cursor)
+            for row in rankings.unranked_classes():
+                rankings.refresh(row['class_id'], row['user_id'])
+
+            # Create result cube (per-user rollups of the partial aggregates, see CubeRepo)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS result_cube (
+                    user_id INTEGER NOT NULL,
+                    level VARCHAR(20) NOT NULL,
+                    semester VARCHAR(50),
+                    class_id INTEGER,
+                    subject VARCHAR(100),
+                    exam_date DATE,
+                    count INTEGER NOT NULL,
+                    sum DOUBLE PRECISION NOT NULL,
+                    sum_sq DOUBLE PRECISION NOT NULL,
+                    min_value DOUBLE PRECISION,
+                    max_value DOUBLE PRECISION,
+                    histogram INTEGER[] NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE,
+                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                );
+            """)
+            # One row per slice; columns a level rolls up are NULL, so the key coalesces them.
+            # It is also what dashboard lookups by (user_id, level, semester) read.
+            cursor.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_result_cube_slice ON result_cube (
+                    user_id, level, COALESCE(semester, ''), COALESCE(class_id, 0), COALESCE(subject, ''),
+                    COALESCE(exam_date, DATE '0001-01-01')
+                )
+            """)
+            # Users with partial aggregates from before the cube existed are rolled up once here
+            from repositories import CubeRepo
+            cube = CubeRepo(cursor)
+            for row in cube.uncubed_users():
+                cube.refresh_user(row['user_id'])
+
+            # Create at-risk scores (one row per scored student, written by at_risk.py)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS at_risk (
+                    student_id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    class_id INTEGER NOT NULL,
+                    result_count INTEGER NOT NULL,
+                    percentile DOUBLE PRECISION,
+                    z_score DOUBLE PRECISION,
+                    trend DOUBLE PRECISION,
+                    worst_drop DOUBLE PRECISION,
+                    reasons TEXT[] NOT NULL DEFAULT '{}',
+                    flagged BOOLEAN NOT NULL,
+                    scored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE,
+                    FOREIGN KEY (class_id) REFERENCES classes(id) ON DELETE CASCADE,
+                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                );
+            """)
+
+            # Create at-risk scan state (the partial aggregate version each exam was last scored at)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS at_risk_exams (
+                    exam_id INTEGER PRIMARY KEY,
+                    aggregate_updated_at TIMESTAMP,
+                    FOREIGN KEY (exam_id) REFERENCES exams(id) ON DELETE CASCADE
+                );
+            """)
+
+            # Create circuit breaker trip log (one row per trip, written by the app process once it closes)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS db_breaker_trips (
+                    id SERIAL PRIMARY KEY,
+                    host VARCHAR(255) NOT NULL,
+                    opened_at TIMESTAMP NOT NULL,
+                    closed_at TIMESTAMP NOT NULL,
+                    failures INTEGER NOT NULL,
+                    probes INTEGER NOT NULL,
+                    reason TEXT
+                );
+            """)
+
             # Create indexes for better performance
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_classes_user_id ON classes(user_id)")
+            # Dashboard filters walk classes(user_id, semester) and then exams(class_id, exam_date);
+            # they replace the single-column indexes, which are their leading columns
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_classes_user_id_semester ON classes(user_id, semester)")
+            cursor.execute("DROP INDEX IF EXISTS idx_classes_user_id")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_user_id ON students(user_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_class_id ON students(class_id)")
+            # Enrollment trends read created_at ranges; rows are appended in time order, so a
+            # BRIN index (a few pages of min/max per block range) narrows them almost for free
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_created_at ON students USING BRIN (created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_classes_created_at ON classes USING BRIN (created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_exams_class_id_exam_date ON exams(class_id, exam_date)")
+            cursor.execute("DROP INDEX IF EXISTS idx_exams_class_id")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_student_id ON results(student_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_result_aggregates_user_id ON result_aggregates(user_id)")
+            # Leaderboards read the top of a class's ranking
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_class_rankings_class_id_rank ON class_rankings(class_id, rank)")
+            # The dashboard only lists flagged students
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_at_risk_user_id_flagged ON at_risk(user_id) WHERE flagged")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created_at ON jobs(status, created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user_id_created_at ON jobs(user_id, created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_expires_at ON cache_entries(expires_at)")
             
             connection.commit()
             cursor.close()
@@ -0,0 +1,212 @@
+"""
+Latency budgets, query cancellation and a circuit breaker for page renders.
+
+Budgets: a page calls Connect_DB.use_budget(page) before it queries. Connections it
+opens or borrows then run with statement_timeout set to that page's budget
+(PAGE_BUDGETS_MS, or <PAGE>_BUDGET_MS in the settings), and connecting gives up
+after the budget or DB_CONNECT_TIMEOUT, whichever is shorter. Table creation, job
+workers and the CLIs run outside any page and keep the server's defaults.
+
+Cancellation: on a rerun Streamlit starts the new run straight away and leaves the
+old one to stop at its next st call, which never comes while it waits on a query.
+Connect_DB.begin_run(), first thing in main.py, cancels whatever the session's
+earlier runs still have in flight, so clicking around a slow page doesn't pile up
+one stuck connection per click.
+
+Circuit breaker: connect failures, lost connections and statement timeouts on the
+primary are counted per process. DB_BREAKER_FAILURES of them in a row (default 3)
+open the breaker for DB_BREAKER_COOLDOWN_SECONDS (default 30): connects and pooled
+borrows fail at once with DatabaseUnavailable, the dashboard serves the last
+figures it loaded and other pages show a notice. After the cooldown one probe is
+let through; its success closes the breaker, its failure opens it again. Every
+trip is printed to the server log and written to db_breaker_trips once the
+database is back.
+"""
+import os
+import socket
+import threading
+import time
+import weakref
+from datetime import datetime
+import psycopg2
+from psycopg2.extras import execute_values
+
+# statement_timeout per page, in milliseconds (0 = no limit)
+PAGE_BUDGETS_MS = {
+    "login": 3000,
+    "dashboard": 5000,
+    "add_class": 10000,
+    "results": 5000,
+    "jobs": 3000,
+}
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+# Connections a cancel was sent to; their QueryCanceled is not the database's fault
+_cancelled = weakref.WeakSet()
+
+
+class DatabaseUnavailable(psycopg2.OperationalError):
+    """Raised instead of connecting while the circuit breaker is open"""
+
+
+def is_health_failure(error):
+    """
+    True for errors that say the database is unhealthy: connects that failed,
+    connections that were lost or refused, and statements that ran out of budget
+    """
+    if isinstance(error, DatabaseUnavailable):
+        return False
+    code = getattr(error, "pgcode", None)
+    if code is None:
+        # Raised by libpq itself: the server could not be reached or went away
+        return isinstance(error, psycopg2.OperationalError)
+    # 08 connection exception, 53 insufficient resources, 57 operator intervention (57014 = timeout)
+    return code[:2] in ("08", "53", "57")
+
+
+def was_cancelled(connection):
+    return connection in _cancelled
+
+
+def _send_cancel(connection):
+    try:
+        connection.cancel()
+    except psycopg2.Error:
+        pass
+
+
+class CircuitBreaker:
+    """
+    Process-wide and thread-safe. A trip lasts from opening to the next statement
+    that succeeds; finished trips wait in pending until they are written out.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.trip = None
+        self.pending = []
+        self._opened_until = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if the database may be tried now; after the cooldown, lets one probe through"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now >= self._opened_until:
+                self.state = HALF_OPEN
+            # A probe that never reported back (its page stopped) gives way after a cooldown
+            if self.state == HALF_OPEN and (self._probe_started is None or now - self._probe_started >= self.cooldown):
+                self._probe_started = now
+                return True
+            return False
+
+    def unavailable(self):
+        """The error raised while the breaker refuses requests"""
+        with self._lock:
+            wait = max(1, round(self._opened_until - time.monotonic()))
+        return DatabaseUnavailable(f"The database is not responding; trying again in {wait}s.")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            # Statements that started before the trip don't count; only the probe can close it
+            if self.state != HALF_OPEN:
+                return
+            self.state = CLOSED
+            self._probe_started = None
+            trip, self.trip = self.trip, None
+            trip["closed_at"] = datetime.now()
+            self.pending.append(trip)
+        seconds = (trip["closed_at"] - trip["opened_at"]).total_seconds()
+        print(f"[db] circuit breaker closed after {seconds:.0f}s ({trip['probes']} failed probe(s))", flush=True)
+
+    def record_failure(self, error):
+        if not is_health_failure(error):
+            return
+        reason = str(error).strip().splitlines()[0][:200] if str(error).strip() else type(error).__name__
+        with self._lock:
+            self.failures += 1
+            if self.state == OPEN or (self.state == CLOSED and self.failures < self.threshold):
+                return
+            if self.state == HALF_OPEN:
+                self.trip["probes"] += 1
+            else:
+                self.trips += 1
+                self.trip = {"opened_at": datetime.now(), "failures": self.failures, "probes": 0, "reason": reason}
+            self.state = OPEN
+            self._probe_started = None
+            self._opened_until = time.monotonic() + self.cooldown
+            failures = self.failures
+        print(f"[db] circuit breaker open after {failures} failure(s): {reason}; "
+              f"retrying in {self.cooldown:.0f}s", flush=True)
+
+    def take_pending(self):
+        with self._lock:
+            trips, self.pending = self.pending, []
+        return trips
+
+    def requeue(self, trips):
+        """Puts back trips that could not be written, to try again later"""
+        with self._lock:
+            self.pending[:0] = trips
+
+
+def record_trips(cursor, trips):
+    """Writes finished breaker trips of this process to db_breaker_trips"""
+    host = f"{socket.gethostname()}:{os.getpid()}"
+    execute_values(cursor, """
+        INSERT INTO db_breaker_trips (host, opened_at, closed_at, failures, probes, reason) VALUES %s
+    """, [
+        (host, trip["opened_at"], trip["closed_at"], trip["failures"], trip["probes"], trip["reason"])
+        for trip in trips
+    ])
+
+
+class SessionGuard:
+    """
+    One per session: the statement timeout of the page being rendered, and the
+    connections the session's runs are using, tagged with the run that took them,
+    so a new run can cancel what earlier runs left in flight.
+    """
+
+    def __init__(self):
+        self.run = 0
+        self.timeout_ms = None
+        self.cancelled = 0
+        self._connections = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def begin_run(self):
+        """Starts a new run without a budget and cancels earlier runs' queries; returns how many"""
+        with self._lock:
+            self.run += 1
+            self.timeout_ms = None
+            stale = [connection for connection, run in self._connections.items() if run < self.run]
+            for connection in stale:
+                del self._connections[connection]
+                if not connection.closed:
+                    _cancelled.add(connection)
+        stale = [connection for connection in stale if not connection.closed]
+        # PQcancel opens its own connection to the server; don't make the new run wait on it
+        for connection in stale:
+            threading.Thread(target=_send_cancel, args=(connection,), name="laytics-cancel", daemon=True).start()
+        self.cancelled += len(stale)
+        return len(stale)
+
+    def track(self, connection):
+        with self._lock:
+            self._connections[connection] = self.run
+
+    def release(self, connection):
+        """Stops tracking a connection; True if a cancel was sent to it, so it must not be reused"""
+        with self._lock:
+            self._connections.pop(connection, None)
+        return connection in _cancelled
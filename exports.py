@@ -0,0 +1,323 @@
+import csv
+import math
+import os
+import shutil
+import tempfile
+import uuid
+import weakref
+import psycopg2
+import psycopg2.extensions
+import streamlit as st
+from db_connection import Connect_DB
+
+# Rows fetched per round trip from the server-side cursor and written per chunk
+CHUNK_SIZE = 5000
+
+# Largest file offered straight from the page; bigger exports move to Background Jobs
+EXPORT_INLINE_BYTES = 25 * 1024 * 1024
+
+# Rows in one xlsx sheet, header included; longer exports continue on further sheets
+XLSX_MAX_ROWS = 1048576
+
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+EXPORT_COLUMNS = [
+    "class_name", "semester", "roll_no", "name", "subject",
+    "exam", "exam_date", "marks", "total_marks", "percentage",
+]
+
+EXPORT_QUERY = """
+    SELECT c.class_name, c.semester, s.roll_no, s.name, sb.name,
+           e.name, e.exam_date, r.marks, r.total_marks,
+           ROUND(r.marks::numeric / NULLIF(r.total_marks, 0) * 100, 2)::float AS percentage
+    FROM results r
+    JOIN exams e ON r.exam_id = e.id
+    JOIN subjects sb ON e.subject_id = sb.id
+    JOIN students s ON r.student_id = s.id
+    JOIN classes c ON e.class_id = c.id
+    WHERE {where}
+    ORDER BY c.class_name, c.id, e.exam_date, sb.name_key, e.name, s.roll_no
+"""
+
+
+class ResultsExporter:
+    """
+    Streams results out of PostgreSQL through a named (server-side) cursor and
+    writes them chunk by chunk, so memory use stays flat however many rows match.
+    Archived classes in scope follow the live rows, read from their Parquet files.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @staticmethod
+    def build_scope(user_id, class_id=None, exam_id=None):
+        """Returns the WHERE clause and parameters for a user, class or exam export"""
+        conditions = ["c.user_id = %s"]
+        params = [user_id]
+        if class_id is not None:
+            conditions.append("c.id = %s")
+            params.append(class_id)
+        if exam_id is not None:
+            conditions.append("r.exam_id = %s")
+            params.append(exam_id)
+        return " AND ".join(conditions), params
+
+    def iter_chunks(self, user_id, class_id=None, exam_id=None):
+        """Yields lists of row tuples (in EXPORT_COLUMNS order) from a server-side cursor"""
+        where, params = self.build_scope(user_id, class_id, exam_id)
+        cursor = self.connection.cursor(
+            name=f"export_{uuid.uuid4().hex}",
+            cursor_factory=psycopg2.extensions.cursor
+        )
+        cursor.itersize = CHUNK_SIZE
+        try:
+            cursor.execute(EXPORT_QUERY.format(where=where), params)
+            while True:
+                rows = cursor.fetchmany(CHUNK_SIZE)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+        from archive import iter_archived_chunks
+
+        yield from iter_archived_chunks(user_id, class_id, exam_id, CHUNK_SIZE)
+
+    def write(self, export_format, path, **scope):
+        """Writes the export to path and returns the number of rows written"""
+        return self.write_chunks(export_format, path, self.iter_chunks(**scope))
+
+    def write_chunks(self, export_format, path, chunks):
+        """Writes already-fetched row chunks in the given format; returns the row count"""
+        writers = {
+            "csv": self._write_csv,
+            "parquet": self._write_parquet,
+            "xlsx": self._write_xlsx,
+        }
+        return writers[export_format](path, chunks)
+
+    def _write_csv(self, path, chunks):
+        total = 0
+        with open(path, "w", newline="", encoding="utf-8") as handle:
+            writer = csv.writer(handle)
+            writer.writerow(EXPORT_COLUMNS)
+            for rows in chunks:
+                writer.writerows(rows)
+                total += len(rows)
+        return total
+
+    def _write_parquet(self, path, chunks):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([
+            ("class_name", pa.string()),
+            ("semester", pa.string()),
+            ("roll_no", pa.string()),
+            ("name", pa.string()),
+            ("subject", pa.string()),
+            ("exam", pa.string()),
+            ("exam_date", pa.date32()),
+            ("marks", pa.int32()),
+            ("total_marks", pa.int32()),
+            ("percentage", pa.float64()),
+        ])
+        total = 0
+        with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+            for rows in chunks:
+                columns = list(zip(*rows))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                    schema=schema
+                ))
+                total += len(rows)
+        return total
+
+    def _write_xlsx(self, path, chunks):
+        import xlsxwriter
+
+        # constant_memory flushes each row to disk as soon as the next one starts
+        workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        date_format = workbook.add_format({"num_format": "yyyy-mm-dd"})
+
+        def add_sheet():
+            # xlsxwriter ignores rows past the sheet limit instead of raising, so a full sheet
+            # continues on "Results 2", "Results 3", ...
+            sheets = len(workbook.worksheets())
+            sheet = workbook.add_worksheet(f"Results {sheets + 1}" if sheets else "Results")
+            sheet.write_row(0, 0, EXPORT_COLUMNS)
+            return sheet
+
+        worksheet = add_sheet()
+        line = 0
+        total = 0
+        try:
+            for rows in chunks:
+                for row in rows:
+                    if line == XLSX_MAX_ROWS - 1:
+                        worksheet = add_sheet()
+                        line = 0
+                    line += 1
+                    total += 1
+                    worksheet.write_row(line, 0, row[:6])
+                    worksheet.write_datetime(line, 6, row[6], date_format)
+                    worksheet.write_row(line, 7, row[7:])
+        finally:
+            workbook.close()
+        return total
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class PreparedExport:
+    """
+    An export file written for one session. The file is deleted when it is replaced,
+    and otherwise once the session ends and its state (with this object) is collected.
+    """
+
+    def __init__(self, path, file_name, mime, rows):
+        self.path = path
+        self.file_name = file_name
+        self.mime = mime
+        self.rows = rows
+        self._cleanup = weakref.finalize(self, _remove_file, path)
+
+    def discard(self):
+        self._cleanup()
+
+
+def file_reader(path):
+    """
+    Returns a callable for st.download_button's data. The file is read only when
+    the button is clicked, not into server memory on every render.
+    """
+    def read():
+        with open(path, "rb") as handle:
+            return handle.read()
+    return read
+
+
+def export_file_name(label, export_format):
+    safe_label = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in label).strip("_")
+    return f"{safe_label or 'results'}.{export_format}"
+
+
+def hand_over_to_jobs(path, file_name, mime, rows, user_id, export_format, label, scope):
+    """
+    Moves a finished export that is too large for the page into the job output
+    directory and records it as a succeeded export job. Returns the job id.
+    """
+    from jobs import JobQueue, job_output_dir
+
+    target = os.path.join(job_output_dir(), f"export_{uuid.uuid4().hex}_{file_name}")
+    shutil.move(path, target)
+    connection = Connect_DB.get_connection()
+    if not connection:
+        os.remove(target)
+        raise psycopg2.OperationalError("Database connection failed.")
+    try:
+        params = {"format": export_format, "label": label}
+        params.update(scope)
+        job_id = JobQueue.record_finished(
+            connection.cursor(), user_id, "export", params,
+            {"path": target, "file_name": file_name, "mime": mime, "rows": rows},
+            f"{rows} rows exported"
+        )
+        connection.commit()
+        return job_id
+    except psycopg2.Error:
+        os.remove(target)
+        raise
+    finally:
+        connection.close()
+
+
+def render_export_controls(key, label, user_id, **scope):
+    """
+    Renders format selection, a button that writes the export to a temporary file,
+    and a download button for the finished file. The file path is kept in session
+    state so the download survives the rerun triggered by clicking it.
+    """
+    state_key = f"export_file_{key}"
+    format_name = st.selectbox("Format", list(EXPORT_FORMATS), key=f"export_format_{key}")
+    export_format, mime = EXPORT_FORMATS[format_name]
+
+    col1, col2 = st.columns(2)
+    with col1:
+        prepare = st.button("Prepare Export", key=f"export_button_{key}")
+    with col2:
+        background = st.button("Export in Background", key=f"export_job_{key}",
+                               help="Large exports run on the job workers; follow them on the Background Jobs page")
+
+    if background:
+        from jobs import JobQueue
+
+        connection = Connect_DB.get_connection()
+        if not connection:
+            st.error("Database connection failed.")
+            return
+        try:
+            cursor = connection.cursor()
+            params = {"format": export_format, "label": label}
+            params.update(scope)
+            job_id = JobQueue.submit(cursor, user_id, "export", params)
+            connection.commit()
+            st.success(f"Export job #{job_id} queued. Download it from Background Jobs when it finishes.")
+        except psycopg2.Error as e:
+            st.error(f"Error queuing export: {e}")
+        finally:
+            connection.close()
+
+    if prepare:
+        previous = st.session_state.pop(state_key, None)
+        if previous:
+            previous.discard()
+
+        connection = Connect_DB.get_connection(readonly=True)
+        if not connection:
+            st.error("Database connection failed.")
+            return
+
+        handle, path = tempfile.mkstemp(prefix="laytics_export_", suffix=f".{export_format}")
+        os.close(handle)
+        try:
+            with st.spinner("Exporting results..."):
+                rows = ResultsExporter(connection).write(export_format, path, user_id=user_id, **scope)
+            file_name = export_file_name(label, export_format)
+            if os.path.getsize(path) > int(Connect_DB.get_setting("EXPORT_INLINE_BYTES", EXPORT_INLINE_BYTES)):
+                job_id = hand_over_to_jobs(path, file_name, mime, rows, user_id, export_format, label, scope)
+                st.info(f"This export is too large to download here. It was saved as job #{job_id}; "
+                        "download it from Background Jobs.")
+            else:
+                st.session_state[state_key] = PreparedExport(path, file_name, mime, rows)
+        except ImportError as e:
+            os.remove(path)
+            st.error(f"{format_name} export needs an extra package: {e.name}. Add it to your environment.")
+        except psycopg2.Error as e:
+            _remove_file(path)
+            st.error(f"Error exporting results: {e}")
+        finally:
+            connection.close()
+
+    prepared = st.session_state.get(state_key)
+    if prepared and os.path.exists(prepared.path):
+        sheets = math.ceil(prepared.rows / (XLSX_MAX_ROWS - 1)) if prepared.path.endswith(".xlsx") else 1
+        st.caption(f"{prepared.rows} rows ready" + (f", continued over {sheets} sheets" if sheets > 1 else ""))
+        st.download_button(
+            f"Download {prepared.file_name}",
+            data=file_reader(prepared.path),
+            file_name=prepared.file_name,
+            mime=prepared.mime,
+            key=f"export_download_{key}"
+        )
@@ -0,0 +1,119 @@
+"""
+Process-wide cache of Plotly figures, keyed by what they were built from.
+
+Building a figure with Plotly Express costs tens of milliseconds, and pages
+rebuild the same ones on every rerun. cached_figure(build, **inputs) fingerprints
+the builder and its inputs (the chart's data and options, as plain lists, strings
+and numbers), and builds only when that fingerprint is new:
+
+    fig = cached_figure(class_distribution_figure, class_names=names, student_counts=counts)
+
+Figures are kept as the JSON Plotly serializes them to, in an LRU capped at
+FIGURE_CACHE_MAX_BYTES (default 32 MiB). A hit turns the JSON back into a Figure
+without validating it again, which is what makes a hit cheap: the JSON came from
+a Figure that Plotly had already validated. Builders must be module-level
+functions that depend on their arguments only.
+"""
+import hashlib
+import json
+import threading
+import weakref
+from collections import OrderedDict
+import streamlit as st
+from db_connection import Connect_DB
+from metrics import counter, gauge
+
+MIB = 1024 * 1024
+
+# Every FigureCache of this process, for the metrics
+_caches = weakref.WeakSet()
+
+
+def fingerprint(build, inputs):
+    """sha256 of the builder's name and its inputs; values json can't encode are hashed by str()"""
+    payload = json.dumps(
+        [build.__module__, build.__qualname__, inputs], sort_keys=True, default=str, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class FigureCache:
+    """Thread-safe LRU of fingerprint -> figure JSON, capped by total bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total = 0
+        _caches.add(self)
+
+    def get(self, key):
+        """Returns the stored JSON, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key, spec):
+        """Stores figure JSON; specs larger than the whole cache are not kept"""
+        size = len(spec.encode())
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (spec, size)
+            self._total += size
+            while self._total > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._total -= evicted
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total = 0
+
+    @property
+    def total(self):
+        return self._total
+
+
+@st.cache_resource
+def get_figure_cache():
+    return FigureCache(max_bytes=int(Connect_DB.get_setting("FIGURE_CACHE_MAX_BYTES", 32 * MIB)))
+
+
+def cached_figure(build, **inputs):
+    """Returns build(**inputs), reusing the figure built earlier from the same inputs"""
+    import plotly.graph_objects as go
+    import plotly.io as pio
+
+    cache = get_figure_cache()
+    key = fingerprint(build, inputs)
+    spec = cache.get(key)
+    if spec is None:
+        spec = pio.to_json(build(**inputs), validate=False)
+        cache.put(key, spec)
+    # Already validated when it was built; validating again costs as much as building.
+    # Misses return the stored copy too, so the spec Streamlit sends (and the chart's
+    # element id, which hashes it) is the same on every run.
+    return go.Figure(json.loads(spec), _validate=False)
+
+
+def _cache_stat(name):
+    return lambda: [({}, sum(cache.stats[name] for cache in list(_caches)))]
+
+
+counter("laytics_figure_cache_hits_total", "Figures served from the figure cache", collect=_cache_stat("hits"))
+counter("laytics_figure_cache_misses_total", "Figures built because the cache had no copy", collect=_cache_stat("misses"))
+counter("laytics_figure_cache_evictions_total", "Figures dropped to stay under FIGURE_CACHE_MAX_BYTES",
+        collect=_cache_stat("evictions"))
+gauge("laytics_figure_cache_bytes", "Bytes of figure JSON held by the figure cache",
+      collect=lambda: [({}, sum(cache.total for cache in list(_caches)))])
@@ -0,0 +1,16 @@
+# Lowest percentage for each grade, checked from the top down
+GRADE_BOUNDARIES = [
+    (90, "A+"),
+    (80, "A"),
+    (70, "B+"),
+    (60, "B"),
+    (50, "C+"),
+    (40, "C"),
+]
+
+
+def calculate_grade(percentage):
+    for minimum, grade in GRADE_BOUNDARIES:
+        if percentage >= minimum:
+            return grade
+    return "F"
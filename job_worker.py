@@ -0,0 +1,137 @@
+"""
+Background worker pool for the jobs table.
+
+    python job_worker.py --workers 4
+
+Each worker process keeps two connections: an autocommit control connection for
+claiming jobs and reporting progress, and a work connection the handler runs its
+transaction on. DATABASE_URL is read from .streamlit/secrets.toml or the environment.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from db_connection import Connect_DB
+from jobs import Job, JobQueue, run_job
+import analytics  # noqa: F401  registers the analytics_snapshot job handler
+import archive  # noqa: F401  registers the archive_semester and restore_class job handlers
+import at_risk  # noqa: F401  registers the at_risk_scan job handler
+import report_cards  # noqa: F401  registers the report_cards job handler
+
+# Seconds to wait before polling again when the queue is empty
+POLL_INTERVAL = 2.0
+
+# Longest wait between reconnect attempts while the database is down
+MAX_BACKOFF = 60.0
+
+# How often a sleeping worker checks whether it should stop
+STOP_CHECK_INTERVAL = 0.5
+
+
+def connect(database_url, autocommit=False):
+    connection = psycopg2.connect(
+        database_url,
+        cursor_factory=RealDictCursor,
+        sslmode=Connect_DB.get_setting("DB_SSLMODE", "require")
+    )
+    connection.autocommit = autocommit
+    return connection
+
+
+def pause(stopping, seconds):
+    """Sleeps for up to seconds, waking early once the stop flag is set"""
+    deadline = time.monotonic() + seconds
+    while not stopping.value and time.monotonic() < deadline:
+        time.sleep(max(0, min(STOP_CHECK_INTERVAL, deadline - time.monotonic())))
+
+
+def worker_loop(index, database_url, poll_interval, stopping):
+    # Only the parent handles SIGINT/SIGTERM and sets the stop flag. The flag is a lock-free
+    # shared byte: a worker killed while waiting on a multiprocessing.Event leaves the
+    # event's condition behind, and the parent's set() would then block forever
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    worker_name = f"{socket.gethostname()}:{os.getpid()}:{index}"
+    control = work = None
+    backoff = poll_interval
+    print(f"[{worker_name}] started", flush=True)
+
+    while not stopping.value:
+        try:
+            if control is None or control.closed or work.closed:
+                close_all(control, work)
+                control = connect(database_url, autocommit=True)
+                work = connect(database_url)
+            backoff = poll_interval
+
+            cursor = control.cursor()
+            row = JobQueue.claim(cursor, worker_name)
+            cursor.close()
+            if row is None:
+                pause(stopping, poll_interval)
+                continue
+
+            job = Job(row, control)
+            started = time.perf_counter()
+            status = run_job(job, work)
+            print(f"[{worker_name}] job {job.id} ({job.kind}) {status} in {time.perf_counter() - started:.1f}s", flush=True)
+
+        except psycopg2.Error as e:
+            # Lost the database (or a connection is broken): drop both, back off and reconnect
+            print(f"[{worker_name}] database unavailable, retrying in {backoff:g}s: {e}", flush=True)
+            close_all(control, work)
+            control = work = None
+            pause(stopping, backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    close_all(control, work)
+
+
+def close_all(*connections):
+    for connection in connections:
+        if connection is not None and not connection.closed:
+            connection.close()
+
+
+def start_worker(index, database_url, poll_interval, stopping):
+    process = multiprocessing.Process(target=worker_loop, args=(index, database_url, poll_interval, stopping))
+    process.start()
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run background job workers")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    args = parser.parse_args()
+
+    database_url = Connect_DB.get_database_url()
+    stopping = multiprocessing.RawValue("b", 0)
+
+    def stop(signum, frame):
+        stopping.value = 1
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    processes = [
+        start_worker(index, database_url, args.poll_interval, stopping)
+        for index in range(args.workers)
+    ]
+    # A worker that died (killed, or crashed outside a job) is replaced
+    while not stopping.value:
+        pause(stopping, args.poll_interval)
+        for index, process in enumerate(processes):
+            if not process.is_alive() and not stopping.value:
+                print(f"worker {index} exited with code {process.exitcode}; restarting", flush=True)
+                processes[index] = start_worker(index, database_url, args.poll_interval, stopping)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import json
+import os
+from psycopg2.extras import Json, execute_values
+from db_connection import Connect_DB
+from exports import ResultsExporter, export_file_name, EXPORT_FORMATS
+from shared_cache import invalidate_user
+from live_updates import publish_change
+
+# Running jobs whose worker has not sent a heartbeat for this long are reclaimed
+STALE_AFTER_SECONDS = 300
+
+ACTIVE_STATUSES = ("queued", "running")
+
+# kind -> handler(job, connection); filled by @register_job
+JOB_HANDLERS = {}
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler when the user has asked for the job to stop"""
+
+
+def register_job(kind):
+    def decorator(handler):
+        JOB_HANDLERS[kind] = handler
+        return handler
+    return decorator
+
+
+def job_output_dir():
+    path = Connect_DB.get_setting("JOB_OUTPUT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_output"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class JobQueue:
+    """
+    Submission and status API over the jobs table. The UI only ever inserts and
+    reads rows here; the work itself happens in job_worker.py processes.
+    """
+
+    @staticmethod
+    def submit(cursor, user_id, kind, params, max_attempts=3):
+        cursor.execute(
+            """INSERT INTO jobs (user_id, kind, params, max_attempts)
+               VALUES (%s, %s, %s, %s) RETURNING id""",
+            (user_id, kind, Json(params), max_attempts)
+        )
+        return cursor.fetchone()['id']
+
+    @staticmethod
+    def record_finished(cursor, user_id, kind, params, result, message=None):
+        """Stores output the app already produced as a succeeded job, so it is downloaded like a worker's"""
+        cursor.execute(
+            """INSERT INTO jobs (user_id, kind, params, status, progress, message, result, finished_at)
+               VALUES (%s, %s, %s, 'succeeded', 1, %s, %s, CURRENT_TIMESTAMP) RETURNING id""",
+            (user_id, kind, Json(params), message, Json(result))
+        )
+        return cursor.fetchone()['id']
+
+    @staticmethod
+    def list_for_user(cursor, user_id, limit=50):
+        cursor.execute(
+            """SELECT id, kind, params, status, progress, message, result, attempts, max_attempts,
+                      cancel_requested, created_at, started_at, finished_at
+               FROM jobs WHERE user_id = %s
+               ORDER BY created_at DESC LIMIT %s""",
+            (user_id, limit)
+        )
+        return cursor.fetchall()
+
+    @staticmethod
+    def cancel(cursor, user_id, job_id):
+        """Cancels a queued job immediately and asks a running one to stop at its next progress report"""
+        cursor.execute(
+            """UPDATE jobs
+               SET status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                   finished_at = CASE WHEN status = 'queued' THEN CURRENT_TIMESTAMP ELSE finished_at END,
+                   cancel_requested = TRUE
+               WHERE id = %s AND user_id = %s AND status IN ('queued', 'running')""",
+            (job_id, user_id)
+        )
+        return cursor.rowcount > 0
+
+    @staticmethod
+    def retry(cursor, user_id, job_id):
+        """Re-queues a failed or cancelled job with a fresh attempt budget"""
+        cursor.execute(
+            """UPDATE jobs
+               SET status = 'queued', progress = 0, message = NULL, result = NULL, attempts = 0,
+                   cancel_requested = FALSE, started_at = NULL, finished_at = NULL, worker = NULL
+               WHERE id = %s AND user_id = %s AND status IN ('failed', 'cancelled')""",
+            (job_id, user_id)
+        )
+        return cursor.rowcount > 0
+
+    @staticmethod
+    def claim(cursor, worker_name):
+        """
+        Atomically takes the oldest queued job (or a running job whose worker stopped
+        sending heartbeats and has attempts left). SKIP LOCKED lets many workers poll
+        without blocking each other.
+        """
+        JobQueue.fail_exhausted(cursor)
+        cursor.execute(
+            """UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = %s,
+                      started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+               WHERE id = (
+                   SELECT id FROM jobs
+                   WHERE status = 'queued'
+                      OR (status = 'running' AND attempts < max_attempts
+                          AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                   ORDER BY created_at
+                   LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING id, user_id, kind, params, attempts, max_attempts""",
+            (worker_name, STALE_AFTER_SECONDS)
+        )
+        return cursor.fetchone()
+
+    @staticmethod
+    def fail_exhausted(cursor):
+        """
+        Fails stale running jobs that have used up their attempts: a job that keeps
+        killing its worker would otherwise be reclaimed forever
+        """
+        cursor.execute(
+            """UPDATE jobs SET status = 'failed', finished_at = CURRENT_TIMESTAMP, worker = NULL,
+                      message = 'Worker stopped responding on the last attempt'
+               WHERE id IN (
+                   SELECT id FROM jobs
+                   WHERE status = 'running' AND attempts >= max_attempts
+                     AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                   FOR UPDATE SKIP LOCKED
+               )""",
+            (STALE_AFTER_SECONDS,)
+        )
+        return cursor.rowcount
+
+
+class Job:
+    """
+    A claimed job as seen by its handler. Progress and completion are written on the
+    worker's autocommit control connection, so they are visible to the UI while the
+    handler's own transaction is still open.
+    """
+
+    def __init__(self, row, control_connection):
+        self.id = row['id']
+        self.user_id = row['user_id']
+        self.kind = row['kind']
+        self.params = row['params']
+        self.attempts = row['attempts']
+        self.max_attempts = row['max_attempts']
+        self.control_connection = control_connection
+
+    def report(self, progress, message=None):
+        """Stores progress (0..1) and raises JobCancelled if cancellation was requested"""
+        cursor = self.control_connection.cursor()
+        cursor.execute(
+            """UPDATE jobs SET progress = %s, message = COALESCE(%s, message), heartbeat_at = CURRENT_TIMESTAMP
+               WHERE id = %s RETURNING cancel_requested""",
+            (min(max(progress, 0.0), 1.0), message, self.id)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        if row and row['cancel_requested']:
+            raise JobCancelled()
+
+    def finish(self, status, message=None, result=None):
+        cursor = self.control_connection.cursor()
+        cursor.execute(
+            """UPDATE jobs SET status = %s, message = %s, result = %s,
+                      progress = CASE WHEN %s = 'succeeded' THEN 1 ELSE progress END,
+                      finished_at = CURRENT_TIMESTAMP
+               WHERE id = %s""",
+            (status, message, Json(result) if result is not None else None, status, self.id)
+        )
+        cursor.close()
+
+    def requeue(self, message):
+        """Puts a failed attempt back in the queue for another worker to pick up"""
+        cursor = self.control_connection.cursor()
+        cursor.execute(
+            "UPDATE jobs SET status = 'queued', message = %s, worker = NULL WHERE id = %s",
+            (message, self.id)
+        )
+        cursor.close()
+
+
+@register_job("export")
+def run_export_job(job, connection):
+    """params: format, label and optional class_id / exam_id"""
+    params = job.params
+    scope = {key: params[key] for key in ("class_id", "exam_id") if params.get(key) is not None}
+    where, where_params = ResultsExporter.build_scope(job.user_id, **scope)
+
+    cursor = connection.cursor()
+    cursor.execute(
+        f"""SELECT COUNT(*) AS total FROM results r
+            JOIN exams e ON r.exam_id = e.id
+            JOIN classes c ON e.class_id = c.id
+            WHERE {where}""",
+        where_params
+    )
+    total = cursor.fetchone()['total']
+    cursor.close()
+
+    from archive import archived_result_count
+
+    total = (total + archived_result_count(job.user_id, **scope)) or 1
+
+    export_format = params["format"]
+    file_name = export_file_name(params.get("label", "results"), export_format)
+    path = os.path.join(job_output_dir(), f"job_{job.id}_{file_name}")
+    exporter = ResultsExporter(connection)
+
+    def tracked_chunks():
+        written = 0
+        for rows in exporter.iter_chunks(job.user_id, **scope):
+            written += len(rows)
+            job.report(written / total, f"{written} of {total} rows")
+            yield rows
+
+    try:
+        rows = exporter.write_chunks(export_format, path, tracked_chunks())
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    mime = next(mime for fmt, mime in EXPORT_FORMATS.values() if fmt == export_format)
+    return {"path": path, "file_name": file_name, "mime": mime, "rows": rows}
+
+
+# Students inserted per round trip during bulk imports
+IMPORT_BATCH_SIZE = 1000
+
+
+@register_job("import_class")
+def run_import_class_job(job, connection):
+    """params: class_name, semester, students as [[roll_no, name], ...]"""
+    params = job.params
+    students = [(str(roll_no).strip(), str(name).strip()) for roll_no, name in params["students"]]
+    students = [student for student in students if student[0] and student[1]]
+    if not students:
+        raise ValueError("No valid students to import")
+
+    cursor = connection.cursor()
+    cursor.execute(
+        "INSERT INTO classes (class_name, semester, total_students, user_id) VALUES (%s, %s, %s, %s) RETURNING id",
+        (params["class_name"], params["semester"], len(students), job.user_id)
+    )
+    class_id = cursor.fetchone()['id']
+
+    for start in range(0, len(students), IMPORT_BATCH_SIZE):
+        batch = students[start:start + IMPORT_BATCH_SIZE]
+        execute_values(
+            cursor,
+            "INSERT INTO students (class_id, roll_no, name, user_id) VALUES %s",
+            [(class_id, roll_no, name, job.user_id) for roll_no, name in batch]
+        )
+        job.report((start + len(batch)) / len(students), f"{start + len(batch)} of {len(students)} students")
+
+    # Nothing is visible until the whole roster is in, so a cancelled or failed import leaves no partial class
+    publish_change(cursor, job.user_id, "classes", class_id=class_id)
+    connection.commit()
+    cursor.close()
+    invalidate_user(job.user_id, "classes")
+    return {"class_id": class_id, "students": len(students)}
+
+
+def _rollback(connection):
+    # A connection the server dropped is already closed; its transaction is gone with it
+    if not connection.closed:
+        connection.rollback()
+
+
+def run_job(job, connection):
+    """Runs a claimed job's handler and records the outcome; returns the final status"""
+    handler = JOB_HANDLERS.get(job.kind)
+    if handler is None:
+        job.finish("failed", f"Unknown job kind: {job.kind}")
+        return "failed"
+
+    try:
+        result = handler(job, connection)
+        connection.commit()
+        job.finish("succeeded", "Done", result)
+        return "succeeded"
+    except JobCancelled:
+        _rollback(connection)
+        job.finish("cancelled", "Cancelled")
+        return "cancelled"
+    except Exception as e:
+        _rollback(connection)
+        message = f"{type(e).__name__}: {e}"
+        if job.attempts < job.max_attempts:
+            job.requeue(f"Attempt {job.attempts} failed, retrying: {message}")
+            return "queued"
+        job.finish("failed", message)
+        return "failed"
+
+
+def job_summary(job):
+    """One-line description of a job for the jobs page"""
+    params = job['params'] or {}
+    if job['kind'] == "export":
+        return f"Export {params.get('label', 'results')} ({params.get('format', '').upper()})"
+    if job['kind'] == "import_class":
+        return f"Import class {params.get('class_name', '')} ({len(params.get('students', []))} students)"
+    if job['kind'] == "report_cards":
+        classes = params.get("class_ids")
+        return f"Report cards for {f'{len(classes)} class(es)' if classes else 'all classes'}"
+    if job['kind'] == "archive_semester":
+        return f"Archive semester {params.get('semester', '')}"
+    if job['kind'] == "restore_class":
+        return f"Restore archived class #{params.get('class_id', '')}"
+    if job['kind'] == "analytics_snapshot":
+        return f"{'Full' if params.get('full') else 'Incremental'} analytics snapshot"
+    if job['kind'] == "at_risk_scan":
+        return f"{'Full' if params.get('full') else 'Incremental'} at-risk scan"
+    return f"{job['kind']} {json.dumps(params)[:60]}"
@@ -0,0 +1,143 @@
+"""
+Live dashboard refresh over PostgreSQL LISTEN/NOTIFY.
+
+Writers call publish_change() inside the transaction that changes a user's classes
+or results; PostgreSQL delivers the event on commit. Each app process runs one
+ChangeListener thread on a dedicated connection that LISTENs on the channel, drops
+the cached copies of the affected dashboard datasets and bumps a
+per-user version. Open dashboards compare versions in memory, so the database
+sees no polling at all, and rerun only when something of theirs changed: the
+sections showing it where they can (see rerun_fragments), or else the page.
+
+Settings: LIVE_UPDATES (default true), LIVE_CHECK_SECONDS (default 2).
+"""
+import json
+import select
+import threading
+import time
+from collections import defaultdict
+import psycopg2
+import streamlit as st
+from db_connection import Connect_DB
+from repositories import EventRepo
+from shared_cache import get_shared_cache, invalidate_user
+
+CHANNEL = "laytics_changes"
+
+# Seconds to wait before reconnecting after the listener connection drops
+RECONNECT_SECONDS = 5
+
+# How often an open dashboard compares its versions with the listener's (in memory only)
+LIVE_CHECK_SECONDS = float(Connect_DB.get_setting("LIVE_CHECK_SECONDS", 2))
+
+
+def publish_change(cursor, user_id, change, **detail):
+    """Queues a change event ("classes", "results" or "at_risk") to be sent when the transaction commits"""
+    EventRepo(cursor).notify(CHANNEL, json.dumps({"user_id": user_id, "change": change, **detail}))
+
+
+def live_updates_enabled():
+    return str(Connect_DB.get_setting("LIVE_UPDATES", "true")).lower() not in ("0", "false", "no", "off")
+
+
+class ChangeListener:
+    """
+    One per process. Versions are kept per (user_id, change); the epoch is bumped on
+    every (re)connect, since events sent while disconnected are lost and every open
+    dashboard must refresh once to catch up.
+    """
+
+    def __init__(self, database_url, cache):
+        self.database_url = database_url
+        self.cache = cache
+        self.epoch = 0
+        self.connected = False
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="laytics-change-listener", daemon=True)
+        self._thread.start()
+
+    def versions(self, user_id):
+        """Current (epoch, {change: version}) for a user; cheap, never touches the database"""
+        with self._lock:
+            return self.epoch, {change: version for (owner, change), version in self._versions.items() if owner == user_id}
+
+    def _run(self):
+        while True:
+            connection = None
+            try:
+                connection = Connect_DB._connect(self.database_url)
+                connection.autocommit = True
+                cursor = connection.cursor()
+                cursor.execute(f"LISTEN {CHANNEL}")
+                cursor.close()
+                # Anything cached while disconnected may have missed its invalidation
+                self.cache.clear_local()
+                with self._lock:
+                    self.epoch += 1
+                    self.connected = True
+
+                while True:
+                    # Block until the server sends something; the timeout only bounds how
+                    # long a dead connection can go unnoticed
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        connection.poll()
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self._handle(connection.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError, ValueError):
+                with self._lock:
+                    self.connected = False
+                if connection is not None and not connection.closed:
+                    connection.close()
+                time.sleep(RECONNECT_SECONDS)
+
+    def _handle(self, payload):
+        try:
+            event = json.loads(payload)
+            user_id, change = event["user_id"], event["change"]
+        except (ValueError, KeyError, TypeError):
+            return
+        # Runs after the commit on every replica, so no replica keeps (or re-shares) a stale copy
+        invalidate_user(user_id, change, cache=self.cache)
+        with self._lock:
+            self._versions[(user_id, change)] += 1
+
+
+@st.cache_resource(show_spinner=False)
+def get_change_listener():
+    """Starts this process's listener on first use, or returns None when live updates are off"""
+    if not live_updates_enabled():
+        return None
+    try:
+        database_url = Connect_DB.get_database_url()
+    except KeyError:
+        return None
+    return ChangeListener(database_url, get_shared_cache())
+
+
+def rerun_fragments(keys):
+    """
+    From inside a fragment, reruns the @st.fragment(key=...) sections named by keys
+    instead of the page. st.rerun() only takes fragment keys from widget callbacks,
+    so this queues the request it would make; where this Streamlit can't, the page reruns.
+    """
+    from streamlit.errors import StreamlitAPIException
+    try:
+        from streamlit.runtime.scriptrunner import RerunData, get_script_run_ctx
+        ctx = get_script_run_ctx()
+        requested = ctx.script_requests.request_rerun(RerunData(
+            query_string=ctx.query_string,
+            page_script_hash=ctx.page_script_hash,
+            fragment_id_queue=ctx.fragment_storage.resolve_target(list(keys)),
+            is_fragment_scoped_rerun=True,
+            cached_message_hashes=ctx.cached_message_hashes,
+            context_info=ctx.context_info,
+        ))
+    except (ImportError, AttributeError, TypeError, StreamlitAPIException):
+        requested = False
+    if not requested:
+        st.rerun()
+    # Writing an element is a yield point: the script runner takes up the request there
+    st.empty()
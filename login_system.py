@@ -5,60 +5,33 @@ import hashlib
 import os
 import time
 from db_connection import Connect_DB
+from repositories import UserRepo
+from static_assets import inject_css
+from metrics import counter, histogram
+
+LOGIN_ATTEMPTS = counter("laytics_login_attempts_total", "Login attempts, by outcome (success, failure, error)", ("outcome",))
+LOGIN_SECONDS = histogram("laytics_login_seconds", "Time to check a login")
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
+@st.cache_resource(show_spinner=False)
+def _create_tables_once():
+    if not Connect_DB.create_tables():
+        # Raising keeps the failure out of the cache so the next run retries
+        raise RuntimeError("Database tables could not be created")
+    return True
+
 def initialize_database():
-    """Initialize the database tables"""
-    Connect_DB.create_tables()
+    """Initialize the database tables once per process"""
+    try:
+        _create_tables_once()
+    except RuntimeError:
+        pass
 
 def load_custom_css():
     """Load custom CSS styles for the application"""
-    st.markdown(
-        """
-        <style>
-        .stApp {
-            background: var(--background-color);
-            color: var(--text-color);
-        }
-
-        # .auth-container {
-        #     max-width: 400px;
-        #     margin: 2rem auto;
-        #     padding: 2rem;
-        #     background: white;
-        #     border-radius: 15px;
-        #     box-shadow: 0 5px 15px rgba(0,0,0,0.1);
-        # }
-
-        .auth-emoji {
-            font-size: 3rem;
-            text-align: center;
-            margin-bottom: 1rem;
-        }
-
-        .input-emoji {
-            font-size: 1.5rem;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            height: 100%;
-        }
-
-        .welcome-text {
-            text-align: center;
-            margin-bottom: 2rem;
-            color: #666;
-        }
-
-        .back-button {
-            margin-bottom: 1rem;
-        }
-        </style>
-        """,
-        unsafe_allow_html=True
-    )
+    inject_css("auth")
 
 class Login:
     def __init__(self):
@@ -130,13 +103,18 @@ class Login:
                     st.warning("Invalid credentials")
 
     def authenticate(self):
+        with LOGIN_SECONDS.time():
+            outcome = self._check_credentials()
+        LOGIN_ATTEMPTS.inc(outcome=outcome)
+        return outcome == "success"
+
+    def _check_credentials(self):
+        """Returns "success", "failure" (wrong credentials) or "error" (no database)"""
         connection = Connect_DB.get_connection()
         if connection:
             try:
                 cursor = connection.cursor(cursor_factory=RealDictCursor)
-                query = "SELECT id, password FROM users WHERE email = %s OR username = %s"
-                cursor.execute(query, (self.identifier, self.identifier))
-                result = cursor.fetchone()
+                result = UserRepo(cursor).find_by_identifier(self.identifier)
 
                 if result and result['password'] == hash_password(self.password):
                     # Clear all previous session state data
@@ -148,15 +126,15 @@ class Login:
                     st.session_state["identifier"] = self.identifier
                     st.session_state.user_id = result['id']  # Save user_id
                     st.session_state["show_login_form"] = False
-                    return True
-                return False
+                    return "success"
+                return "failure"
             except psycopg2.Error as e:
                 st.warning("Authentication error")
-                return False
+                return "error"
             finally:
                 cursor.close()
                 connection.close()
-        return False
+        return "error"
 
 
 class Signup:
@@ -223,25 +201,18 @@ class Signup:
             cursor = connection.cursor(cursor_factory=RealDictCursor)
 
             # Check if email or username exists
-            check_query = "SELECT * FROM users WHERE email = %s OR username = %s"
-            cursor.execute(check_query, (self.email, self.username))
-            if cursor.fetchone():
+            users = UserRepo(cursor)
+            if users.exists(self.email, self.username):
                 return False
 
             # Insert new user and fetch the id
-            query = """
-                INSERT INTO users (email, username, password)
-                VALUES (%s, %s, %s)
-                RETURNING id
-            """
-            cursor.execute(query, (self.email, self.username, hash_password(self.password)))
-            new_user = cursor.fetchone()
+            new_user_id = users.create(self.email, self.username, hash_password(self.password))
             connection.commit()
 
             # Set session state for the new user
             st.session_state.is_logged_in = True
             st.session_state.identifier = self.email
-            st.session_state.user_id = new_user['id']  # Set user_id
+            st.session_state.user_id = new_user_id  # Set user_id
 
             return True
 
@@ -1,8 +1,12 @@
 import streamlit as st
 import os
-from home_page import ClassManagerApp
+from db_connection import Connect_DB
 from login_system import initialize_database
-from class_manager import ClassManager
+from session_memory import account_session
+from metrics import histogram, start_metrics_server
+
+# main.py runs again on every rerun; the registry hands back the same histogram
+RUN_SECONDS = histogram("laytics_script_run_seconds", "Time of each full script run (every rerun)")
 
 
 # Set page configuration at the very beginning
@@ -14,6 +18,9 @@ st.set_page_config(
 )
 
 def main():
+    # Cancel queries an earlier run of this session left waiting (the page reran without them)
+    Connect_DB.begin_run()
+
     # Initialize database
     initialize_database()
 
@@ -37,12 +44,21 @@ def main():
         st.session_state.current_tab = "login"
 
     # Create and run the application
+    # Page modules are imported on first use so a cold replica only loads what it renders
     if st.session_state.is_logged_in:
+        from class_manager import ClassManager
         class_manager = ClassManager()
         class_manager.run()
     else:
+        from home_page import ClassManagerApp
+        Connect_DB.use_budget("login")
         app = ClassManagerApp()
         app.run()
 
+    # Record this session's memory use and release what idle sessions remembered
+    account_session()
+
 if __name__ == "__main__":
-    main()
+    start_metrics_server()
+    with RUN_SECONDS.time():
+        main()
@@ -0,0 +1,186 @@
+"""
+Autosave for marks entry.
+
+Marks are entered in one st.data_editor per exam; its edits are copied into the
+draft, which marks the edited students dirty. A small fragment on the
+results page checks the draft every AUTOSAVE_CHECK_SECONDS and, once no edit has
+been made for AUTOSAVE_DEBOUNCE_SECONDS, upserts only the rows whose marks (or the
+exam's total) differ from what was last saved, AUTOSAVE_BATCH_SIZE rows per
+statement. Saved marks are loaded back when the same exam is entered again, so a
+dropped session loses at most the last few seconds of typing.
+
+An autosave writes rows and nothing else. The exam's partial aggregate, the class
+rankings, the cube and the dashboard notification are brought up to date once per
+typing session: on Generate Result, when the teacher moves to another exam, or once
+no edit has been made for AUTOSAVE_PUBLISH_SECONDS.
+
+Settings: AUTOSAVE_DEBOUNCE_SECONDS (default 2), AUTOSAVE_BATCH_SIZE (default 100),
+AUTOSAVE_PUBLISH_SECONDS (default 30).
+"""
+import time
+import uuid
+import streamlit as st
+from db_connection import Connect_DB
+from repositories import CubeRepo, ExamRepo, RankingRepo, ResultRepo
+from stats_accumulators import RunningStats, save_partial
+from live_updates import publish_change
+
+AUTOSAVE_DEBOUNCE_SECONDS = float(Connect_DB.get_setting("AUTOSAVE_DEBOUNCE_SECONDS", 2))
+AUTOSAVE_BATCH_SIZE = int(Connect_DB.get_setting("AUTOSAVE_BATCH_SIZE", 100))
+AUTOSAVE_PUBLISH_SECONDS = float(Connect_DB.get_setting("AUTOSAVE_PUBLISH_SECONDS", 30))
+
+# How often the status fragment looks for pending edits (in memory only)
+AUTOSAVE_CHECK_SECONDS = 1
+
+DRAFT_KEY = "marks_draft"
+
+# Column of the marks editor that holds the marks
+MARKS_COLUMN = "Marks"
+
+
+class MarksDraft:
+    """
+    Autosave state for one exam (class, subject, exam name, exam date). Small enough for
+    st.session_state: marks maps student_id -> marks as entered, saved maps student_id ->
+    (marks, total_marks) as last written, dirty maps student_id -> time of the last edit
+    not yet written. exam_id stays None
+    until the exam's first row is written. unpublished holds the students whose written
+    rows are not yet in the exam's aggregates.
+    """
+
+    def __init__(self, class_id, subject, exam_name, exam_date, exam_id, saved):
+        self.exam = (class_id, subject, exam_name, exam_date)
+        self.exam_id = exam_id
+        self.saved = saved
+        self.marks = {student_id: marks for student_id, (marks, _) in saved.items()}
+        # A fresh editor per draft, so edits made to another exam are never replayed here
+        self.editor_key = f"marks_editor_{uuid.uuid4().hex}"
+        self.dirty = {}
+        self.total_marks = 0
+        self.last_edit = 0.0
+        self.saved_at = None
+        self.error = None
+        self.unpublished = set()
+
+    def touch(self, student_id=None):
+        self.last_edit = time.monotonic()
+        if student_id is not None:
+            self.dirty[student_id] = self.last_edit
+
+    def due(self):
+        return time.monotonic() - self.last_edit >= AUTOSAVE_DEBOUNCE_SECONDS
+
+    def publish_due(self):
+        return bool(self.unpublished) and time.monotonic() - self.last_edit >= AUTOSAVE_PUBLISH_SECONDS
+
+    def changes(self, student_ids=None):
+        """
+        student_id -> marks for rows that differ from what was saved: the edited ones
+        (and every saved one, if the total changed), or any of student_ids when given
+        """
+        if student_ids is None:
+            student_ids = set(self.dirty) | {sid for sid, (_, total) in self.saved.items() if total != self.total_marks}
+        changes = {}
+        for student_id in student_ids:
+            marks = self.marks.get(student_id)
+            if marks is not None and self.saved.get(student_id) != (marks, self.total_marks):
+                changes[student_id] = marks
+        return changes
+
+    def mark_saved(self, changes, started, exam_id):
+        """Records written rows; edits made while the write was running stay dirty"""
+        self.exam_id = exam_id
+        for student_id, marks in changes.items():
+            self.saved[student_id] = (marks, self.total_marks)
+        self.unpublished.update(changes)
+        for student_id, edited in list(self.dirty.items()):
+            if edited <= started:
+                del self.dirty[student_id]
+        self.saved_at = time.strftime("%H:%M:%S")
+        self.error = None
+
+
+def get_draft():
+    return st.session_state.get(DRAFT_KEY)
+
+
+def load_draft(cursor, user_id, class_id, subject, exam_name, exam_date, students):
+    """
+    Starts a draft for an exam, unless it is already the current one, holding the marks
+    that were saved (0 for everyone else). Returns the saved total marks, or None.
+    Looking an exam up never creates it; that waits for its first saved mark.
+    """
+    draft = get_draft()
+    if draft is not None and draft.exam == (class_id, subject, exam_name, exam_date):
+        return None
+    exam_id = ExamRepo(cursor).find(class_id, user_id, subject, exam_name, exam_date)
+    rows = ResultRepo(cursor).marks_for_exam(exam_id) if exam_id else []
+    saved = {row['student_id']: (row['marks'], row['total_marks']) for row in rows}
+    draft = MarksDraft(class_id, subject, exam_name, exam_date, exam_id, saved)
+    for student_id, _, _ in students:
+        draft.marks.setdefault(student_id, 0)
+    st.session_state[DRAFT_KEY] = draft
+    return max((total for _, total in saved.values()), default=None)
+
+
+def mark_dirty(student_id=None):
+    """on_change callback of the total marks widget"""
+    draft = get_draft()
+    if draft is not None:
+        draft.touch(student_id)
+
+
+def apply_edits(student_ids):
+    """
+    on_change callback of the marks editor: copies its edited rows (positions in
+    student_ids) into the draft and marks the students whose marks changed dirty
+    """
+    draft = get_draft()
+    if draft is None:
+        return
+    for row, values in st.session_state[draft.editor_key]["edited_rows"].items():
+        if MARKS_COLUMN not in values:
+            continue
+        student_id = student_ids[int(row)]
+        marks = int(values[MARKS_COLUMN] or 0)
+        if draft.marks.get(student_id) != marks:
+            draft.marks[student_id] = marks
+            draft.touch(student_id)
+
+
+def write_marks(cursor, user_id, draft, changes):
+    """
+    Upserts the changed rows in batches, creating the exam (and its subject) on first
+    use. The caller owns the transaction, so the returned exam id is only valid once
+    it commits.
+    """
+    class_id, subject, exam_name, exam_date = draft.exam
+    exam_id = draft.exam_id or ExamRepo(cursor).create(class_id, user_id, subject, exam_name, exam_date)
+    if exam_id is None:
+        raise ValueError("Class not found")
+    ResultRepo(cursor).upsert_many(
+        [(student_id, exam_id, marks, draft.total_marks) for student_id, marks in changes.items()],
+        page_size=AUTOSAVE_BATCH_SIZE
+    )
+    return exam_id
+
+
+def publish_marks(cursor, user_id, draft):
+    """
+    Folds the draft's written rows into the exam's partial aggregate, the class's
+    rankings and the exam's cube slices, and tells open dashboards. Returns the
+    students it covered; the caller owns the transaction.
+    """
+    class_id = draft.exam[0]
+    students = set(draft.unpublished)
+    # The partial covers every saved row of the exam, not just the ones written since the last publish
+    rows = ResultRepo(cursor).marks_for_exam(draft.exam_id)
+    stats = RunningStats.from_values(row['marks'] / row['total_marks'] * 100 for row in rows if row['total_marks'])
+    if save_partial(cursor, user_id, class_id, draft.exam_id, stats):
+        # A new latest exam moves every student's previous percentage
+        RankingRepo(cursor).refresh(class_id, user_id)
+    else:
+        RankingRepo(cursor).refresh_students(class_id, user_id, students)
+    CubeRepo(cursor).refresh_exam(user_id, draft.exam_id)
+    publish_change(cursor, user_id, "results", class_id=class_id)
+    return students
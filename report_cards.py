@@ -0,0 +1,333 @@
+"""
+Batch PDF report cards.
+
+Charts are rendered once per class to PNG and shared by every student in that
+class. Chart renders and student PDFs run in parallel across CPU cores, pipelined
+across classes, and are packaged into one zip per class. Runs as the "report_cards" background job, or directly:
+
+    python report_cards.py --user-id 1 [--class-id 7] [--out report_cards] [--processes 8]
+"""
+import argparse
+import io
+import os
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from grading import calculate_grade
+from jobs import register_job, job_output_dir
+
+# A4 portrait, in inches
+PAGE_SIZE = (8.27, 11.69)
+# Result rows on the first page (above the class charts) and on each continuation page
+FIRST_PAGE_ROWS = 20
+CONTINUATION_PAGE_ROWS = 48
+# Students rendered per worker task; large enough to amortize shipping the class charts
+STUDENTS_PER_TASK = 25
+# Classes in flight per worker process: keeps every core busy across class boundaries
+# while bounding the charts held in memory and the zips open at once
+CLASSES_PER_PROCESS = 2
+
+
+def fetch_report_data(cursor, user_id, class_ids=None):
+    """
+    Returns {class_id: {"class_name", "semester", "students": {student_id: {"roll_no", "name", "results"}}}}
+    for a user's classes, built from one query ordered for grouping.
+    """
+    conditions = "c.user_id = %s"
+    params = [user_id]
+    if class_ids:
+        conditions += " AND c.id = ANY(%s)"
+        params.append(list(class_ids))
+
+    cursor.execute(f"""
+        SELECT c.id AS class_id, c.class_name, c.semester,
+               s.id AS student_id, s.roll_no, s.name,
+               sb.name AS subject, e.exam_date, r.marks, r.total_marks
+        FROM classes c
+        JOIN students s ON s.class_id = c.id
+        JOIN results r ON r.student_id = s.id
+        JOIN exams e ON r.exam_id = e.id
+        JOIN subjects sb ON e.subject_id = sb.id
+        WHERE {conditions} AND r.total_marks > 0
+        ORDER BY c.id, s.roll_no, e.exam_date, sb.name_key
+    """, params)
+
+    classes = {}
+    for row in cursor.fetchall():
+        entry = classes.setdefault(row['class_id'], {
+            "class_name": row['class_name'],
+            "semester": row['semester'],
+            "students": {},
+        })
+        student = entry["students"].setdefault(row['student_id'], {
+            "roll_no": row['roll_no'],
+            "name": row['name'],
+            "results": [],
+        })
+        student["results"].append((row['subject'], row['exam_date'], row['marks'], row['total_marks']))
+    return classes
+
+
+def subject_averages(students):
+    """Average percentage per subject across the class"""
+    totals = defaultdict(lambda: [0.0, 0])
+    for student in students.values():
+        for subject, _, marks, total_marks in student["results"]:
+            totals[subject][0] += marks / total_marks * 100
+            totals[subject][1] += 1
+    return {subject: total / count for subject, (total, count) in sorted(totals.items())}
+
+
+def student_percentage(student):
+    obtained = sum(marks for _, _, marks, _ in student["results"])
+    possible = sum(total_marks for _, _, _, total_marks in student["results"])
+    return obtained / possible * 100 if possible else 0.0
+
+
+def render_class_charts(class_data):
+    """Renders the shared class charts to PNG bytes (subject averages, grade distribution)"""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
+    averages = subject_averages(class_data["students"])
+    grades = defaultdict(int)
+    for student in class_data["students"].values():
+        grades[calculate_grade(student_percentage(student))] += 1
+
+    figure = Figure(figsize=(7.5, 3.2), dpi=150)
+    left, right = figure.subplots(1, 2)
+    left.bar(list(averages), list(averages.values()), color="#4a90e2")
+    left.set_title("Class Average by Subject")
+    left.set_ylim(0, 100)
+    left.set_ylabel("Percentage")
+    left.tick_params(axis="x", labelrotation=45)
+
+    order = ["A+", "A", "B+", "B", "C+", "C", "F"]
+    labels = [grade for grade in order if grades[grade]]
+    right.pie([grades[grade] for grade in labels], labels=labels, wedgeprops={"width": 0.4})
+    right.set_title("Class Grade Distribution")
+    figure.tight_layout()
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue(), averages
+
+
+RESULT_COLUMNS = ["Subject", "Exam Date", "Marks", "Percentage", "Grade", "Class Avg"]
+
+
+def _results_table(figure, rows, bounds):
+    table_axes = figure.add_axes(bounds)
+    table_axes.axis("off")
+    table = table_axes.table(cellText=rows, colLabels=RESULT_COLUMNS, loc="upper center", cellLoc="center")
+    table.auto_set_font_size(False)
+    table.set_fontsize(9)
+    table.scale(1, 1.3)
+
+
+def render_student_pdf(class_name, semester, student, chart_image, averages):
+    """
+    Renders one student's report card and returns the PDF bytes and its page count.
+    Results that don't fit on the first page continue on further pages.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    overall = student_percentage(student)
+    rows = []
+    for subject, exam_date, marks, total_marks in student["results"]:
+        percentage = marks / total_marks * 100
+        rows.append([subject, f"{exam_date}", f"{marks}/{total_marks}", f"{percentage:.1f}%",
+                     calculate_grade(percentage), f"{averages.get(subject, 0):.1f}%"])
+
+    buffer = io.BytesIO()
+    with PdfPages(buffer) as pages:
+        figure = Figure(figsize=PAGE_SIZE)
+        figure.text(0.5, 0.95, "Report Card", ha="center", fontsize=22, weight="bold")
+        figure.text(0.5, 0.92, f"{class_name} · Semester {semester}", ha="center", fontsize=12)
+        figure.text(0.08, 0.88, f"Name: {student['name']}", fontsize=12)
+        figure.text(0.08, 0.86, f"Roll No: {student['roll_no']}", fontsize=12)
+        figure.text(0.92, 0.88, f"Overall: {overall:.1f}%", ha="right", fontsize=12, weight="bold")
+        figure.text(0.92, 0.86, f"Grade: {calculate_grade(overall)}", ha="right", fontsize=12, weight="bold")
+        _results_table(figure, rows[:FIRST_PAGE_ROWS], [0.08, 0.45, 0.84, 0.38])
+
+        chart_axes = figure.add_axes([0.06, 0.05, 0.88, 0.36])
+        chart_axes.imshow(chart_image)
+        chart_axes.axis("off")
+        pages.savefig(figure)
+
+        for start in range(FIRST_PAGE_ROWS, len(rows), CONTINUATION_PAGE_ROWS):
+            figure = Figure(figsize=PAGE_SIZE)
+            figure.text(0.08, 0.95, f"{student['name']} ({student['roll_no']}) · results continued", fontsize=12)
+            _results_table(figure, rows[start:start + CONTINUATION_PAGE_ROWS], [0.08, 0.05, 0.84, 0.88])
+            pages.savefig(figure)
+        page_count = pages.get_pagecount()
+    return buffer.getvalue(), page_count
+
+
+def render_student_batch(class_name, semester, students, chart_png, averages):
+    """Worker entry point: decodes the class charts once, then renders a batch of students"""
+    import matplotlib.image as mpimg
+
+    chart_image = mpimg.imread(io.BytesIO(chart_png), format="png")
+    return [
+        (student["roll_no"], *render_student_pdf(class_name, semester, student, chart_image, averages))
+        for student in students
+    ]
+
+
+def safe_name(value):
+    return "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in str(value)).strip("_") or "unnamed"
+
+
+def generate_report_cards(classes, output_dir, processes=None, progress=None):
+    """
+    Renders every student's report card and writes one zip per class into output_dir.
+    A class's student batches are submitted as soon as its charts are rendered, and its
+    zip is written as they finish, so classes overlap instead of running one at a time.
+    progress(done, total) is called as batches finish. Returns a summary with report
+    cards and pages per second.
+    """
+    started = time.perf_counter()
+    total = sum(len(data["students"]) for data in classes.values())
+    done = pages = 0
+    workers = processes or os.cpu_count()
+    paths = {
+        class_id: os.path.join(
+            output_dir, f"report_cards_{safe_name(data['class_name'])}_{safe_name(data['semester'])}_{class_id}.zip"
+        )
+        for class_id, data in classes.items()
+    }
+    waiting = iter(classes.items())
+    remaining = {}  # class_id -> batches not yet written
+    archives = {}  # class_id -> open zip, from its first finished batch to its last
+    pending = {}  # future -> (class_id, "charts" or "students")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        def start_next_class():
+            for class_id, class_data in waiting:
+                pending[executor.submit(render_class_charts, class_data)] = (class_id, "charts")
+                remaining[class_id] = None
+                return
+
+        try:
+            for _ in range(workers * CLASSES_PER_PROCESS):
+                start_next_class()
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    class_id, kind = pending.pop(future)
+                    class_data = classes[class_id]
+                    if kind == "charts":
+                        chart_png, averages = future.result()
+                        students = list(class_data["students"].values())
+                        for start in range(0, len(students), STUDENTS_PER_TASK):
+                            batch = executor.submit(
+                                render_student_batch,
+                                class_data["class_name"],
+                                class_data["semester"],
+                                students[start:start + STUDENTS_PER_TASK],
+                                chart_png,
+                                averages
+                            )
+                            pending[batch] = (class_id, "students")
+                        remaining[class_id] = -(-len(students) // STUDENTS_PER_TASK)
+                    else:
+                        if class_id not in archives:
+                            archives[class_id] = zipfile.ZipFile(paths[class_id], "w", compression=zipfile.ZIP_STORED)
+                        batch = future.result()
+                        for roll_no, pdf, page_count in batch:
+                            archives[class_id].writestr(f"{safe_name(roll_no)}.pdf", pdf)
+                            pages += page_count
+                        done += len(batch)
+                        remaining[class_id] -= 1
+                        if progress:
+                            progress(done, total)
+
+                    if remaining[class_id] == 0:
+                        archives.pop(class_id).close()
+                        del remaining[class_id]
+                        start_next_class()
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            for archive in archives.values():
+                archive.close()
+            raise
+
+    elapsed = time.perf_counter() - started
+    return {
+        "archives": list(paths.values()),
+        "report_cards": total,
+        "pages": pages,
+        "seconds": round(elapsed, 2),
+        "report_cards_per_second": round(total / elapsed, 2) if elapsed > 0 else None,
+        "pages_per_second": round(pages / elapsed, 2) if elapsed > 0 else None,
+    }
+
+
+@register_job("report_cards")
+def run_report_cards_job(job, connection):
+    """params: optional class_ids (defaults to all of the user's classes) and processes"""
+    cursor = connection.cursor()
+    classes = fetch_report_data(cursor, job.user_id, job.params.get("class_ids"))
+    cursor.close()
+    if not classes:
+        raise ValueError("No results found to build report cards from")
+
+    output_dir = os.path.join(job_output_dir(), f"job_{job.id}_report_cards")
+    os.makedirs(output_dir, exist_ok=True)
+    summary = generate_report_cards(
+        classes,
+        output_dir,
+        processes=job.params.get("processes"),
+        progress=lambda done, total: job.report(done / total, f"{done} of {total} report cards")
+    )
+
+    # Hand the UI a single download: one zip of the per-class zips
+    bundle_path = f"{output_dir}.zip"
+    with zipfile.ZipFile(bundle_path, "w", compression=zipfile.ZIP_STORED) as bundle:
+        for archive in summary["archives"]:
+            bundle.write(archive, os.path.basename(archive))
+    summary.update({
+        "path": bundle_path,
+        "file_name": "report_cards.zip",
+        "mime": "application/zip",
+    })
+    return summary
+
+
+def main():
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    from db_connection import Connect_DB
+
+    parser = argparse.ArgumentParser(description="Render PDF report cards for a user's classes")
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--class-id", type=int, action="append", dest="class_ids")
+    parser.add_argument("--out", default="report_cards")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        Connect_DB.get_database_url(),
+        cursor_factory=RealDictCursor,
+        sslmode=Connect_DB.get_setting("DB_SSLMODE", "require")
+    )
+    cursor = connection.cursor()
+    classes = fetch_report_data(cursor, args.user_id, args.class_ids)
+    connection.close()
+
+    os.makedirs(args.out, exist_ok=True)
+    summary = generate_report_cards(classes, args.out, args.processes)
+    print(f"{summary['report_cards']} report cards ({summary['pages']} pages) in {summary['seconds']}s "
+          f"({summary['report_cards_per_second']} cards/s, {summary['pages_per_second']} pages/s), "
+          f"{len(summary['archives'])} class archives in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
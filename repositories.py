@@ -0,0 +1,711 @@
+"""
+Data-access layer: every statement the app pages run lives here.
+
+Repositories wrap a cursor, so they work on any connection: pooled, replica, or a
+local test database. Statements marked hot are sent once per connection as a
+server-side PREPARE and afterwards run with EXECUTE, so PostgreSQL skips parsing
+and, after a few executions, planning. The per-connection cache follows pooled
+connections for their lifetime. Set DB_PREPARED_STATEMENTS = false when running
+behind a transaction-mode pooler such as PgBouncer, where server sessions are shared.
+
+Every execution is counted by statement name, and timed into the
+laytics_db_query_seconds metric; tests can assert on the counts with:
+
+    with counting_queries() as counts:
+        ...
+    assert counts["class_list_for_user"] == 1
+"""
+import re
+import threading
+import time
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.errors
+from psycopg2.extras import execute_values
+from db_connection import Connect_DB
+from metrics import counter, histogram
+
+# connection -> names of the statements already prepared on it
+_prepared = weakref.WeakKeyDictionary()
+
+_query_counts = Counter()
+_counts_lock = threading.Lock()
+
+_PLACEHOLDER = re.compile(r"\$(\d+)")
+
+QUERY_SECONDS = histogram("laytics_db_query_seconds", "Time per repository statement", ("statement",))
+QUERY_ERRORS = counter(
+    "laytics_db_query_errors_total", "Repository statements that failed, by error class", ("statement", "error")
+)
+
+
+def query_counts():
+    """Returns a copy of the executions per statement since the process started"""
+    with _counts_lock:
+        return Counter(_query_counts)
+
+
+@contextmanager
+def counting_queries():
+    """Yields a Counter that is filled with the statements executed inside the block"""
+    before = query_counts()
+    counts = Counter()
+    try:
+        yield counts
+    finally:
+        counts.update(query_counts() - before)
+
+
+def prepared_statements_enabled():
+    return str(Connect_DB.get_setting("DB_PREPARED_STATEMENTS", "true")).lower() not in ("0", "false", "no", "off")
+
+
+class Repository:
+    """
+    Base class: STATEMENTS maps a name to (sql, hot). SQL uses $1, $2... placeholders
+    so the same text serves PREPARE and, for statements that are not hot, a plain execute.
+    """
+
+    PREFIX = ""
+    STATEMENTS = {}
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.use_prepared = prepared_statements_enabled()
+
+    def execute(self, name, *params):
+        sql, hot = self.STATEMENTS[name]
+        key = f"{self.PREFIX}_{name}"
+        with _counts_lock:
+            _query_counts[key] += 1
+        with self._timed(key):
+            return self._execute(key, sql, hot, params)
+
+    def _execute(self, key, sql, hot, params):
+        if not (hot and self.use_prepared):
+            # psycopg2 wants %s placeholders in order, repeating values that are reused
+            positions = [int(number) - 1 for number in _PLACEHOLDER.findall(sql)]
+            self.cursor.execute(_PLACEHOLDER.sub("%s", sql), [params[index] for index in positions])
+            return self.cursor
+
+        connection = self.cursor.connection
+        prepared = _prepared.setdefault(connection, set())
+        if key not in prepared:
+            self.cursor.execute(f"PREPARE {key} AS {sql}")
+            prepared.add(key)
+
+        arguments = f"({', '.join(['%s'] * len(params))})" if params else ""
+        try:
+            self.cursor.execute(f"EXECUTE {key}{arguments}", params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # The server session was reset under us; prepare again on next use
+            prepared.discard(key)
+            raise
+        return self.cursor
+
+    def execute_values(self, name, rows, page_size=100):
+        """Runs a multi-row statement (one VALUES %s placeholder), page_size rows per round trip"""
+        sql, _ = self.STATEMENTS[name]
+        key = f"{self.PREFIX}_{name}"
+        with _counts_lock:
+            _query_counts[key] += -(-len(rows) // page_size)
+        with self._timed(key):
+            execute_values(self.cursor, sql, rows, page_size=page_size)
+        return self.cursor
+
+    @staticmethod
+    @contextmanager
+    def _timed(key):
+        """Records the statement's time, and its error class if it fails"""
+        started = time.perf_counter()
+        try:
+            yield
+        except psycopg2.Error as e:
+            QUERY_ERRORS.inc(statement=key, error=type(e).__name__)
+            raise
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - started, statement=key)
+
+
+class UserRepo(Repository):
+    PREFIX = "user"
+    STATEMENTS = {
+        "find_by_identifier": ("SELECT id, password FROM users WHERE email = $1 OR username = $1", False),
+        "exists": ("SELECT 1 FROM users WHERE email = $1 OR username = $2", False),
+        "create": ("INSERT INTO users (email, username, password) VALUES ($1, $2, $3) RETURNING id", False),
+    }
+
+    def find_by_identifier(self, identifier):
+        """Looks a user up by email or username"""
+        return self.execute("find_by_identifier", identifier).fetchone()
+
+    def exists(self, email, username):
+        return self.execute("exists", email, username).fetchone() is not None
+
+    def create(self, email, username, password_hash):
+        return self.execute("create", email, username, password_hash).fetchone()['id']
+
+
+# Dashboard aggregates; {semester} is empty, or narrows to the classes of one semester
+# (the classes(user_id, semester) index answers both)
+_CLASS_TOTALS = """
+    SELECT
+        (SELECT COUNT(*) FROM classes c WHERE c.user_id = $1 {semester}) AS total_classes,
+        (SELECT COUNT(s.id)
+         FROM students s
+         JOIN classes c ON s.class_id = c.id
+         WHERE c.user_id = $1 {semester}) AS total_students,
+        (SELECT COUNT(*)
+         FROM students s
+         JOIN classes c ON s.class_id = c.id
+         WHERE c.user_id = $1 {semester}
+         GROUP BY s.class_id
+         ORDER BY COUNT(*) DESC LIMIT 1) AS highest_students
+"""
+_CLASS_DISTRIBUTION = """
+    SELECT c.class_name, COUNT(s.id) AS student_count
+    FROM classes c
+    LEFT JOIN students s ON c.id = s.class_id
+    WHERE c.user_id = $1 AND c.archived_at IS NULL {semester}
+    GROUP BY c.class_name, c.id
+    ORDER BY student_count DESC
+"""
+_CLASS_ENROLLMENT = """
+    SELECT c.class_name, c.semester, COUNT(s.id) AS student_count
+    FROM classes c
+    LEFT JOIN students s ON c.id = s.class_id
+    WHERE c.user_id = $1 {semester}
+    GROUP BY c.class_name, c.semester, c.id
+    HAVING COUNT(s.id) > 0
+    ORDER BY student_count DESC
+"""
+_IN_SEMESTER = "AND c.semester = $2"
+
+# Classes and students created from $3 on, counted per class and date_trunc($2) bucket.
+# The created_at ranges are answered from the BRIN indexes, so a recent start reads
+# only the newest pages of the append-mostly tables.
+_ENROLLMENT_BUCKETS = """
+    SELECT bucket, class_id, semester,
+        SUM(new_classes)::integer AS new_classes, SUM(new_students)::integer AS new_students
+    FROM (
+        SELECT date_trunc($2, c.created_at)::date AS bucket, c.id AS class_id, c.semester,
+            1 AS new_classes, 0 AS new_students
+        FROM classes c
+        WHERE c.user_id = $1 AND c.created_at >= $3
+        UNION ALL
+        SELECT date_trunc($2, s.created_at)::date, s.class_id, c.semester, 0, COUNT(*)
+        FROM students s
+        JOIN classes c ON s.class_id = c.id
+        WHERE s.user_id = $1 AND s.created_at >= $3
+        GROUP BY 1, 2, 3
+    ) buckets
+    GROUP BY bucket, class_id, semester
+    ORDER BY bucket
+"""
+
+# Per-exam partials within an exam date range ($2 to $3), walked from the user's classes
+# through exams(class_id, exam_date) to result_aggregates' primary key; {scope} narrows
+# the classes to one semester or one class
+_SCOPED_PARTIALS = """
+    SELECT a.class_id, c.class_name, c.semester, a.exam_id, sb.name AS subject, e.name AS exam_name,
+        e.exam_date, a.count, a.mean, a.m2, a.min_value, a.max_value, a.histogram
+    FROM classes c
+    JOIN exams e ON e.class_id = c.id
+    JOIN subjects sb ON e.subject_id = sb.id
+    JOIN result_aggregates a ON a.exam_id = e.id
+    WHERE c.user_id = $1 AND e.exam_date BETWEEN $2 AND $3 {scope}
+"""
+
+
+class ClassRepo(Repository):
+    PREFIX = "class"
+    STATEMENTS = {
+        "create": (
+            "INSERT INTO classes (class_name, semester, total_students, user_id) VALUES ($1, $2, $3, $4) RETURNING id",
+            False,
+        ),
+        "list_for_user": (
+            "SELECT id, class_name, semester, total_students, archived_at FROM classes WHERE user_id = $1",
+            True,
+        ),
+        "get": ("SELECT * FROM classes WHERE id = $1 AND user_id = $2", True),
+        "totals": (_CLASS_TOTALS.format(semester=""), True),
+        "totals_in_semester": (_CLASS_TOTALS.format(semester=_IN_SEMESTER), True),
+        "distribution": (_CLASS_DISTRIBUTION.format(semester=""), True),
+        "distribution_in_semester": (_CLASS_DISTRIBUTION.format(semester=_IN_SEMESTER), True),
+        "enrollment": (_CLASS_ENROLLMENT.format(semester=""), True),
+        "enrollment_in_semester": (_CLASS_ENROLLMENT.format(semester=_IN_SEMESTER), True),
+        "enrollment_buckets": (_ENROLLMENT_BUCKETS, True),
+    }
+
+    def create(self, class_name, semester, total_students, user_id):
+        return self.execute("create", class_name, semester, total_students, user_id).fetchone()['id']
+
+    def list_for_user(self, user_id):
+        return self.execute("list_for_user", user_id).fetchall()
+
+    def get(self, class_id, user_id):
+        return self.execute("get", class_id, user_id).fetchone()
+
+    def totals(self, user_id, semester=None):
+        """Class count, student count and the size of the largest class (of one semester, if given)"""
+        if semester is None:
+            result = self.execute("totals", user_id).fetchone()
+        else:
+            result = self.execute("totals_in_semester", user_id, semester).fetchone()
+        if result and result['highest_students'] is None:
+            result['highest_students'] = 0
+        return result
+
+    def distribution(self, user_id, semester=None):
+        """Students per hot (not archived) class, largest first"""
+        if semester is None:
+            return self.execute("distribution", user_id).fetchall()
+        return self.execute("distribution_in_semester", user_id, semester).fetchall()
+
+    def enrollment(self, user_id, semester=None):
+        """Students per class and semester, for classes with at least one student"""
+        if semester is None:
+            return self.execute("enrollment", user_id).fetchall()
+        return self.execute("enrollment_in_semester", user_id, semester).fetchall()
+
+    def enrollment_buckets(self, user_id, unit, since):
+        """New classes and students per class and "week"/"month" bucket, created since the given time"""
+        return self.execute("enrollment_buckets", user_id, unit, since).fetchall()
+
+
+class StudentRepo(Repository):
+    PREFIX = "student"
+    STATEMENTS = {
+        "add": ("INSERT INTO students (class_id, roll_no, name, user_id) VALUES ($1, $2, $3, $4)", False),
+        "list_for_class": ("SELECT id, roll_no, name FROM students WHERE class_id = $1 AND user_id = $2", True),
+    }
+
+    def add(self, class_id, roll_no, name, user_id):
+        self.execute("add", class_id, roll_no, name, user_id)
+
+    def list_for_class(self, class_id, user_id):
+        return self.execute("list_for_class", class_id, user_id).fetchall()
+
+
+class ExamRepo(Repository):
+    PREFIX = "exam"
+    STATEMENTS = {
+        "find": ("""
+            SELECT e.id
+            FROM exams e
+            JOIN subjects sb ON e.subject_id = sb.id
+            JOIN classes c ON e.class_id = c.id
+            WHERE e.class_id = $1 AND c.user_id = $2 AND sb.name_key = subject_key($3)
+              AND e.name = btrim($4) AND e.exam_date = $5
+        """, True),
+        # Get-or-create in one round trip; the no-op updates make RETURNING yield existing rows
+        "create": ("""
+            WITH subject AS (
+                INSERT INTO subjects (class_id, name)
+                SELECT id, btrim($3) FROM classes WHERE id = $1 AND user_id = $2
+                ON CONFLICT (class_id, name_key) DO UPDATE SET class_id = EXCLUDED.class_id
+                RETURNING id, class_id
+            )
+            INSERT INTO exams (class_id, subject_id, name, exam_date)
+            SELECT class_id, id, btrim($4), $5 FROM subject
+            ON CONFLICT (subject_id, exam_date, name) DO UPDATE SET class_id = EXCLUDED.class_id
+            RETURNING id
+        """, False),
+        "subjects_for_class": ("""
+            SELECT sb.id, sb.name
+            FROM subjects sb
+            JOIN classes c ON sb.class_id = c.id
+            WHERE sb.class_id = $1 AND c.user_id = $2
+            ORDER BY sb.name_key
+        """, True),
+    }
+
+    def find(self, class_id, user_id, subject, name, exam_date):
+        """Id of an exam, matching the subject by subject_key; None if it doesn't exist yet"""
+        row = self.execute("find", class_id, user_id, subject, name, exam_date).fetchone()
+        return row['id'] if row else None
+
+    def create(self, class_id, user_id, subject, name, exam_date):
+        """Id of the exam, creating it (and its subject) if needed; None if the class isn't the user's"""
+        row = self.execute("create", class_id, user_id, subject, name, exam_date).fetchone()
+        return row['id'] if row else None
+
+    def subjects_for_class(self, class_id, user_id):
+        return self.execute("subjects_for_class", class_id, user_id).fetchall()
+
+
+class ResultRepo(Repository):
+    PREFIX = "result"
+    STATEMENTS = {
+        "upsert": ("""
+            INSERT INTO results (student_id, exam_id, marks, total_marks)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (exam_id, student_id)
+            DO UPDATE SET marks = EXCLUDED.marks, total_marks = EXCLUDED.total_marks,
+                          updated_at = CURRENT_TIMESTAMP
+        """, True),
+        # Multi-row form of upsert for execute_values; rows must not repeat a student
+        "upsert_many": ("""
+            INSERT INTO results (student_id, exam_id, marks, total_marks)
+            VALUES %s
+            ON CONFLICT (exam_id, student_id)
+            DO UPDATE SET marks = EXCLUDED.marks, total_marks = EXCLUDED.total_marks,
+                          updated_at = CURRENT_TIMESTAMP
+        """, False),
+        "marks_for_exam": ("SELECT student_id, marks, total_marks FROM results WHERE exam_id = $1", True),
+        "exams_for_class": ("""
+            SELECT e.id, sb.name AS subject, e.name, e.exam_date
+            FROM exams e
+            JOIN subjects sb ON e.subject_id = sb.id
+            JOIN classes c ON e.class_id = c.id
+            WHERE e.class_id = $1 AND c.user_id = $2
+              AND EXISTS (SELECT 1 FROM results r WHERE r.exam_id = e.id)
+            ORDER BY e.exam_date DESC, sb.name_key, e.name
+        """, True),
+        "performance_partials": ("""
+            SELECT a.class_id, c.class_name, c.semester, a.exam_id, sb.name AS subject, e.name AS exam_name,
+                e.exam_date, a.count, a.mean, a.m2, a.min_value, a.max_value, a.histogram
+            FROM result_aggregates a
+            JOIN exams e ON a.exam_id = e.id
+            JOIN subjects sb ON e.subject_id = sb.id
+            JOIN classes c ON a.class_id = c.id
+            WHERE a.user_id = $1
+        """, True),
+        "partials_between": (_SCOPED_PARTIALS.format(scope=""), True),
+        "semester_partials_between": (_SCOPED_PARTIALS.format(scope="AND c.semester = $4"), True),
+        "class_partials_between": (_SCOPED_PARTIALS.format(scope="AND c.id = $4"), True),
+    }
+
+    def upsert(self, student_id, exam_id, marks, total_marks):
+        self.execute("upsert", student_id, exam_id, marks, total_marks)
+
+    def upsert_many(self, rows, page_size=100):
+        """Upserts (student_id, exam_id, marks, total_marks) rows, page_size per statement"""
+        if rows:
+            self.execute_values("upsert_many", rows, page_size)
+
+    def marks_for_exam(self, exam_id):
+        """Saved marks of one exam (exam ids come from ExamRepo, which checks ownership)"""
+        return self.execute("marks_for_exam", exam_id).fetchall()
+
+    def exams_for_class(self, class_id, user_id):
+        """Exams with saved results (id, subject, name, exam_date), newest first"""
+        return self.execute("exams_for_class", class_id, user_id).fetchall()
+
+    def performance_partials(self, user_id):
+        """Mergeable per-exam aggregates (see stats_accumulators)"""
+        return self.execute("performance_partials", user_id).fetchall()
+
+    def scoped_partials(self, user_id, date_from, date_to, semester=None, class_id=None):
+        """Per-exam aggregates of exams held from date_from to date_to, in one semester or one class"""
+        if class_id is not None:
+            return self.execute("class_partials_between", user_id, date_from, date_to, class_id).fetchall()
+        if semester is not None:
+            return self.execute("semester_partials_between", user_id, date_from, date_to, semester).fetchall()
+        return self.execute("partials_between", user_id, date_from, date_to).fetchall()
+
+
+# Per-student totals of one class: the overall percentage weighs every exam by its total
+# marks, and the previous percentage is the same without the class's latest exam.
+# {students} narrows them to some students; {prune} drops the rows of students in scope
+# that no longer have results. New rows get rank 0 until the rerank that follows.
+_RANKING_TOTALS = """
+    WITH latest AS (
+        SELECT a.exam_id
+        FROM result_aggregates a
+        JOIN exams e ON a.exam_id = e.id
+        WHERE a.class_id = $1
+        ORDER BY e.exam_date DESC, e.id DESC
+        LIMIT 1
+    ), totals AS (
+        SELECT r.student_id, COUNT(*) AS exam_count,
+            SUM(r.marks)::numeric / SUM(r.total_marks) * 100 AS percentage,
+            SUM(r.marks) FILTER (WHERE r.exam_id <> (SELECT exam_id FROM latest))::numeric
+                / NULLIF(SUM(r.total_marks) FILTER (WHERE r.exam_id <> (SELECT exam_id FROM latest)), 0)
+                * 100 AS previous_percentage
+        FROM results r
+        JOIN exams e ON r.exam_id = e.id
+        JOIN classes c ON e.class_id = c.id
+        WHERE e.class_id = $1 AND c.user_id = $2 AND r.total_marks > 0 {students}
+        GROUP BY r.student_id
+    ), pruned AS (
+        DELETE FROM class_rankings cr
+        WHERE cr.class_id = $1 {prune} AND NOT EXISTS (SELECT 1 FROM totals WHERE totals.student_id = cr.student_id)
+    )
+    INSERT INTO class_rankings (student_id, class_id, user_id, exam_count, percentage, previous_percentage, rank)
+    SELECT student_id, $1, $2, exam_count, percentage, previous_percentage, 0 FROM totals
+    ON CONFLICT (student_id)
+    DO UPDATE SET exam_count = EXCLUDED.exam_count, percentage = EXCLUDED.percentage,
+                  previous_percentage = EXCLUDED.previous_percentage, updated_at = CURRENT_TIMESTAMP
+    WHERE (class_rankings.exam_count, class_rankings.percentage, class_rankings.previous_percentage)
+        IS DISTINCT FROM (EXCLUDED.exam_count, EXCLUDED.percentage, EXCLUDED.previous_percentage)
+"""
+
+
+class RankingRepo(Repository):
+    PREFIX = "ranking"
+    STATEMENTS = {
+        # Held until commit, so two writers of one class don't rank from each other's stale totals
+        "lock_class": ("SELECT pg_advisory_xact_lock(hashtext('class_rankings'), $1)", True),
+        "totals": (_RANKING_TOTALS.format(students="", prune=""), False),
+        # Only the students whose results were written: one index range of results per student
+        "student_totals": (_RANKING_TOTALS.format(
+            students="AND r.student_id = ANY($3)", prune="AND cr.student_id = ANY($3)"
+        ), True),
+        # Ranks from the stored totals (one row per student, no results read);
+        # rows whose rank didn't move are not rewritten
+        "rerank": ("""
+            WITH ranked AS (
+                SELECT student_id,
+                    DENSE_RANK() OVER (ORDER BY percentage DESC) AS rank,
+                    CASE WHEN previous_percentage IS NOT NULL
+                         THEN DENSE_RANK() OVER (ORDER BY previous_percentage DESC NULLS LAST) END AS previous_rank
+                FROM class_rankings
+                WHERE class_id = $1
+            )
+            UPDATE class_rankings cr
+            SET rank = ranked.rank, previous_rank = ranked.previous_rank, updated_at = CURRENT_TIMESTAMP
+            FROM ranked
+            WHERE cr.student_id = ranked.student_id
+              AND (cr.rank, cr.previous_rank) IS DISTINCT FROM (ranked.rank, ranked.previous_rank)
+        """, True),
+        # Top of the leaderboard: a range of the (class_id, rank) index; LIMIT NULL is everyone
+        "top_for_class": ("""
+            SELECT cr.rank, cr.previous_rank, cr.percentage, cr.exam_count, s.roll_no, s.name
+            FROM class_rankings cr
+            JOIN students s ON cr.student_id = s.id
+            WHERE cr.class_id = $1 AND cr.user_id = $2
+            ORDER BY cr.rank, s.roll_no
+            LIMIT $3
+        """, True),
+        # Classes with results but no rankings, and classes ranked before totals were stored
+        "unranked_classes": ("""
+            SELECT DISTINCT a.class_id, a.user_id
+            FROM result_aggregates a
+            WHERE NOT EXISTS (SELECT 1 FROM class_rankings cr WHERE cr.class_id = a.class_id)
+            UNION
+            SELECT DISTINCT class_id, user_id
+            FROM class_rankings
+            WHERE previous_rank IS NOT NULL AND previous_percentage IS NULL
+        """, False),
+    }
+
+    def refresh(self, class_id, user_id):
+        """
+        Recomputes every student's totals and re-ranks the class; for a new latest exam
+        (every previous percentage moves), restores and backfills
+        """
+        self.execute("lock_class", class_id)
+        self.execute("totals", class_id, user_id)
+        self.execute("rerank", class_id)
+
+    def refresh_students(self, class_id, user_id, student_ids):
+        """
+        Recomputes the totals of the students whose results changed, then re-ranks the
+        class from the stored totals; runs in the caller's transaction, after the write
+        """
+        if not student_ids:
+            return
+        self.execute("lock_class", class_id)
+        self.execute("student_totals", class_id, user_id, list(student_ids))
+        self.execute("rerank", class_id)
+
+    def top_for_class(self, class_id, user_id, limit=None):
+        """The class's leaderboard, best first; limit=None returns every ranked student"""
+        return self.execute("top_for_class", class_id, user_id, limit).fetchall()
+
+    def unranked_classes(self):
+        """(class_id, user_id) of classes whose rankings need a full refresh, e.g. from before rankings existed"""
+        return self.execute("unranked_classes").fetchall()
+
+
+# Rolls a user's per-exam partials up into result_cube with one GROUPING SETS query.
+# Histograms are summed bin by bin: every partial is unnested into its bins, each set is
+# grouped with the bin as well, and counts and sums are taken from the first bin only so
+# each exam counts once. {target} and {slices} narrow the input to the slices one exam
+# belongs to (every row of those slices passes, so their totals are complete); {keep}
+# then drops the incomplete groups the narrowed input produces for other slices.
+_CUBE_REFRESH = """
+    WITH {target}partials AS (
+        SELECT c.semester, a.class_id, sb.name AS subject, e.exam_date,
+            a.count, a.mean, a.m2, a.min_value, a.max_value, a.histogram
+        FROM result_aggregates a
+        JOIN exams e ON a.exam_id = e.id
+        JOIN subjects sb ON e.subject_id = sb.id
+        JOIN classes c ON a.class_id = c.id
+        WHERE a.user_id = $1 {slices}
+    ), bins AS (
+        SELECT GROUPING(p.semester, p.class_id, p.subject, p.exam_date) AS grouping,
+            p.semester, p.class_id, p.subject, p.exam_date, h.bin, SUM(h.n) AS n,
+            SUM(p.count) FILTER (WHERE h.bin = 1) AS count,
+            SUM(p.count * p.mean) FILTER (WHERE h.bin = 1) AS sum,
+            SUM(p.m2 + p.count * p.mean * p.mean) FILTER (WHERE h.bin = 1) AS sum_sq,
+            MIN(p.min_value) AS min_value, MAX(p.max_value) AS max_value
+        FROM partials p
+        CROSS JOIN LATERAL unnest(p.histogram) WITH ORDINALITY AS h(n, bin)
+        GROUP BY GROUPING SETS (
+            (p.semester, h.bin), (p.semester, p.class_id, h.bin),
+            (p.subject, h.bin), (p.semester, p.subject, h.bin),
+            (p.exam_date, h.bin), (p.semester, p.exam_date, h.bin)
+        )
+    ), cube AS (
+        SELECT CASE grouping WHEN 7 THEN 'semester' WHEN 3 THEN 'class' WHEN 13 THEN 'subject'
+                WHEN 5 THEN 'semester_subject' WHEN 14 THEN 'exam_date' WHEN 6 THEN 'semester_exam_date' END AS level,
+            semester, class_id, subject, exam_date,
+            SUM(count)::integer AS count, SUM(sum) AS sum, SUM(sum_sq) AS sum_sq,
+            MIN(min_value) AS min_value, MAX(max_value) AS max_value,
+            array_agg(n::integer ORDER BY bin) AS histogram
+        FROM bins
+        GROUP BY grouping, semester, class_id, subject, exam_date
+    ){prune}
+    INSERT INTO result_cube (user_id, level, semester, class_id, subject, exam_date,
+                             count, sum, sum_sq, min_value, max_value, histogram)
+    SELECT $1, cube.level, cube.semester, cube.class_id, cube.subject, cube.exam_date, cube.count,
+        cube.sum, cube.sum_sq, cube.min_value, cube.max_value, cube.histogram
+    FROM cube {keep}
+    ON CONFLICT (user_id, level, COALESCE(semester, ''), COALESCE(class_id, 0), COALESCE(subject, ''),
+                 COALESCE(exam_date, DATE '0001-01-01'))
+    DO UPDATE SET count = EXCLUDED.count, sum = EXCLUDED.sum, sum_sq = EXCLUDED.sum_sq,
+                  min_value = EXCLUDED.min_value, max_value = EXCLUDED.max_value,
+                  histogram = EXCLUDED.histogram, updated_at = CURRENT_TIMESTAMP
+    WHERE (result_cube.count, result_cube.sum, result_cube.sum_sq, result_cube.histogram)
+        IS DISTINCT FROM (EXCLUDED.count, EXCLUDED.sum, EXCLUDED.sum_sq, EXCLUDED.histogram)
+"""
+_CUBE_EXAM_TARGET = """target AS (
+        SELECT c.semester, e.class_id, sb.name AS subject, e.exam_date
+        FROM exams e
+        JOIN subjects sb ON e.subject_id = sb.id
+        JOIN classes c ON e.class_id = c.id
+        WHERE e.id = $2 AND c.user_id = $1
+    ), """
+_CUBE_EXAM_SLICES = """AND (c.semester = (SELECT semester FROM target) OR sb.name = (SELECT subject FROM target)
+                             OR e.exam_date = (SELECT exam_date FROM target))"""
+_CUBE_EXAM_KEEP = """JOIN target t ON (cube.semester IS NULL OR cube.semester = t.semester)
+        AND (cube.class_id IS NULL OR cube.class_id = t.class_id)
+        AND (cube.subject IS NULL OR cube.subject = t.subject)
+        AND (cube.exam_date IS NULL OR cube.exam_date = t.exam_date)"""
+_CUBE_PRUNE = """, pruned AS (
+        DELETE FROM result_cube rc
+        WHERE rc.user_id = $1 AND NOT EXISTS (
+            SELECT 1 FROM cube
+            WHERE cube.level = rc.level AND cube.semester IS NOT DISTINCT FROM rc.semester
+              AND cube.class_id IS NOT DISTINCT FROM rc.class_id AND cube.subject IS NOT DISTINCT FROM rc.subject
+              AND cube.exam_date IS NOT DISTINCT FROM rc.exam_date
+        )
+    )"""
+# Cube rows as mergeable partials (mean and M2 from the sums), like performance_partials
+_CUBE_ROWS = """
+    SELECT rc.level, rc.semester, rc.class_id, c.class_name, rc.subject, rc.exam_date, rc.count,
+        rc.sum / rc.count AS mean, GREATEST(rc.sum_sq - rc.sum * rc.sum / rc.count, 0) AS m2,
+        rc.min_value, rc.max_value, rc.histogram
+    FROM result_cube rc
+    LEFT JOIN classes c ON rc.class_id = c.id
+    WHERE rc.user_id = $1 AND rc.count > 0 {semester}
+"""
+
+
+class CubeRepo(Repository):
+    PREFIX = "cube"
+    STATEMENTS = {
+        # Held until commit: refreshes of one user's cube run one after another, and each one
+        # (a new statement, so a new snapshot) sees the partials the one before it committed
+        "lock_user": ("SELECT pg_advisory_xact_lock(hashtext('result_cube'), $1)", True),
+        # Runs with every results write: only the slices holding the exam are recomputed
+        "refresh_exam": (_CUBE_REFRESH.format(
+            target=_CUBE_EXAM_TARGET, slices=_CUBE_EXAM_SLICES, prune="", keep=_CUBE_EXAM_KEEP
+        ), True),
+        # Whole rebuild, for backfills and for classes leaving or coming back (archive, restore)
+        "refresh_user": (_CUBE_REFRESH.format(target="", slices="", prune=_CUBE_PRUNE, keep=""), False),
+        "for_user": (_CUBE_ROWS.format(semester=""), True),
+        # Within a semester, only the levels that keep the semester apply
+        "for_semester": (_CUBE_ROWS.format(
+            semester="AND rc.semester = $2 AND rc.level IN ('semester', 'class', 'semester_subject', 'semester_exam_date')"
+        ), True),
+        "uncubed_users": ("""
+            SELECT DISTINCT a.user_id
+            FROM result_aggregates a
+            WHERE NOT EXISTS (SELECT 1 FROM result_cube rc WHERE rc.user_id = a.user_id)
+            ORDER BY a.user_id
+        """, False),
+    }
+
+    def refresh_exam(self, user_id, exam_id):
+        """Recomputes the cube rows of the slices an exam belongs to, after its partial changed"""
+        self.execute("lock_user", user_id)
+        self.execute("refresh_exam", user_id, exam_id)
+
+    def refresh_user(self, user_id):
+        """Recomputes a user's whole cube and drops the rows of slices that no longer exist"""
+        self.execute("lock_user", user_id)
+        return self.execute("refresh_user", user_id)
+
+    def slices(self, user_id, semester=None):
+        """The user's cube rows (of one semester, if given), shaped like performance_partials plus level"""
+        if semester is None:
+            return self.execute("for_user", user_id).fetchall()
+        return self.execute("for_semester", user_id, semester).fetchall()
+
+    def uncubed_users(self):
+        """Users with partial aggregates but no cube yet, e.g. before the cube existed"""
+        return self.execute("uncubed_users").fetchall()
+
+
+class AtRiskRepo(Repository):
+    PREFIX = "at_risk"
+    STATEMENTS = {
+        # Answered from the partial index on flagged rows
+        "flagged_for_user": ("""
+            SELECT ar.student_id, s.roll_no, s.name, ar.class_id, c.class_name, c.semester,
+                ar.result_count, ar.percentile, ar.trend, ar.worst_drop, ar.reasons, ar.scored_at
+            FROM at_risk ar
+            JOIN students s ON ar.student_id = s.id
+            JOIN classes c ON ar.class_id = c.id
+            WHERE ar.user_id = $1 AND ar.flagged
+            ORDER BY ar.percentile, s.name
+        """, True),
+    }
+
+    def flagged_for_user(self, user_id):
+        """Students the last at-risk scan flagged, lowest percentile first (see at_risk.py)"""
+        return self.execute("flagged_for_user", user_id).fetchall()
+
+
+class CacheRepo(Repository):
+    PREFIX = "cache"
+    STATEMENTS = {
+        "get": ("SELECT value FROM cache_entries WHERE key = $1 AND expires_at > CURRENT_TIMESTAMP", True),
+        "set": ("""
+            INSERT INTO cache_entries (key, value, expires_at)
+            VALUES ($1, $2, CURRENT_TIMESTAMP + make_interval(secs => $3))
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+        """, True),
+        "delete": ("DELETE FROM cache_entries WHERE key = $1", True),
+        "purge_expired": ("DELETE FROM cache_entries WHERE expires_at <= CURRENT_TIMESTAMP", False),
+    }
+
+    def get(self, key):
+        row = self.execute("get", key).fetchone()
+        return bytes(row['value']) if row else None
+
+    def set(self, key, value, ttl):
+        self.execute("set", key, psycopg2.Binary(value), float(ttl))
+
+    def delete(self, key):
+        self.execute("delete", key)
+
+    def purge_expired(self):
+        return self.execute("purge_expired").rowcount
+
+
+class EventRepo(Repository):
+    PREFIX = "event"
+    STATEMENTS = {
+        # pg_notify is transactional: listeners only hear about committed changes
+        "notify": ("SELECT pg_notify($1, $2)", True),
+    }
+
+    def notify(self, channel, payload):
+        self.execute("notify", channel, payload)
@@ -0,0 +1,240 @@
+"""
+Per-session memory accounting and a bounded store for large per-session objects.
+
+st.session_state lives as long as the browser tab, whatever it holds, so pages
+keep only small values there. Anything large (class rosters and the like) goes
+through remember()/recall(), which keep it in a process-wide SessionStore with a
+per-session byte cap, a process-wide byte cap and an idle timeout, evicting least
+recently used entries first. Evicted values are simply recomputed on next use.
+
+Settings (secrets or environment):
+    SESSION_STORE_SESSION_BYTES  per-session cap for remembered objects (default 4 MiB)
+    SESSION_STORE_TOTAL_BYTES    cap across all sessions in this process (default 256 MiB)
+    SESSION_IDLE_SECONDS         drop remembered objects of sessions idle this long (default 1800)
+"""
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, defaultdict
+import streamlit as st
+from db_connection import Connect_DB
+
+MIB = 1024 * 1024
+
+# Objects that are shared, not owned by the session, and must not be walked
+_SKIP_TYPES = (type, type(sys), type(len), type(lambda: None))
+
+
+def deep_sizeof(obj, seen=None):
+    """Approximate bytes reachable from obj (containers, instances, numpy and pandas objects)"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, _SKIP_TYPES):
+        return 0
+    seen.add(id(obj))
+
+    # pandas / numpy report their own buffers, which getsizeof would miss
+    if hasattr(obj, "columns") and callable(getattr(obj, "memory_usage", None)):
+        return int(obj.memory_usage(deep=True).sum())
+    nbytes = getattr(obj, "nbytes", None)
+    if isinstance(nbytes, int) and not isinstance(obj, (bytes, bytearray, array)):
+        return nbytes + sys.getsizeof(obj, 0)
+
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool, array)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    else:
+        if hasattr(obj, "__dict__"):
+            size += deep_sizeof(vars(obj), seen)
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+class SessionStore:
+    """LRU store keyed by (session_id, key) with per-session and total byte caps"""
+
+    def __init__(self, session_bytes, total_bytes, idle_seconds):
+        self.session_bytes = session_bytes
+        self.total_bytes = total_bytes
+        self.idle_seconds = idle_seconds
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._usage = defaultdict(int)
+        self._last_seen = {}
+        self._total = 0
+
+    def get(self, session_id, key):
+        with self._lock:
+            self._last_seen[session_id] = time.monotonic()
+            entry = self._entries.get((session_id, key))
+            if entry is None:
+                return None
+            self._entries.move_to_end((session_id, key))
+            return entry[0]
+
+    def put(self, session_id, key, value):
+        """Stores value and returns its size; values larger than the session cap are not kept"""
+        size = deep_sizeof(value)
+        with self._lock:
+            self._last_seen[session_id] = time.monotonic()
+            self._remove((session_id, key))
+            if size > self.session_bytes:
+                return size
+            self._entries[(session_id, key)] = (value, size)
+            self._usage[session_id] += size
+            self._total += size
+
+            # Oldest entries of this session first, then oldest entries of any session
+            for entry_key in [k for k in self._entries if k[0] == session_id]:
+                if self._usage[session_id] <= self.session_bytes:
+                    break
+                self._remove(entry_key, evicted=True)
+            while self._total > self.total_bytes and self._entries:
+                self._remove(next(iter(self._entries)), evicted=True)
+        return size
+
+    def forget(self, session_id, key=None):
+        """Drops one key, or everything the session has stored"""
+        with self._lock:
+            keys = [(session_id, key)] if key is not None else [k for k in self._entries if k[0] == session_id]
+            for entry_key in keys:
+                self._remove(entry_key)
+
+    def sweep(self):
+        """Drops everything stored by sessions idle for longer than idle_seconds"""
+        cutoff = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = {session_id for session_id, seen in self._last_seen.items() if seen < cutoff}
+            for entry_key in [k for k in self._entries if k[0] in idle]:
+                self._remove(entry_key, evicted=True)
+            for session_id in idle:
+                del self._last_seen[session_id]
+
+    def usage(self, session_id=None):
+        """Bytes stored per key for one session, or per session for all of them"""
+        with self._lock:
+            if session_id is None:
+                return dict(self._usage)
+            return {key: size for (owner, key), (_, size) in self._entries.items() if owner == session_id}
+
+    @property
+    def total(self):
+        return self._total
+
+    def _remove(self, entry_key, evicted=False):
+        entry = self._entries.pop(entry_key, None)
+        if entry is None:
+            return
+        session_id = entry_key[0]
+        self._usage[session_id] -= entry[1]
+        self._total -= entry[1]
+        if self._usage[session_id] <= 0:
+            del self._usage[session_id]
+        if evicted:
+            self.evictions += 1
+
+
+@st.cache_resource
+def get_session_store():
+    return SessionStore(
+        session_bytes=int(Connect_DB.get_setting("SESSION_STORE_SESSION_BYTES", 4 * MIB)),
+        total_bytes=int(Connect_DB.get_setting("SESSION_STORE_TOTAL_BYTES", 256 * MIB)),
+        idle_seconds=float(Connect_DB.get_setting("SESSION_IDLE_SECONDS", 1800)),
+    )
+
+
+@st.cache_resource
+def _session_accounts():
+    """session_id -> {"state": {key: bytes}, "store": bytes, "seen": timestamp}, for every session in this process"""
+    return {"lock": threading.Lock(), "sessions": {}}
+
+
+def current_session_id():
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "local"
+
+
+def remember(key, value):
+    """Keeps a large object for this session in the bounded store and returns it"""
+    get_session_store().put(current_session_id(), key, value)
+    return value
+
+
+def recall(key):
+    """Returns a remembered object, or None if it was never stored or has been evicted"""
+    return get_session_store().get(current_session_id(), key)
+
+
+def forget(key=None):
+    get_session_store().forget(current_session_id(), key)
+
+
+def session_state_sizes():
+    """Approximate bytes per st.session_state key for the current session"""
+    return {key: deep_sizeof(value) for key, value in st.session_state.to_dict().items()}
+
+
+def account_session():
+    """
+    Records this session's memory use (session_state per key plus remembered objects)
+    and sweeps idle sessions. Called once per script run.
+    """
+    store = get_session_store()
+    store.sweep()
+    session_id = current_session_id()
+    accounts = _session_accounts()
+    with accounts["lock"]:
+        accounts["sessions"][session_id] = {
+            "state": session_state_sizes(),
+            "store": sum(store.usage(session_id).values()),
+            "seen": time.time(),
+        }
+        cutoff = time.time() - store.idle_seconds
+        for idle in [sid for sid, account in accounts["sessions"].items() if account["seen"] < cutoff]:
+            del accounts["sessions"][idle]
+
+
+def memory_report():
+    """Per-session totals for this process, largest first"""
+    accounts = _session_accounts()
+    with accounts["lock"]:
+        sessions = {
+            session_id: sum(account["state"].values()) + account["store"]
+            for session_id, account in accounts["sessions"].items()
+        }
+    store = get_session_store()
+    return {
+        "sessions": dict(sorted(sessions.items(), key=lambda item: item[1], reverse=True)),
+        "store_bytes": store.total,
+        "store_evictions": store.evictions,
+    }
+
+
+class Roster:
+    """
+    Compact class roster: ids in an int array and roll numbers / names in tuples,
+    instead of one dict per student. Iterates as (id, roll_no, name) tuples.
+    """
+
+    __slots__ = ("ids", "roll_nos", "names")
+
+    def __init__(self, students):
+        self.ids = array("q", (student['id'] for student in students))
+        self.roll_nos = tuple(student['roll_no'] for student in students)
+        self.names = tuple(student['name'] for student in students)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return zip(self.ids, self.roll_nos, self.names)
@@ -0,0 +1,371 @@
+"""
+Shared cache tier for values that are worth reusing across replicas (dashboard
+snapshots, class rosters).
+
+Lookups go to a small in-process LRU first and then to the shared backend, so
+the first replica to compute a value warms it for the whole fleet. Backends:
+
+    CACHE_BACKEND = "none"      in-process LRU only (default)
+    CACHE_BACKEND = "postgres"  UNLOGGED cache_entries table on the primary
+    CACHE_BACKEND = "socket"    cache_server.py on a local Unix socket (CACHE_SOCKET_PATH)
+
+The in-process copy lives for CACHE_LOCAL_TTL_SECONDS at most, so a write made
+on another replica is seen within that window once the shared entry is dropped.
+A backend that is down behaves like a miss: caching never breaks a page.
+
+Values reach the shared backend pickled and signed with HMAC-SHA256 under
+CACHE_SIGNING_KEY, over the key and the payload. Entries with a missing or wrong
+signature are rejected before they are unpickled, since anyone able to write the
+cache_entries table or reach the socket could otherwise run code in the app. Without
+a signing key the shared backends are not used.
+
+Values set with keep_stale=True also keep a last-good copy in process for
+CACHE_STALE_TTL_SECONDS (default a day), which invalidation leaves alone; pages
+fall back to it with get_stale() while the database is failing.
+"""
+import hashlib
+import hmac
+import pickle
+import socket
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from urllib.parse import quote
+import psycopg2
+from psycopg2.pool import PoolError
+import streamlit as st
+from db_connection import Connect_DB
+from repositories import CacheRepo
+from metrics import counter
+
+# Bump when the pickled shape of cached values changes, so old entries are ignored
+KEY_PREFIX = "laytics:v2:"
+
+# HMAC-SHA256 signature stored in front of each shared payload
+SIGNATURE_BYTES = 32
+
+# Shared sets between expired-row purges on the postgres backend
+PURGE_EVERY = 200
+
+# Every SharedCache of this process, for the lookup metric
+_caches = weakref.WeakSet()
+
+
+def _lookup_totals():
+    totals = {"local_hits": 0, "shared_hits": 0, "misses": 0, "rejected": 0, "errors": 0}
+    for cache in list(_caches):
+        for result, count in cache.stats.items():
+            totals[result] += count
+    return [({"result": result}, count) for result, count in totals.items()]
+
+
+counter(
+    "laytics_cache_lookups_total", "Shared cache lookups, by result (local_hits, shared_hits, misses, rejected, errors)",
+    ("result",), collect=_lookup_totals
+)
+
+
+class LocalLRU:
+    """Thread-safe in-process LRU with per-entry expiry"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Returns (hit, value)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+class PostgresBackend:
+    """Shared entries in the UNLOGGED cache_entries table (no WAL, so writes are cheap)"""
+
+    errors = (psycopg2.Error, PoolError)
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._sets = 0
+
+    def _run(self, action, commit=False):
+        with Connect_DB.pooled_connection(self.pool) as connection:
+            cursor = connection.cursor()
+            try:
+                result = action(CacheRepo(cursor))
+                if commit:
+                    connection.commit()
+                return result
+            finally:
+                cursor.close()
+
+    def get(self, key):
+        return self._run(lambda repo: repo.get(key))
+
+    def set(self, key, value, ttl):
+        self._sets += 1
+        purge = self._sets % PURGE_EVERY == 0
+
+        def store(repo):
+            repo.set(key, value, ttl)
+            if purge:
+                repo.purge_expired()
+        self._run(store, commit=True)
+
+    def delete(self, key):
+        self._run(lambda repo: repo.delete(key), commit=True)
+
+
+class SocketBackend:
+    """
+    Client for cache_server.py: a line protocol over a Unix socket, one connection per thread.
+
+        GET <key>                    -> HIT <n>\\n<n bytes> | MISS
+        SET <key> <ttl> <n>\\n<bytes> -> OK
+        DEL <key>                    -> OK
+    """
+
+    errors = (OSError, ValueError)
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        stream = getattr(self._local, "stream", None)
+        if stream is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            stream = self._local.stream = sock.makefile("rwb")
+            self._local.socket = sock
+        return stream
+
+    def _request(self, header, payload=b""):
+        try:
+            stream = self._connection()
+            stream.write(header.encode() + b"\n" + payload)
+            stream.flush()
+            reply = stream.readline().decode().split()
+            if not reply:
+                raise ConnectionError("cache server closed the connection")
+            if reply[0] == "HIT":
+                return stream.read(int(reply[1]))
+            return None
+        except BaseException:
+            # Drop the connection so the next request starts clean
+            self._close()
+            raise
+
+    def _close(self):
+        for name in ("stream", "socket"):
+            handle = getattr(self._local, name, None)
+            if handle is not None:
+                handle.close()
+                setattr(self._local, name, None)
+
+    def get(self, key):
+        return self._request(f"GET {quote(key, safe='')}")
+
+    def set(self, key, value, ttl):
+        self._request(f"SET {quote(key, safe='')} {float(ttl)} {len(value)}", value)
+
+    def delete(self, key):
+        self._request(f"DEL {quote(key, safe='')}")
+
+
+class SharedCache:
+    """In-process LRU in front of a shared backend; values are pickled and signed for the backend"""
+
+    def __init__(self, backend, local, default_ttl, stale=None, signing_key=b""):
+        self.backend = backend
+        self.local = local
+        self.default_ttl = default_ttl
+        self.stale = stale
+        self.signing_key = signing_key
+        self.errors = getattr(backend, "errors", ())
+        self.stats = {"local_hits": 0, "shared_hits": 0, "misses": 0, "rejected": 0, "errors": 0}
+        _caches.add(self)
+
+    def _signature(self, key, payload):
+        return hmac.new(self.signing_key, key.encode() + b"\0" + payload, hashlib.sha256).digest()
+
+    def _pack(self, key, value):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        return self._signature(key, payload) + payload
+
+    def _unpack(self, key, signed):
+        """The payload if its signature matches this key, else None; only then is it unpickled"""
+        signature, payload = signed[:SIGNATURE_BYTES], signed[SIGNATURE_BYTES:]
+        if len(signature) < SIGNATURE_BYTES or not hmac.compare_digest(signature, self._signature(key, payload)):
+            return None
+        return payload
+
+    def get(self, key):
+        """Returns (hit, value)"""
+        key = KEY_PREFIX + key
+        hit, value = self.local.get(key)
+        if hit:
+            self.stats["local_hits"] += 1
+            return True, value
+        try:
+            payload = self.backend.get(key)
+        except self.errors:
+            self.stats["errors"] += 1
+            payload = None
+        if payload is not None:
+            payload = self._unpack(key, payload)
+            if payload is None:
+                self.stats["rejected"] += 1
+        if payload is None:
+            self.stats["misses"] += 1
+            return False, None
+        value = pickle.loads(payload)
+        self.local.set(key, value, self.local.ttl)
+        self.stats["shared_hits"] += 1
+        return True, value
+
+    def set(self, key, value, ttl=None, local_ttl=None, keep_stale=False):
+        """
+        local_ttl may exceed the usual in-process lifetime when every replica is told
+        about changes (see live_updates.py), since stale local copies are then dropped.
+        keep_stale also keeps a last-good copy for get_stale().
+        """
+        ttl = ttl or self.default_ttl
+        key = KEY_PREFIX + key
+        self.local.set(key, value, local_ttl or min(ttl, self.local.ttl))
+        if keep_stale and self.stale is not None:
+            self.stale.set(key, (value, time.time()), self.stale.ttl)
+        try:
+            self.backend.set(key, self._pack(key, value), ttl)
+        except self.errors:
+            self.stats["errors"] += 1
+
+    def delete(self, key):
+        key = KEY_PREFIX + key
+        self.local.delete(key)
+        try:
+            self.backend.delete(key)
+        except self.errors:
+            self.stats["errors"] += 1
+
+    def get_stale(self, key):
+        """Returns (hit, value, saved_at) for the last value kept with keep_stale, however old"""
+        if self.stale is None:
+            return False, None, None
+        hit, entry = self.stale.get(KEY_PREFIX + key)
+        return (True, *entry) if hit else (False, None, None)
+
+    def clear_local(self):
+        self.local.clear()
+
+    def get_or_compute(self, key, compute, ttl=None):
+        """Returns the cached value, or computes and caches it (None results are not cached)"""
+        hit, value = self.get(key)
+        if hit:
+            return value
+        value = compute()
+        if value is not None:
+            self.set(key, value, ttl)
+        return value
+
+
+def create_backend(name, signing_key=b""):
+    if name in ("postgres", "socket") and not signing_key:
+        print(f"[cache] CACHE_BACKEND = {name!r} needs CACHE_SIGNING_KEY; using the in-process cache only", flush=True)
+        return NullBackend()
+    if name == "postgres":
+        pool = Connect_DB.get_pool()
+        return PostgresBackend(pool) if pool else NullBackend()
+    if name == "socket":
+        from cache_server import default_socket_path
+
+        return SocketBackend(
+            Connect_DB.get_setting("CACHE_SOCKET_PATH") or default_socket_path(),
+            float(Connect_DB.get_setting("CACHE_SOCKET_TIMEOUT", 0.5))
+        )
+    return NullBackend()
+
+
+@st.cache_resource
+def get_shared_cache():
+    signing_key = str(Connect_DB.get_setting("CACHE_SIGNING_KEY", "")).encode()
+    return SharedCache(
+        create_backend(str(Connect_DB.get_setting("CACHE_BACKEND", "none")).lower(), signing_key),
+        LocalLRU(
+            max_entries=int(Connect_DB.get_setting("CACHE_LOCAL_MAX_ENTRIES", 512)),
+            ttl=float(Connect_DB.get_setting("CACHE_LOCAL_TTL_SECONDS", 5))
+        ),
+        default_ttl=float(Connect_DB.get_setting("CACHE_DEFAULT_TTL_SECONDS", 60)),
+        stale=LocalLRU(
+            max_entries=int(Connect_DB.get_setting("CACHE_LOCAL_MAX_ENTRIES", 512)),
+            ttl=float(Connect_DB.get_setting("CACHE_STALE_TTL_SECONDS", 86400))
+        ),
+        signing_key=signing_key
+    )
+
+
+# Dashboard datasets are cached separately so a change only drops the ones it affects
+DASHBOARD_DATASETS = ("classes", "totals", "class_distribution", "performance_cube", "enrollment", "at_risk")
+# Closed buckets of the enrollment trend, one entry per bucket unit (see Dashboard.get_enrollment_trend)
+ENROLLMENT_TREND_DATASETS = ("enrollment_week", "enrollment_month")
+CHANGE_DATASETS = {
+    "classes": ("classes", "totals", "class_distribution", "enrollment") + ENROLLMENT_TREND_DATASETS,
+    "results": ("performance_cube",),
+    "at_risk": ("at_risk",),
+}
+
+
+def dashboard_key(user_id, dataset):
+    return f"dashboard:{user_id}:{dataset}"
+
+
+def roster_key(user_id, class_id):
+    return f"roster:{user_id}:{class_id}"
+
+
+def invalidate_user(user_id, change=None, cache=None):
+    """
+    Drops the dashboard datasets a change of the given kind ("classes", "results" or "at_risk")
+    makes stale, or all of them when the kind is not given
+    """
+    cache = cache or get_shared_cache()
+    for dataset in CHANGE_DATASETS.get(change, DASHBOARD_DATASETS + ENROLLMENT_TREND_DATASETS):
+        cache.delete(dashboard_key(user_id, dataset))
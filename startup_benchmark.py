@@ -0,0 +1,98 @@
+"""
+Cold-start benchmark for the landing page.
+
+    python startup_benchmark.py [--runs 5] [--budget startup_budget.json]
+
+Each run starts a fresh interpreter, so module caches are cold like on a new replica:
+  * import_ms  - time to import main.py (and whatever it pulls in at module load)
+  * render_ms  - time for the first full script run of the anonymous landing page
+
+The median of each is compared with the budget file and the script exits with
+status 1 if any budget is exceeded, so CI fails when startup regresses.
+Set LAYTICS_BENCH_DATABASE_URL to render against a real database; by default an
+unreachable address is used and the page renders without one.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+DEFAULT_BUDGET = BASE_DIR / "startup_budget.json"
+DEFAULT_DATABASE_URL = "postgresql://bench@127.0.0.1:1/bench?connect_timeout=1"
+
+IMPORT_PROBE = """
+import sys, time
+sys.path.insert(0, {base!r})
+start = time.perf_counter()
+import main
+print((time.perf_counter() - start) * 1000)
+"""
+
+RENDER_PROBE = """
+import time
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+app = AppTest.from_file({main!r}, default_timeout=60)
+app.secrets["secrets"] = {{"DATABASE_URL": {database_url!r}}}
+app.run()
+elapsed = (time.perf_counter() - start) * 1000
+if app.exception:
+    raise SystemExit("landing page raised: " + app.exception[0].message)
+print(elapsed)
+"""
+
+
+def run_probe(code):
+    """Runs a probe in a fresh interpreter and returns the milliseconds it printed"""
+    completed = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=BASE_DIR,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip() or completed.stdout.strip())
+    return float(completed.stdout.strip().splitlines()[-1])
+
+
+def measure(runs, database_url):
+    import_times = [run_probe(IMPORT_PROBE.format(base=str(BASE_DIR))) for _ in range(runs)]
+    render_times = [
+        run_probe(RENDER_PROBE.format(main=str(BASE_DIR / "main.py"), database_url=database_url))
+        for _ in range(runs)
+    ]
+    return {
+        "import_ms": statistics.median(import_times),
+        "render_ms": statistics.median(render_times),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure landing page cold-start time against a budget")
+    parser.add_argument("--runs", type=int, default=5, help="fresh-interpreter runs per measurement")
+    parser.add_argument("--budget", type=Path, default=DEFAULT_BUDGET, help="JSON file of millisecond budgets")
+    args = parser.parse_args()
+
+    budget = json.loads(args.budget.read_text())
+    database_url = os.environ.get("LAYTICS_BENCH_DATABASE_URL", DEFAULT_DATABASE_URL)
+    results = measure(args.runs, database_url)
+
+    failed = False
+    for name, value in results.items():
+        limit = budget.get(name)
+        status = "ok"
+        if limit is not None and value > limit:
+            status = "OVER BUDGET"
+            failed = True
+        print(f"{name:>10}: {value:8.1f} ms (budget {limit} ms) {status}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
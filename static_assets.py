@@ -0,0 +1,72 @@
+import hashlib
+import json
+import re
+from pathlib import Path
+import streamlit as st
+
+BASE_DIR = Path(__file__).resolve().parent
+ASSETS_DIR = BASE_DIR / "assets"
+STATIC_DIR = BASE_DIR / "static"
+MANIFEST_PATH = STATIC_DIR / "manifest.json"
+
+# Streamlit serves ./static at this URL prefix when server.enableStaticServing is on
+STATIC_URL_PREFIX = "app/static"
+
+
+def content_hash(data):
+    """Short content hash used to version asset URLs"""
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def minify_css(css):
+    """Strips comments and redundant whitespace from a stylesheet"""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};:,>])\s*", r"\1", css)
+    css = css.replace(";}", "}")
+    return css.strip()
+
+
+@st.cache_resource(show_spinner=False)
+def load_manifest():
+    """Reads the build manifest (asset path -> content hash) written by build_assets.py"""
+    try:
+        return json.loads(MANIFEST_PATH.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def asset_url(path):
+    """
+    Returns the URL of a file under ./static, versioned with its content hash.
+    The ?v= parameter lets the static file server send long-lived cache headers
+    while a rebuilt asset still gets a fresh URL. Returns None if the asset is missing.
+    """
+    version = load_manifest().get(path)
+    if version is None:
+        file_path = STATIC_DIR / path
+        if not file_path.is_file():
+            return None
+        version = content_hash(file_path.read_bytes())
+    return f"{STATIC_URL_PREFIX}/{path}?v={version}"
+
+
+@st.cache_resource(show_spinner=False)
+def load_css(name):
+    """
+    Returns the minified stylesheet, read once per process. Prefers the build output
+    in static/css and falls back to minifying the source in assets/css.
+    """
+    built = STATIC_DIR / "css" / f"{name}.min.css"
+    if built.is_file():
+        return built.read_text()
+    return minify_css((ASSETS_DIR / "css" / f"{name}.css").read_text())
+
+
+def inject_css(name):
+    """
+    Injects a stylesheet into the page. Streamlit drops elements that a rerun does not
+    emit again, so the <style> block is sent on every run, but it comes from the
+    per-process cache and is identical each time, so the browser does not re-apply it.
+    """
+    st.markdown(f"<style>{load_css(name)}</style>", unsafe_allow_html=True)
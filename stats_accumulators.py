@@ -0,0 +1,218 @@
+import math
+
+# Percentages are bucketed into fixed-width bins so histograms from different
+# classes, subjects and exams can be merged by simple element-wise addition.
+HISTOGRAM_BINS = 20
+HISTOGRAM_MIN = 0.0
+HISTOGRAM_MAX = 100.0
+
+# The result_cube levels (see CubeRepo) and the columns each one groups by
+CUBE_LEVELS = {
+    "semester": ("semester",),
+    "class": ("semester", "class_id"),
+    "subject": ("subject",),
+    "semester_subject": ("semester", "subject"),
+    "exam_date": ("exam_date",),
+    "semester_exam_date": ("semester", "exam_date"),
+}
+
+
+class RunningStats:
+    """
+    Mergeable accumulator for count, mean, M2 (sum of squared deviations),
+    min/max and a fixed-bin histogram used for approximate quantiles.
+    Values are added with Welford's update and partials are combined with
+    Chan's parallel formula, so no accumulator ever needs the raw rows again.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=None, maximum=None, histogram=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+        self.histogram = list(histogram) if histogram else [0] * HISTOGRAM_BINS
+
+    @staticmethod
+    def bin_index(value):
+        """Returns the histogram bin for a value, clamping out-of-range values"""
+        width = (HISTOGRAM_MAX - HISTOGRAM_MIN) / HISTOGRAM_BINS
+        index = int((value - HISTOGRAM_MIN) // width)
+        return min(max(index, 0), HISTOGRAM_BINS - 1)
+
+    def add(self, value):
+        """Adds a single observation (Welford)"""
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.histogram[self.bin_index(value)] += 1
+        return self
+
+    def merge(self, other):
+        """Combines another accumulator into this one in place (Chan et al.)"""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.minimum, self.maximum = other.minimum, other.maximum
+            self.histogram = list(other.histogram)
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+        return self
+
+    @classmethod
+    def from_values(cls, values):
+        stats = cls()
+        for value in values:
+            stats.add(value)
+        return stats
+
+    @classmethod
+    def combine(cls, partials):
+        """Returns a new accumulator holding the merge of all partials"""
+        total = cls()
+        for partial in partials:
+            total.merge(partial)
+        return total
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count > 0 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def quantile(self, q):
+        """Approximates the q-th quantile by interpolating inside the histogram bin"""
+        if self.count == 0:
+            return None
+        if q <= 0:
+            return self.minimum
+        if q >= 1:
+            return self.maximum
+
+        width = (HISTOGRAM_MAX - HISTOGRAM_MIN) / HISTOGRAM_BINS
+        target = q * self.count
+        seen = 0
+        for index, bin_count in enumerate(self.histogram):
+            if bin_count and seen + bin_count >= target:
+                low = HISTOGRAM_MIN + index * width
+                estimate = low + (target - seen) / bin_count * width
+                return min(max(estimate, self.minimum), self.maximum)
+            seen += bin_count
+        return self.maximum
+
+    @property
+    def median(self):
+        return self.quantile(0.5)
+
+    @classmethod
+    def from_row(cls, row):
+        """Builds an accumulator from a result_aggregates row"""
+        return cls(
+            count=row['count'],
+            mean=row['mean'],
+            m2=row['m2'],
+            minimum=row['min_value'],
+            maximum=row['max_value'],
+            histogram=row['histogram'],
+        )
+
+
+def merge_by(rows, key):
+    """
+    Groups result_aggregates rows by key(row) and merges each group's partials.
+    Returns a dict of key -> RunningStats, e.g. per class, semester or subject.
+    """
+    groups = {}
+    for row in rows:
+        group = key(row)
+        if group not in groups:
+            groups[group] = RunningStats()
+        groups[group].merge(RunningStats.from_row(row))
+    return groups
+
+
+def cube_rows(partials):
+    """
+    Rolls per-exam partials up into the result_cube levels, in the shape CubeRepo.slices
+    returns, for partials the cube doesn't hold (archived classes, exam date ranges)
+    """
+    class_names = {row['class_id']: row['class_name'] for row in partials}
+    rows = []
+    for level, columns in CUBE_LEVELS.items():
+        for key, stats in merge_by(partials, lambda row: tuple(row[column] for column in columns)).items():
+            row = dict.fromkeys(("semester", "class_id", "subject", "exam_date"))
+            row.update(zip(columns, key))
+            row.update(
+                level=level,
+                class_name=class_names.get(row['class_id']),
+                count=stats.count,
+                mean=stats.mean,
+                m2=stats.m2,
+                min_value=stats.minimum,
+                max_value=stats.maximum,
+                histogram=stats.histogram,
+            )
+            rows.append(row)
+    return rows
+
+
+def save_partial(cursor, user_id, class_id, exam_id, stats):
+    """
+    Upserts the partial aggregate for one exam; returns True if the exam had none yet.
+    The caller owns the transaction; this runs on the same cursor as the results write.
+    """
+    cursor.execute(
+        """INSERT INTO result_aggregates
+               (exam_id, class_id, user_id, count, mean, m2, min_value, max_value, histogram)
+           VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+           ON CONFLICT (exam_id)
+           DO UPDATE SET count = EXCLUDED.count, mean = EXCLUDED.mean, m2 = EXCLUDED.m2,
+                         min_value = EXCLUDED.min_value, max_value = EXCLUDED.max_value,
+                         histogram = EXCLUDED.histogram, updated_at = CURRENT_TIMESTAMP
+           RETURNING (xmax = 0) AS inserted""",
+        (exam_id, class_id, user_id, stats.count, stats.mean, stats.m2,
+         stats.minimum, stats.maximum, stats.histogram)
+    )
+    # xmax is 0 only on a row version the upsert inserted rather than updated
+    return cursor.fetchone()['inserted']
+
+
+def backfill_partials(cursor, user_id):
+    """
+    Computes partial aggregates from existing results for a user that has none yet.
+    This is a one-time scan; afterwards partials are maintained on every results write.
+    """
+    cursor.execute("""
+        SELECT e.class_id, r.exam_id, r.marks::float / r.total_marks * 100 AS percentage
+        FROM results r
+        JOIN exams e ON r.exam_id = e.id
+        JOIN classes c ON e.class_id = c.id
+        LEFT JOIN result_aggregates a ON a.exam_id = r.exam_id
+        WHERE c.user_id = %s AND r.total_marks > 0 AND a.exam_id IS NULL
+    """, (user_id,))
+
+    groups = {}
+    for row in cursor.fetchall():
+        key = (row['class_id'], row['exam_id'])
+        if key not in groups:
+            groups[key] = RunningStats()
+        groups[key].add(row['percentage'])
+
+    for (class_id, exam_id), stats in groups.items():
+        save_partial(cursor, user_id, class_id, exam_id, stats)
+    return len(groups)